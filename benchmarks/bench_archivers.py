@@ -0,0 +1,110 @@
+"""Throughput comparison of the archive engines and formats.
+
+Usage: python benchmarks/bench_archivers.py [--size-mb 64] [--workers 4]
+"""
+import argparse
+import os
+import random
+import shutil
+import string
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from xtremcache.archivermanager import create_archiver
+from xtremcache.exceptions import XtremCacheMissingDependencyError
+
+
+def generate_tree(root: str, size: int) -> None:
+    """Generate a build-output like tree: a few big binaries, a lot of small text files."""
+
+    random.seed(0)
+    words = [''.join(random.choice(string.ascii_lowercase) for _ in range(8)) for _ in range(2000)]
+    written = 0
+    index = 0
+    while written < size:
+        sub_dir = os.path.join(root, f'dir_{index % 50}')
+        os.makedirs(sub_dir, exist_ok=True)
+        if index % 100 == 0:
+            # Half compressible binary: random bytes followed by zeros.
+            content = os.urandom(512 * 1024) + bytes(512 * 1024)
+            name = f'lib_{index}.so'
+        else:
+            content = ' '.join(random.choice(words) for _ in range(random.randint(100, 4000))).encode()
+            name = f'source_{index}.txt'
+        with open(os.path.join(sub_dir, name), 'wb') as f:
+            f.write(content)
+        written += len(content)
+        index += 1
+
+
+def bench(cache_dir: str, src: str, dest: str, archiver: str, archive_format: str, workers: int) -> list:
+    archiver_obj = create_archiver(cache_dir, archiver, archive_format, workers)
+    start = time.perf_counter()
+    archive_path = archiver_obj.archive('bench', src)
+    archive_time = time.perf_counter() - start
+    start = time.perf_counter()
+    archiver_obj.extract('bench', dest, archive_path)
+    extract_time = time.perf_counter() - start
+    archive_size = os.path.getsize(archive_path)
+    os.remove(archive_path)
+    shutil.rmtree(dest)
+    return archive_time, extract_time, archive_size
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size-mb', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(temp_dir, 'src')
+        generate_tree(src, args.size_mb * 1_000_000)
+        size = sum(
+            os.path.getsize(os.path.join(root, f))
+            for root, _, files in os.walk(src)
+            for f in files)
+        cases = [
+            ('exec', 'zip', 1),
+            ('exec', 'zip', args.workers),
+            ('python', 'zip', 1),
+            ('python', 'zip', args.workers),
+            ('python', 'tar.zst', 1),
+            ('python', 'tar.zst', args.workers),
+            ('python', 'tar.lz4', 1),
+            ('python', 'tar.lz4', args.workers),
+        ]
+        rows = []
+        for archiver, archive_format, workers in cases:
+            try:
+                archive_time, extract_time, archive_size = bench(
+                    os.path.join(temp_dir, 'cache'),
+                    src,
+                    os.path.join(temp_dir, 'dest'),
+                    archiver,
+                    archive_format,
+                    workers)
+            except XtremCacheMissingDependencyError as e:
+                print(e)
+                continue
+            rows.append([
+                archiver,
+                archive_format,
+                workers,
+                f'{size / archive_time / 1_000_000:.1f}',
+                f'{size / extract_time / 1_000_000:.1f}',
+                f'{archive_size / size:.3f}',
+            ])
+        print(f'Input: {size / 1_000_000:.1f} MB, {os.cpu_count()} CPU(s)')
+        print(tabulate(rows, ['archiver', 'format', 'workers', 'cache MB/s', 'uncache MB/s', 'ratio']))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
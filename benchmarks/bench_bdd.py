@@ -0,0 +1,79 @@
+"""Database operations per second of concurrent processes sharing one cache.
+
+Each process runs the database part of uncache on random ids: take a reader,
+then release it, each in a single UPDATE. The default configuration is
+compared with the rollback journal without pooling used before.
+
+Usage: python benchmarks/bench_bdd.py [--processes 8] [--ops 200] [--items 20]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from xtremcache.bddmanager import BddManager
+
+
+class LegacyBddManager(BddManager):
+    """Rollback journal, full synchronous writes and a connection per transaction."""
+
+    JOURNAL_MODE = 'DELETE'
+    SYNCHRONOUS = 'FULL'
+    POOL_SIZE = 0
+
+
+def worker(bdd_class: type, db_dir: str, ops: int, items: int, seed: int) -> None:
+    bdd = bdd_class(db_dir)
+    rand = random.Random(seed)
+    for _ in range(ops):
+        id = f'item_{rand.randrange(items)}'
+        bdd.acquire_reader(id)
+        bdd.release_reader(id)
+
+
+def bench(bdd_class: type, db_dir: str, processes: int, ops: int, items: int) -> float:
+    bdd = bdd_class(db_dir)
+    for i in range(items):
+        bdd.acquire_new(f'item_{i}')
+        bdd.release_writer(f'item_{i}')
+    jobs = [
+        multiprocessing.Process(target=worker, args=(bdd_class, db_dir, ops, items, seed))
+        for seed in range(processes)]
+    start = time.perf_counter()
+    for job in jobs:
+        job.start()
+    for job in jobs:
+        job.join()
+    elapsed = time.perf_counter() - start
+    if any(job.exitcode for job in jobs):
+        raise RuntimeError('A worker process failed.')
+    return processes * ops * 2 / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=200)
+    parser.add_argument('--items', type=int, default=20)
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        rows = []
+        for name, bdd_class in [('before (rollback journal)', LegacyBddManager), ('after (WAL, pooled)', BddManager)]:
+            ops_per_sec = bench(bdd_class, os.path.join(temp_dir, name.split()[0]), args.processes, args.ops, args.items)
+            rows.append([name, args.processes, f'{ops_per_sec:.0f}'])
+        print(tabulate(rows, ['database', 'processes', 'transactions/s']))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
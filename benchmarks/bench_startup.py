@@ -0,0 +1,86 @@
+"""Wall-clock time of short xtremcache command lines, as run in a CI loop.
+
+Each run is a new interpreter uncaching a small entry from a warm cache. The
+lazy imports are compared with SQLAlchemy, PyYAML and tabulate imported up
+front as before, the import time is the one reported by -X importtime.
+
+Usage: python benchmarks/bench_startup.py [--runs 20] [--files 20]
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from xtremcache.cachemanager import CacheManager
+
+# Statements run by each interpreter before the command line.
+MODES = [
+    ('before (eager imports)', 'import sqlalchemy.orm, yaml, tabulate; '),
+    ('after (lazy imports)', ''),
+]
+
+CLI = 'import sys; from xtremcache.main import run_xtremcache; sys.exit(run_xtremcache(sys.argv[1:]))'
+
+
+def import_time(prefix: str, env: dict, cwd: str) -> float:
+    """Return the seconds taken by the imports of the command line, as reported by -X importtime."""
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'{prefix}import xtremcache.main'],
+        env=env, cwd=cwd, stderr=subprocess.PIPE, text=True, check=True)
+    # The top level imports are not indented, their cumulative time includes the nested ones.
+    top_level = re.findall(r'^import time:\s+\d+ \|\s+(\d+) \| \S', result.stderr, re.MULTILINE)
+    return sum(int(us) for us in top_level) / 1_000_000
+
+
+def bench(prefix: str, env: dict, cwd: str, dest: str, runs: int) -> float:
+    """Return the mean seconds of an uncache command line."""
+
+    start = time.perf_counter()
+    for _ in range(runs):
+        subprocess.run(
+            [sys.executable, '-c', f'{prefix}{CLI}', '--quietly', 'uncache', '--id', 'bench', dest],
+            env=env, cwd=cwd, check=True)
+    return (time.perf_counter() - start) / runs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--files', type=int, default=20)
+    args = parser.parse_args()
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(temp_dir, 'src')
+        os.makedirs(src)
+        for i in range(args.files):
+            with open(os.path.join(src, f'file_{i}.txt'), 'w') as f:
+                f.write(f'content {i}\n')
+        cache_dir = os.path.join(temp_dir, 'cache')
+        CacheManager(cache_dir, '100m').cache('bench', src)
+        env = dict(
+            os.environ,
+            PYTHONPATH=ROOT,
+            XCACHE_CACHE_DIR=cache_dir,
+            XCACHE_MAX_SIZE='100m')
+        rows = []
+        for name, prefix in MODES:
+            imports = import_time(prefix, env, temp_dir)
+            mean = bench(prefix, env, temp_dir, os.path.join(temp_dir, 'dest'), args.runs)
+            rows.append([name, f'{imports * 1000:.0f}', f'{mean * 1000:.0f}'])
+        print(tabulate(rows, ['command line', 'imports (ms)', 'uncache (ms)']))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
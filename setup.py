@@ -53,6 +53,10 @@ setup(
         'Tracker': 'https://github.com/xtrembuffalo/xtremcache/issues',
     },
     install_requires=get_install_requires(),
+    extras_require={
+        'zstd': ['zstandard>=0.18.0,<1.0.0'],
+        'lz4': ['lz4>=4.0.0,<5.0.0'],
+    },
     entry_points={
         'console_scripts': ['xtremcache=xtremcache.__main__:main']
     },
@@ -1,6 +1,10 @@
+import io
+import json
 import unittest
 import tempfile
 import yaml
+from glob import glob
+from unittest import mock
 from ddt import ddt, data
 
 from xtremcache.main import run_xtremcache
@@ -64,6 +68,176 @@ class TestXtremcache(unittest.TestCase):
         ), 0)
         self.assertTrue(dircmp(self._dir_to_uncache, self._dir_to_cache))
 
+    @data(*get_id_data())
+    def test_timeout_option(self, id):
+        self.assertEqual(self.xtremcache(
+            '--timeout', '30',
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache(
+            '--timeout', '30',
+            'uncache',
+            '--id', id,
+            self._dir_to_uncache
+        ), 0)
+        self.assertEqual(self.xtremcache('--timeout', '30', 'remove', '--id', id), 0)
+
+    @data(*get_id_data())
+    def test_uncache_workers_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache(
+            'uncache',
+            '--id', id,
+            '--workers', '2',
+            self._dir_to_uncache
+        ), 0)
+        self.assertTrue(dircmp(self._dir_to_uncache, self._dir_to_cache))
+
+    @data(*get_id_data())
+    def test_cache_base_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', 'base',
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            '--base', 'base',
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache(
+            'remove',
+            '--id', 'base'
+        ), 1)
+        self.assertEqual(self.xtremcache(
+            'uncache',
+            '--id', id,
+            self._dir_to_uncache
+        ), 0)
+        self.assertTrue(dircmp(self._dir_to_uncache, self._dir_to_cache))
+
+    @data(*get_id_data())
+    def test_ls_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache('ls'), 0)
+        self.assertEqual(self.xtremcache('ls', '--id', id), 0)
+        self.assertEqual(self.xtremcache('ls', '--id', id + '_unknown'), 1)
+
+    @data(*get_id_data())
+    def test_locks_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache('locks'), 0)
+        self.assertEqual(self.xtremcache('locks', '--id', id, '--clear'), 0)
+
+    def test_batch_command(self):
+        manifest = os.path.join(self._temp_dir, 'manifest.jsonl')
+        with open(manifest, 'w') as f:
+            f.write(json.dumps({'op': 'cache', 'id': 'a', 'path': self._dir_to_cache}) + '\n')
+            f.write(json.dumps({'op': 'cache', 'id': 'b', 'path': self._dir_to_cache}) + '\n')
+            f.write(json.dumps({'op': 'uncache', 'id': 'a', 'path': self._dir_to_uncache}) + '\n')
+            f.write(json.dumps({'op': 'remove', 'id': 'b'}) + '\n')
+        self.assertEqual(self.xtremcache('batch', manifest, '--workers', '2'), 0)
+        self.assertTrue(dircmp(self._dir_to_uncache, self._dir_to_cache))
+        with open(manifest, 'w') as f:
+            f.write(json.dumps({'op': 'remove', 'id': 'b'}) + '\n')
+            f.write('not json\n')
+        self.assertEqual(self.xtremcache('batch', manifest), 1)
+        # Read from stdin, which is left open.
+        stdin = io.StringIO(json.dumps({'op': 'remove', 'id': 'a'}) + '\n')
+        with mock.patch('sys.stdin', stdin):
+            self.assertEqual(self.xtremcache('batch'), 0)
+        self.assertFalse(stdin.closed)
+
+    @data(*get_id_data())
+    def test_reconcile_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache('reconcile'), 0)
+
+    @data(*get_id_data())
+    def test_evict_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache('evict'), 0)
+        self.assertEqual(self.xtremcache('uncache', '--id', id, self._dir_to_uncache), 0)
+        for watermark in ['high_watermark', 'low_watermark']:
+            self.assertEqual(self.xtremcache('config', 'set', watermark, '1', '--local'), 0)
+        self.assertEqual(self.xtremcache('evict'), 0)
+        self.assertEqual(self.xtremcache('uncache', '--id', id, self._dir_to_uncache), 1)
+
+    @data(*get_id_data())
+    def test_reshard_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        self.assertEqual(self.xtremcache('config', 'set', 'shard_depth', '1', '--local'), 0)
+        self.assertEqual(self.xtremcache('reshard'), 0)
+        self.assertEqual(len(glob(os.path.join(self._cache_dir, '??', '*.zip'))), 1)
+        self.assertEqual(self.xtremcache(
+            'uncache',
+            '--id', id,
+            self._dir_to_uncache
+        ), 0)
+        self.assertTrue(dircmp(self._dir_to_uncache, self._dir_to_cache))
+
+    @data(*get_id_data())
+    def test_uncache_only_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        selected = sorted(os.listdir(self._dir_to_cache))[0]
+        self.assertEqual(self.xtremcache(
+            'uncache',
+            '--id', id,
+            self._dir_to_uncache,
+            '--only', selected
+        ), 0)
+        self.assertListEqual(os.listdir(self._dir_to_uncache), [selected])
+
+    @data(*get_id_data())
+    def test_uncache_incremental_command(self, id):
+        self.assertEqual(self.xtremcache(
+            'cache',
+            '--id', id,
+            self._dir_to_cache
+        ), 0)
+        os.makedirs(self._dir_to_uncache)
+        with open(os.path.join(self._dir_to_uncache, 'extra.txt'), 'w') as f:
+            f.write('extra')
+        self.assertEqual(self.xtremcache(
+            'uncache',
+            '--id', id,
+            '--incremental',
+            '--delete',
+            self._dir_to_uncache
+        ), 0)
+        self.assertTrue(dircmp(self._dir_to_uncache, self._dir_to_cache))
+
     @data(*get_id_data())
     def test_uncache_failed_command(self, id):
         self.assertEqual(self.xtremcache(
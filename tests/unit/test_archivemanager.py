@@ -1,9 +1,11 @@
 import unittest
 import tempfile
 import os
-from ddt import ddt, data
+import zipfile
+from ddt import ddt, data, unpack
 
-from xtremcache.archivermanager import create_archiver
+from xtremcache.archivermanager import create_archiver, ARCHIVERS, ARCHIVE_FORMATS, ParallelFrameWriter
+from xtremcache.ignorematcher import IGNORE_FILE
 from tests.test_utils import *
 
 
@@ -23,6 +25,138 @@ class TestArchiver(unittest.TestCase):
         self.__archiver.extract(id, self.__dir_to_extract)
         self.assertTrue(dircmp(self.__dir_to_archive, self.__dir_to_extract))
 
+    @data(*[(w, r) for w in ARCHIVERS for r in ARCHIVERS])
+    @unpack
+    def test_engines_compatibility(self, writer, reader):
+        id = get_id_data()[0]
+        create_archiver(self.__cache_dir, writer).archive(id, self.__dir_to_archive)
+        create_archiver(self.__cache_dir, reader).extract(id, self.__dir_to_extract)
+        self.assertTrue(dircmp(self.__dir_to_archive, self.__dir_to_extract))
+
+    @data(*ARCHIVE_FORMATS)
+    def test_archive_formats(self, archive_format):
+        id = get_id_data()[0]
+        archiver = create_archiver(self.__cache_dir, archive_format=archive_format, workers=4)
+        archive_path = archiver.archive(id, self.__dir_to_archive)
+        self.assertTrue(archive_path.endswith(f'.{archive_format}'))
+        archiver.extract(id, self.__dir_to_extract)
+        self.assertTrue(dircmp(self.__dir_to_archive, self.__dir_to_extract))
+
+    @data(*ARCHIVERS)
+    def test_shard_depth(self, archiver):
+        id = get_id_data()[0]
+        archiver = create_archiver(self.__cache_dir, archiver, shard_depth=2)
+        hash = archiver.id_to_hash(id)
+        archive_path = archiver.archive(id, self.__dir_to_archive)
+        self.assertEqual(archive_path, os.path.join(self.__cache_dir, hash[:2], hash[2:4], archiver.id_to_filename(id)))
+        archiver.extract(id, self.__dir_to_extract)
+        self.assertTrue(dircmp(self.__dir_to_archive, self.__dir_to_extract))
+
+    @data(*ARCHIVE_FORMATS)
+    def test_format_detection(self, archive_format):
+        id = get_id_data()[0]
+        archive_path = create_archiver(self.__cache_dir, archive_format=archive_format).archive(id, self.__dir_to_archive)
+        for reader_format in ARCHIVE_FORMATS:
+            dir_to_extract = os.path.join(self.__dir_to_extract, reader_format)
+            create_archiver(self.__cache_dir, archive_format=reader_format).extract(id, dir_to_extract, archive_path)
+            self.assertTrue(dircmp(self.__dir_to_archive, dir_to_extract))
+
+    @data('tar.zst', 'tar.lz4')
+    def test_multi_frames(self, archive_format):
+        id = get_id_data()[0]
+        content = os.urandom(ParallelFrameWriter.CHUNK_SIZE * 2 + 1) + b'x' * ParallelFrameWriter.CHUNK_SIZE
+        with open(os.path.join(self.__dir_to_archive, 'big.bin'), 'wb') as f:
+            f.write(content)
+        archiver = create_archiver(self.__cache_dir, archive_format=archive_format, workers=3)
+        archiver.archive(id, self.__dir_to_archive)
+        archiver.extract(id, self.__dir_to_extract)
+        with open(os.path.join(self.__dir_to_extract, 'big.bin'), 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    @data(*ARCHIVERS)
+    def test_parallel_extract(self, archiver):
+        id = get_id_data()[0]
+        for i in range(50):
+            with open(os.path.join(self.__dir_to_archive, f'small_{i}.txt'), 'w') as f:
+                f.write(get_random_text(i))
+        archiver = create_archiver(self.__cache_dir, archiver, workers=1)
+        archiver.archive(id, self.__dir_to_archive)
+        archiver.extract(id, self.__dir_to_extract, workers=4)
+        self.assertTrue(dircmp(self.__dir_to_archive, self.__dir_to_extract))
+        for i in range(50):
+            with open(os.path.join(self.__dir_to_archive, f'small_{i}.txt')) as f1, \
+                    open(os.path.join(self.__dir_to_extract, f'small_{i}.txt')) as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    @data(*[(archiver, 'zip') for archiver in ARCHIVERS] + [('python', f) for f in ARCHIVE_FORMATS if f != 'zip'])
+    @unpack
+    def test_archive_manifest(self, archiver, archive_format):
+        id = get_id_data()[0]
+        manifest = []
+        create_archiver(self.__cache_dir, archiver, archive_format).archive(id, self.__dir_to_archive, manifest=manifest)
+        names = [name for _, name in walk_tree(self.__dir_to_archive)]
+        self.assertListEqual(sorted(e['path'] for e in manifest), sorted(names))
+        for entry in manifest:
+            full_path = os.path.join(self.__dir_to_archive, entry['path'])
+            if entry['kind'] == 'file':
+                self.assertEqual(entry['hash'], hash_file(full_path))
+                self.assertEqual(entry['size'], os.path.getsize(full_path))
+            else:
+                self.assertIsNone(entry['hash'])
+            self.assertEqual(entry['kind'] == 'link', os.path.islink(full_path))
+
+    @data(*[(archiver, 'zip') for archiver in ARCHIVERS] + [('python', f) for f in ARCHIVE_FORMATS if f != 'zip'])
+    @unpack
+    def test_max_size(self, archiver, archive_format):
+        id = get_id_data()[0]
+        with open(os.path.join(self.__dir_to_archive, 'big.bin'), 'wb') as f:
+            f.write(os.urandom(4 * 1024 * 1024))
+        archiver = create_archiver(self.__cache_dir, archiver, archive_format)
+        self.assertRaises(XtremCacheMaxSizeCachedError, archiver.archive, id, self.__dir_to_archive, max_size=1024 * 1024)
+        self.assertListEqual(os.listdir(self.__cache_dir), [])
+        archive_path = archiver.archive(id, self.__dir_to_archive, max_size=8 * 1024 * 1024)
+        self.assertLess(os.path.getsize(archive_path), 8 * 1024 * 1024)
+
+    @data(*[(archiver, 'zip') for archiver in ARCHIVERS] + [('python', f) for f in ARCHIVE_FORMATS if f != 'zip'])
+    @unpack
+    def test_partial_extract(self, archiver, archive_format):
+        id = get_id_data()[0]
+        archiver = create_archiver(self.__cache_dir, archiver, archive_format)
+        archiver.archive(id, self.__dir_to_archive)
+        selected = sorted(os.listdir(self.__dir_to_archive))[0]
+        archiver.extract(id, self.__dir_to_extract, include=[selected + '/'])
+        self.assertListEqual(os.listdir(self.__dir_to_extract), [selected])
+        self.assertTrue(dircmp(os.path.join(self.__dir_to_archive, selected), os.path.join(self.__dir_to_extract, selected)))
+        filesystem_remove(self.__dir_to_extract)
+        archiver.extract(id, self.__dir_to_extract, include=['*.tmp'])
+        extracted = [name for _, name in walk_tree(self.__dir_to_extract) if not os.path.isdir(os.path.join(self.__dir_to_extract, name))]
+        self.assertTrue(extracted)
+        self.assertTrue(all(name.endswith('.tmp') for name in extracted))
+
+    @data(*[(archiver, 'zip') for archiver in ARCHIVERS] + [('python', f) for f in ARCHIVE_FORMATS if f != 'zip'])
+    @unpack
+    def test_ignore_file(self, archiver, archive_format):
+        id = get_id_data()[0]
+        for name in ['.hidden', 'deep/skipped.log', 'deep/kept.log']:
+            os.makedirs(os.path.dirname(os.path.join(self.__dir_to_archive, name)), exist_ok=True)
+            with open(os.path.join(self.__dir_to_archive, name), 'w') as f:
+                f.write(name)
+        with open(os.path.join(self.__dir_to_archive, IGNORE_FILE), 'w') as f:
+            f.write('**/*.log\n!kept.log\n')
+        archiver = create_archiver(self.__cache_dir, archiver, archive_format)
+        archiver.archive(id, self.__dir_to_archive, excluded=['*.tmp'])
+        names = set(archiver.index(archiver.id_to_archive_path(id)))
+        self.assertTrue({'.hidden', IGNORE_FILE, 'deep/kept.log'} <= names)
+        self.assertFalse([n for n in names if n.endswith('.tmp') or n.endswith('skipped.log')])
+
+    def test_excluded(self):
+        id = get_id_data()[0]
+        excluded = sorted(os.listdir(self.__dir_to_archive))[0]
+        archive_path = self.__archiver.archive(id, self.__dir_to_archive, excluded=[excluded])
+        with zipfile.ZipFile(archive_path) as zf:
+            names = zf.namelist()
+        self.assertTrue(names)
+        self.assertFalse([n for n in names if n.split('/')[0] == excluded])
+
     def tearDown(self):
         filesystem_remove(self.__temp_dir)
-
@@ -1,6 +1,8 @@
 import unittest
 import tempfile
-from ddt import ddt, data
+from ddt import ddt, data, unpack
+
+from sqlalchemy import text
 
 from xtremcache.bddmanager import *
 from xtremcache.exceptions import *
@@ -61,6 +63,269 @@ class TestBddManager(unittest.TestCase):
         oldest = self.__bdd.oldest
         self.assertEqual(oldest, item_list[0])
 
+    def test_victims_skip_bases(self):
+        item_list = populate(self.__bdd)
+        for item in item_list:
+            item.readers = 0
+            self.__bdd.update(item)
+        delta = item_list[-1]
+        delta.base_id = item_list[0].id
+        self.__bdd.update(delta)
+        self.assertEqual(self.__bdd.victims('fifo')[0], item_list[1])
+        self.assertEqual(self.__bdd.victims('fifo', keep=[item_list[1].id])[0], item_list[2])
+        self.assertEqual(self.__bdd.dependents(item_list[0].id), [delta.id])
+        self.assertEqual(self.__bdd.bases(), {delta.id: item_list[0].id})
+
+    def test_wal_mode(self):
+        self.__bdd.get('wal', create=True)
+        with self.__bdd.transaction() as session:
+            self.assertEqual(session.execute(text('PRAGMA journal_mode')).scalar(), 'wal')
+        self.__bdd.checkpoint()
+        self.assertFalse(os.path.getsize(os.path.join(self.__temp_dir, 'xtremcache.db-wal')))
+
+    def test_transaction_rollback(self):
+        with self.assertRaises(XtremCacheInputError):
+            with self.__bdd.transaction(write=True):
+                self.__bdd.get('rolled_back', create=True)
+                # Nested calls join the outer transaction.
+                self.assertTrue(self.__bdd.get('rolled_back').writer)
+                raise XtremCacheInputError('rollback')
+        self.assertRaises(XtremCacheItemNotFoundError, self.__bdd.get, 'rolled_back')
+
+    def test_concurrent_transactions(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.__bdd.get('counter', create=True)
+
+        def _increment(_):
+            bdd = BddManager(self.__temp_dir)
+            for _ in range(10):
+                with bdd.transaction(write=True):
+                    item = bdd.get('counter')
+                    item.readers += 1
+                    bdd.update(item)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(_increment, range(8)))
+        self.assertEqual(self.__bdd.get('counter').readers, 80)
+
+    def test_acquire_release(self):
+        self.assertTrue(self.__bdd.acquire_new('locked'))
+        self.assertFalse(self.__bdd.acquire_new('locked'))
+        self.assertFalse(self.__bdd.acquire_reader('locked'))
+        self.__bdd.release_writer('locked', 10, 'locked.zip')
+        item = self.__bdd.get('locked')
+        self.assertEqual((item.writer, item.size, item.archive_path), (False, 10, 'locked.zip'))
+        self.assertTrue(self.__bdd.acquire_reader('locked'))
+        self.assertFalse(self.__bdd.acquire_writer('locked'))
+        self.__bdd.release_reader('locked')
+        self.assertTrue(self.__bdd.acquire_writer('locked'))
+        self.assertRaises(XtremCacheItemNotFoundError, self.__bdd.acquire_reader, 'missing')
+
+    def test_acquire_release_many(self):
+        leases = self.__bdd.acquire_new_many([('a', 'archive', None), ('b', 'archive', None), ('a', 'archive', None)])
+        self.assertTrue(leases[0] and leases[1])
+        self.assertIsNone(leases[2])
+        self.assertListEqual([lease is False for lease in self.__bdd.acquire_readers(['a', 'b'])], [True, True])
+        self.__bdd.release_writers([('a', 10, 'a.zip', leases[0]), ('b', 20, 'b.zip', leases[1])])
+        self.assertListEqual(sorted((i.size, i.archive_path, i.writer) for i in self.__bdd.items()), [(10, 'a.zip', False), (20, 'b.zip', False)])
+        leases = self.__bdd.acquire_readers(['a', 'missing'])
+        self.assertTrue(leases[0])
+        self.assertIsNone(leases[1])
+        self.assertListEqual(self.__bdd.acquire_writers(['a', 'b'])[:1], [False])
+        self.__bdd.release_readers([('a', leases[0])])
+        self.assertEqual(self.__bdd.get('a').readers, 0)
+        self.assertEqual(len(self.__bdd.leases()), 1)
+
+    def test_acquire_writer_of_base(self):
+        self.__bdd.acquire_new('base')
+        self.__bdd.release_writer('base')
+        self.__bdd.acquire_new('delta', base_id='base')
+        self.assertFalse(self.__bdd.acquire_writer('base'))
+
+    def test_concurrent_readers(self):
+        from concurrent.futures import ThreadPoolExecutor
+        self.__bdd.acquire_new('shared')
+        self.__bdd.release_writer('shared')
+
+        def _read(_):
+            bdd = BddManager(self.__temp_dir)
+            for _ in range(10):
+                self.assertTrue(bdd.acquire_reader('shared'))
+                bdd.release_reader('shared')
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(_read, range(8)))
+        self.assertEqual(self.__bdd.get('shared').readers, 0)
+
+    @data(
+        ('lru', ['small', 'hot', 'big']),
+        ('lfu', ['small', 'big', 'hot']),
+        ('fifo', ['hot', 'big', 'small']),
+        ('gdsf', ['big', 'small', 'hot']))
+    @unpack
+    def test_victims(self, policy, expected):
+        for id, size in [('hot', 10), ('big', 1000), ('small', 10)]:
+            self.__bdd.acquire_new(id)
+            self.__bdd.release_writer(id, size)
+        for id in ['hot', 'hot', 'big']:
+            self.__bdd.release_reader(id, self.__bdd.acquire_reader(id))
+        self.assertEqual((self.__bdd.get('hot').hit_count, self.__bdd.get('small').hit_count), (2, 0))
+        self.assertListEqual([i.id for i in self.__bdd.victims(policy, 3)], expected)
+        self.__bdd.acquire_reader('small')
+        self.assertNotIn('small', [i.id for i in self.__bdd.victims(policy, 3)])
+
+    def test_gdsf_aging(self):
+        for id in ['old', 'new']:
+            self.__bdd.acquire_new(id)
+            self.__bdd.release_writer(id, 10)
+        self.__bdd.release_reader('old', self.__bdd.acquire_reader('old'))
+        self.__bdd.age(100)
+        self.__bdd.release_reader('new', self.__bdd.acquire_reader('new'))
+        self.assertListEqual([i.id for i in self.__bdd.victims('gdsf', 2)], ['old', 'new'])
+
+    def test_content_size_counter(self):
+        self.assertEqual(self.__bdd.content_size, 0)
+        self.__bdd.acquire_new('archive')
+        self.__bdd.release_writer('archive', 100)
+        self.__bdd.acquire_new('cas', storage='cas')
+        self.__bdd.release_writer('cas', 1000)
+        self.__bdd.add_manifest('cas', [{'path': 'f', 'kind': 'file', 'mode': 0o644, 'mtime': 0, 'size': 10, 'hash': 'h', 'link': None}])
+        self.__bdd.add_tree('archive', 20)
+        self.assertEqual(self.__bdd.content_size, 130)
+        item = self.__bdd.get('archive')
+        item.size = 50
+        self.__bdd.update(item)
+        self.__bdd.delete_tree('archive')
+        self.assertEqual(self.__bdd.content_size, 60)
+        self.__bdd.delete_all()
+        self.assertEqual(self.__bdd.content_size, 10)
+        self.assertEqual(self.__bdd.reconcile(), 0)
+
+    def test_reconcile(self):
+        self.__bdd.acquire_new('id')
+        self.__bdd.release_writer('id', 100)
+        with self.__bdd.transaction(write=True) as session:
+            session.execute(text("UPDATE counters SET value = 7 WHERE name = 'content_size'"))
+        self.assertEqual(self.__bdd.content_size, 7)
+        self.assertEqual(self.__bdd.reconcile(), 93)
+        self.assertEqual(self.__bdd.content_size, 100)
+
+    def test_purge(self):
+        entry = lambda h: {'path': h, 'kind': 'file', 'mode': 0o644, 'mtime': 0, 'size': 10, 'hash': h, 'link': None}
+        for id, base_id in [('base', None), ('delta', 'base'), ('idle', None)]:
+            self.__bdd.acquire_new(id, base_id=base_id)
+            self.__bdd.release_writer(id, 100, f'{id}.zip')
+        for id, hashes in [('cas', ['shared', 'own']), ('other_cas', ['shared'])]:
+            self.__bdd.acquire_new(id, storage='cas')
+            self.__bdd.add_manifest(id, [entry(h) for h in hashes])
+            self.__bdd.release_writer(id, 20)
+        self.__bdd.add_tree('idle', 30)
+        reader = self.__bdd.acquire_reader('delta')
+        taken = self.__bdd.acquire_purge()
+        self.assertListEqual(sorted(id for id, *_ in taken), ['cas', 'idle', 'other_cas'])
+        self.assertEqual(dict((id, path) for id, _, path, _ in taken)['idle'], 'idle.zip')
+        self.assertFalse(self.__bdd.acquire_reader('idle'))
+        removed = []
+        self.__bdd.purge(['cas', 'idle'], removed.extend)
+        self.assertListEqual(removed, ['own'])
+        self.assertListEqual(sorted(i.id for i in self.__bdd.items()), ['base', 'delta', 'other_cas'])
+        self.assertListEqual(self.__bdd.leases('idle'), [])
+        self.assertEqual(self.__bdd.content_size, 210)
+        self.__bdd.release_reader('delta', reader)
+        self.__bdd.release_writer('other_cas')
+        self.assertEqual(len(self.__bdd.acquire_purge()), 3)
+        self.__bdd.purge(['base', 'delta', 'other_cas'], removed.extend)
+        self.assertListEqual(sorted(removed), ['own', 'shared'])
+        self.assertEqual(self.__bdd.content_size, 0)
+        self.assertEqual(self.__bdd.reconcile(), 0)
+
+    def test_reclaim_leases(self):
+        import subprocess
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        for id in ['dead', 'expired', 'alive']:
+            self.__bdd.acquire_new(id)
+            self.__bdd.release_writer(id)
+        leases = {id: self.__bdd.acquire_reader(id) for id in ['dead', 'expired', 'alive']}
+        self.assertEqual(len(self.__bdd.leases()), 3)
+        with self.__bdd.transaction(write=True) as session:
+            session.execute(text('UPDATE leases SET pid = :pid WHERE rowid = :lease'), {'pid': dead.pid, 'lease': leases['dead']})
+            session.execute(text("UPDATE leases SET expires = 0, hostname = 'other' WHERE rowid = :lease"), {'lease': leases['expired']})
+        self.assertListEqual(sorted(l.entry_id for l in self.__bdd.reclaim()), ['dead', 'expired'])
+        self.assertListEqual([l.entry_id for l in self.__bdd.leases()], ['alive'])
+        self.assertEqual(self.__bdd.get('dead').readers, 0)
+        self.assertEqual(self.__bdd.get('alive').readers, 1)
+        self.__bdd.release_reader('alive', leases['alive'])
+        self.assertListEqual(self.__bdd.leases(), [])
+
+    def test_schema_created_once(self):
+        import subprocess
+        import sys
+        self.__bdd.acquire_new('id')
+        self.__bdd.release_writer('id', 10)
+        with self.__bdd.transaction() as session:
+            versions = [v for v, in session.execute(text('SELECT version FROM schema_version ORDER BY version'))]
+        self.assertListEqual(versions, list(range(1, BddManager.SCHEMA_VERSION + 1)))
+        # The hot path of another process runs without SQLAlchemy.
+        code = (
+            'import sys; from xtremcache.bddmanager import BddManager; bdd = BddManager(sys.argv[1]); '
+            'bdd.release_reader("id", bdd.acquire_reader("id")); print(bdd.get("id").size, "sqlalchemy" in sys.modules)')
+        output = subprocess.run([sys.executable, '-c', code, self.__temp_dir], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split(), ['10', 'False'])
+
+    def test_concurrent_migrations(self):
+        import shutil
+        import sqlite3
+        import subprocess
+        import sys
+        self.__bdd.acquire_new('id')
+        self.__bdd.release_writer('id', 10)
+        self.__bdd.checkpoint()
+        # The database of the first schema version.
+        old_dir = os.path.join(self.__temp_dir, 'old')
+        os.makedirs(old_dir)
+        shutil.copy(os.path.join(self.__temp_dir, 'xtremcache.db'), old_dir)
+        connection = sqlite3.connect(os.path.join(old_dir, 'xtremcache.db'))
+        connection.execute('DROP INDEX ix_manifests_entry_id_path')
+        connection.execute('DROP INDEX ix_blobs_refcount')
+        connection.execute('CREATE INDEX ix_manifests_entry_id ON manifests (entry_id)')
+        connection.execute('DELETE FROM schema_version WHERE version > 1')
+        connection.commit()
+        connection.close()
+        code = 'import sys; from xtremcache.bddmanager import BddManager; print(BddManager(sys.argv[1]).get("id").size)'
+        processes = [
+            subprocess.Popen([sys.executable, '-c', code, old_dir], stdout=subprocess.PIPE, text=True)
+            for _ in range(4)]
+        self.assertListEqual([p.communicate()[0].strip() for p in processes], ['10'] * 4)
+        old = BddManager(old_dir)
+        with old.transaction() as session:
+            versions = [v for v, in session.execute(text('SELECT version FROM schema_version ORDER BY version'))]
+            indexes = sorted(n for n, in session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")))
+            plan = session.execute(text("EXPLAIN QUERY PLAN SELECT * FROM manifests WHERE entry_id = 'id' ORDER BY path")).all()
+        with self.__bdd.transaction() as session:
+            expected = sorted(n for n, in session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'")))
+        self.assertListEqual(versions, list(range(1, BddManager.SCHEMA_VERSION + 1)))
+        self.assertListEqual(indexes, expected)
+        self.assertNotIn('TEMP B-TREE', str(plan))
+
+    def test_upgrade_previous_database(self):
+        import sqlite3
+        with sqlite3.connect(os.path.join(self.__temp_dir, 'xtremcache.db')) as connection:
+            connection.execute(
+                'CREATE TABLE items (id VARCHAR NOT NULL, size INTEGER NOT NULL, readers INTEGER NOT NULL, '
+                'writer BOOLEAN NOT NULL, archive_path VARCHAR NOT NULL, created_date DATETIME, PRIMARY KEY (id))')
+            connection.execute("INSERT INTO items VALUES ('old', 10, 0, 0, 'old.zip', '2022-01-01 00:00:00.000000')")
+        item = self.__bdd.get('old')
+        self.assertEqual(item.size, 10)
+        self.assertEqual(item.storage, 'archive')
+        self.assertEqual(item.hit_count, 0)
+        self.assertEqual(self.__bdd.victims('lfu'), [item])
+        with self.__bdd.transaction() as session:
+            indexes = [r[0] for r in session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))]
+        self.assertIn('ix_items_hit_count_last_access', indexes)
+        self.assertIn('ix_manifests_entry_id_path', indexes)
+        self.assertEqual(self.__bdd.content_size, 10)
+
     def tearDown(self):
         filesystem_remove(self.__temp_dir)
 
@@ -0,0 +1,58 @@
+import unittest
+import tempfile
+import os
+from glob import glob
+from ddt import ddt, data
+
+from xtremcache.bddmanager import BddManager
+from xtremcache.blobmanager import BlobManager
+from tests.test_utils import *
+
+
+def get_blobs(cache_dir):
+    return glob(os.path.join(cache_dir, 'blobs', '*', '*'))
+
+
+@ddt
+class TestBlobManager(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        self.__cache_dir = os.path.join(self.__temp_dir, 'data')
+        self.__dir_to_cache = os.path.join(self.__temp_dir, 'dir_to_cache')
+        self.__dir_to_uncache = os.path.join(self.__temp_dir, 'dir_to_uncache')
+        self.__bdd = BddManager(self.__cache_dir)
+        self.__blobs = BlobManager(self.__cache_dir, self.__bdd)
+        generate_dir_to_cache(self.__dir_to_cache)
+
+    @data(*get_id_data())
+    def test_cache_uncache(self, id):
+        self.__blobs.cache(id, self.__dir_to_cache)
+        self.__blobs.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_cache, self.__dir_to_uncache))
+
+    def test_deduplication(self):
+        first_size = self.__blobs.cache('first', self.__dir_to_cache)
+        blobs = get_blobs(self.__cache_dir)
+        self.assertGreater(first_size, 0)
+        self.assertEqual(self.__blobs.cache('second', self.__dir_to_cache), 0)
+        self.assertEqual(self.__bdd.unique_size('first'), 0)
+        self.assertListEqual(get_blobs(self.__cache_dir), blobs)
+        with open(os.path.join(self.__dir_to_cache, 'new.txt'), 'w') as f:
+            f.write(get_random_text(100))
+        self.assertEqual(self.__blobs.cache('third', self.__dir_to_cache), 100)
+        self.assertEqual(len(get_blobs(self.__cache_dir)), len(blobs) + 1)
+
+    def test_reference_counting(self):
+        self.__blobs.cache('first', self.__dir_to_cache)
+        blobs = get_blobs(self.__cache_dir)
+        self.__blobs.cache('second', self.__dir_to_cache)
+        self.__blobs.remove('first')
+        self.assertListEqual(get_blobs(self.__cache_dir), blobs)
+        self.__blobs.uncache('second', self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_cache, self.__dir_to_uncache))
+        self.__blobs.remove('second')
+        self.assertListEqual(get_blobs(self.__cache_dir), [])
+        self.assertEqual(self.__bdd.content_size, 0)
+
+    def tearDown(self):
+        filesystem_remove(self.__temp_dir)
@@ -1,13 +1,17 @@
 import unittest
 import tempfile
 import os
+import time
 from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from pathlib import Path
-from ddt import ddt, data
+from unittest import mock
+from ddt import ddt, data, unpack
 
 from xtremcache.cachemanager import CacheManager, BddManager
-from xtremcache.archivermanager import create_archiver
+from xtremcache.archivermanager import create_archiver, shard_path
+from xtremcache.configuration import ConfigurationLevel
+from xtremcache.lockmanager import LockManager
 from tests.test_utils import *
 
 
@@ -31,6 +35,171 @@ class TestCacheDir(unittest.TestCase):
         self.__cache_manager.uncache(id, self.__dir_to_uncache)
         self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
 
+    @data(*get_id_data())
+    def test_uncache_workers(self, id):
+        self.__cache_manager.cache(id, self.__dir_to_cache)
+        self.__cache_manager.uncache(id, self.__dir_to_uncache, workers=3)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+
+    @data({'archiver': 'python'}, {'archiver': 'exec'}, {'archive_format': 'tar.zst'}, {'storage': 'cas'})
+    def test_uncache_over_read_only_files(self, settings):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, workers=1, **settings)
+        cache_manager.cache(id, self.__dir_to_cache)
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        kept_dir = os.path.join(self._temp_dir, 'kept')
+        os.makedirs(kept_dir)
+        kept = {}
+        for full_path, name in walk_tree(self.__dir_to_uncache):
+            if os.path.isfile(full_path) and not os.path.islink(full_path):
+                os.chmod(full_path, 0o444)
+                kept[full_path] = os.path.join(kept_dir, str(len(kept)))
+                os.link(full_path, kept[full_path])
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+        # Replaced rather than written through, which a read only file doesn't allow but for root.
+        for full_path, kept_path in kept.items():
+            self.assertNotEqual(os.stat(full_path).st_ino, os.stat(kept_path).st_ino)
+
+    @data({}, {'archive_format': 'tar.zst'}, {'tree_store': 'clone'}, {'tree_store': 'hardlink'}, {'storage': 'cas'})
+    def test_uncache_destination_error(self, settings):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, **settings)
+        cache_manager.cache(id, self.__dir_to_cache)
+        name = sorted(name for full_path, name in walk_tree(self.__dir_to_cache) if os.path.isfile(full_path) and not os.path.islink(full_path))[0]
+        os.makedirs(os.path.join(self.__dir_to_uncache, name, 'in_the_way'))
+        self.assertRaises(OSError, cache_manager.uncache, id, self.__dir_to_uncache)
+        # The archive is not at fault, the entry is kept.
+        filesystem_remove(self.__dir_to_uncache)
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+
+    @data('tar.zst', 'tar.lz4')
+    def test_cache_archive_format(self, archive_format):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, archive_format=archive_format)
+        cache_manager.cache(id, self.__dir_to_cache)
+        self.assertTrue(BddManager(self.__cache_dir).get(id).archive_path.endswith(archive_format))
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+
+    @data(*get_id_data())
+    def test_cache_cas_storage(self, id):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, storage='cas')
+        cache_manager.cache(id, self.__dir_to_cache)
+        cache_manager.cache(id + '_copy', self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        self.assertEqual(bdd_manager.get(id).storage, 'cas')
+        self.assertEqual(bdd_manager.get(id + '_copy').size, 0)
+        cache_manager.remove(id)
+        cache_manager.uncache(id + '_copy', self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+        cache_manager.remove()
+        self.assertEqual(bdd_manager.content_size, 0)
+
+    @data('clone', 'hardlink')
+    def test_cache_tree_store(self, tree_store):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, tree_store=tree_store)
+        cache_manager.cache(id, self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        archive_size = bdd_manager.content_size
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+        self.assertGreater(bdd_manager.content_size, archive_size)
+        other_dir = os.path.join(self._temp_dir, 'other_dir_to_uncache')
+        cache_manager.uncache(id, other_dir)
+        self.assertTrue(dircmp(other_dir, self.__dir_to_cache))
+        cache_manager.remove(id)
+        self.assertEqual(os.listdir(os.path.join(self.__cache_dir, 'trees')), [])
+        self.assertEqual(bdd_manager.content_size, 0)
+
+    @data('archive', 'cas')
+    def test_manifest(self, storage):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, storage=storage)
+        cache_manager.cache(id, self.__dir_to_cache)
+        manifest = cache_manager.manifest(id)
+        self.assertListEqual([e['path'] for e in manifest], sorted(name for _, name in walk_tree(self.__dir_to_cache)))
+        for entry in manifest:
+            if entry['kind'] == 'file':
+                self.assertEqual(entry['hash'], hash_file(os.path.join(self.__dir_to_cache, entry['path'])))
+        cache_manager.remove(id)
+        self.assertListEqual(BddManager(self.__cache_dir).manifest(id), [])
+
+    def test_archive_manifest_keeps_blobs(self):
+        id = get_id_data()[0]
+        CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, storage='cas').cache(id, self.__dir_to_cache)
+        self.__cache_manager.cache(id + '_archive', self.__dir_to_cache)
+        self.__cache_manager.remove(id + '_archive')
+        self.__cache_manager.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+
+    @data({}, {'storage': 'cas'}, {'tree_store': 'clone'})
+    def test_partial_uncache(self, settings):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, **settings)
+        cache_manager.cache(id, self.__dir_to_cache)
+        selected = sorted(os.listdir(self.__dir_to_cache))[-1]
+        for _ in range(2):
+            cache_manager.uncache(id, self.__dir_to_uncache, include=[selected])
+            self.assertListEqual(os.listdir(self.__dir_to_uncache), [selected])
+            self.assertTrue(dircmp(os.path.join(self.__dir_to_uncache, selected), os.path.join(self.__dir_to_cache, selected)))
+            cache_manager.uncache(id, os.path.join(self._temp_dir, 'full'))
+            filesystem_remove(self.__dir_to_uncache)
+
+    @data({}, {'archive_format': 'tar.zst'}, {'storage': 'cas'}, {'tree_store': 'clone'})
+    def test_incremental_uncache(self, settings):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, **settings)
+        cache_manager.cache(id, self.__dir_to_cache)
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        cache_manager.uncache(id, self.__dir_to_uncache, incremental=True)
+        files = sorted(glob(os.path.join(self.__dir_to_uncache, '*', '*', '*.tmp')))
+        ctimes = {f: os.stat(f).st_ctime_ns for f in files}
+        with open(files[0], 'r+') as f:
+            f.write('x')
+        os.remove(files[1])
+        filesystem_remove(files[2])
+        os.makedirs(files[2])
+        with open(os.path.join(self.__dir_to_uncache, 'extra.txt'), 'w') as f:
+            f.write('extra')
+        cache_manager.uncache(id, self.__dir_to_uncache, incremental=True, delete=True)
+        self.assertEqual(read_tree(self.__dir_to_uncache), read_tree(self.__dir_to_cache))
+        for f in files[3:]:
+            self.assertEqual(os.stat(f).st_ctime_ns, ctimes[f])
+
+    def test_incremental_uncache_hardlink(self):
+        id = get_id_data()[0]
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, tree_store='hardlink')
+        cache_manager.cache(id, self.__dir_to_cache)
+        cache_manager.uncache(id, os.path.join(self._temp_dir, 'first'))
+        for _ in range(2):
+            cache_manager.uncache(id, self.__dir_to_uncache, incremental=True)
+        self.assertEqual(read_tree(self.__dir_to_uncache), read_tree(self.__dir_to_cache))
+        # Shared with the destinations, the files of the tree stay read only.
+        for full_path, _ in walk_tree(os.path.join(self.__cache_dir, 'trees'), ignore_file=None):
+            if os.path.isfile(full_path) and not os.path.islink(full_path):
+                self.assertFalse(os.stat(full_path).st_mode & 0o222)
+
+    def test_incremental_uncache_keeps_extra(self):
+        id = get_id_data()[0]
+        self.__cache_manager.cache(id, self.__dir_to_cache)
+        os.makedirs(self.__dir_to_uncache)
+        extra = os.path.join(self.__dir_to_uncache, 'extra.txt')
+        Path(extra).write_text('extra')
+        self.__cache_manager.uncache(id, self.__dir_to_uncache, incremental=True)
+        self.assertTrue(os.path.exists(extra))
+        os.remove(extra)
+        self.assertEqual(read_tree(self.__dir_to_uncache), read_tree(self.__dir_to_cache))
+
+    @data(*get_id_data())
+    def test_read_previous_format(self, id):
+        self.__cache_manager.cache(id, self.__dir_to_cache)
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, archive_format='tar.zst')
+        cache_manager.uncache(id, self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
+
     @data(*get_id_data())
     def test_cache_non_existing_dir(self, id):
         self.assertRaises(XtremCacheItemNotFoundError, self.__cache_manager.uncache, id, self.__dir_to_uncache)
@@ -88,6 +257,66 @@ class TestCacheGlobal(unittest.TestCase):
         self.__cache_manager.uncache(id, self.__dir_to_uncache)
         self.assertTrue(dircmp(self.__dir_to_uncache, self.__dir_to_cache))
 
+    def test_many(self):
+        ids = [f'id{i}' for i in range(6)]
+        errors = self.__cache_manager.cache_many(
+            [{'id': id, 'path': self.__dir_to_cache} for id in ids] + [{'id': 'id0', 'path': self.__dir_to_cache}], workers=3)
+        self.assertListEqual(errors[:-1], [None] * 6)
+        self.assertIsInstance(errors[-1], XtremCacheAlreadyCachedError)
+        errors = self.__cache_manager.uncache_many(
+            [{'id': id, 'path': os.path.join(self.__dir_to_uncache, id)} for id in ids + ['missing']], workers=3)
+        self.assertListEqual(errors[:-1], [None] * 6)
+        self.assertIsInstance(errors[-1], XtremCacheItemNotFoundError)
+        for id in ids:
+            self.assertTrue(dircmp(os.path.join(self.__dir_to_uncache, id), self.__dir_to_cache))
+        self.__cache_manager.cache('delta', self.__dir_to_cache, base_id='id0')
+        errors = self.__cache_manager.remove_many([{'id': id} for id in ids + ['delta', 'missing']])
+        self.assertListEqual(errors[:-1], [None] * 7)
+        self.assertIsInstance(errors[-1], XtremCacheItemNotFoundError)
+        self.assertListEqual(BddManager(self.__cache_dir).items(), [])
+
+    def test_many_transactions(self):
+        writes = []
+        connect = BddManager._BddManager__connect
+
+        def _connect(bdd_manager):
+            connection = connect(bdd_manager)
+            connection.set_trace_callback(lambda statement: writes.append(statement) if statement == 'BEGIN IMMEDIATE' else None)
+            return connection
+
+        ids = [f'id{i}' for i in range(20)]
+        with mock.patch.object(BddManager, '_BddManager__connect', _connect):
+            cache_manager = CacheManager(os.path.join(self._temp_dir, 'counted'), DEFAULT_TESTS_MAX_SIZE_STR)
+            runs = [
+                lambda: cache_manager.cache_many([{'id': id, 'path': self.__dir_to_cache} for id in ids], workers=3),
+                lambda: cache_manager.uncache_many([{'id': id, 'path': os.path.join(self.__dir_to_uncache, id)} for id in ids], workers=3),
+                lambda: cache_manager.remove_many([{'id': id} for id in ids])
+            ]
+            for run in runs:
+                writes.clear()
+                self.assertListEqual(run(), [None] * len(ids))
+                # A few write transactions for the whole chunk, instead of a few by entry.
+                self.assertLess(len(writes), 6)
+        self.assertListEqual(BddManager(os.path.join(self._temp_dir, 'counted')).items(), [])
+
+    def test_set_values(self):
+        cwd = os.getcwd()
+        # The local file level is the config.yml of the working dir.
+        os.chdir(self._temp_dir)
+        try:
+            cache_manager = CacheManager(self.__cache_dir)
+            cache_manager.set_max_size('5m', ConfigurationLevel.LOCAL_FILE.value)
+            self.assertEqual(cache_manager.max_size, 5_000_000)
+            other_dir = os.path.join(self._temp_dir, 'other')
+            cache_manager = CacheManager()
+            cache_manager.set_cache_dir(other_dir, ConfigurationLevel.LOCAL_FILE.value)
+            self.assertEqual(cache_manager.cache_dir, other_dir)
+            cache_manager.set_setting('archive_format', 'tar.zst', ConfigurationLevel.LOCAL_FILE.value)
+            cache_manager.cache('id', self.__dir_to_cache)
+            self.assertTrue(BddManager(other_dir).get('id').archive_path.endswith('tar.zst'))
+        finally:
+            os.chdir(cwd)
+
     @data(*get_id_data())
     def test_timeout(self, id):
         self.__cache_manager.cache(id, self.__dir_to_cache)
@@ -128,6 +357,23 @@ class TestCacheGlobal(unittest.TestCase):
         filter  = os.path.join(self.__cache_dir, f'*.{create_archiver(self.__cache_dir).ext}')
         self.assertListEqual(glob(filter), [])
 
+    def test_purge(self):
+        for id in ['base', 'idle']:
+            self.__cache_manager.cache(id, self.__dir_to_cache)
+        self.__cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        bdd_manager = BddManager(self.__cache_dir)
+        reader = bdd_manager.acquire_reader('delta')
+        # The base of a busy delta is pinned.
+        self.assertListEqual(self.__cache_manager.purge(workers=2), ['base', 'delta'])
+        self.assertRaises(XtremCacheItemNotFoundError, bdd_manager.get, 'idle')
+        self.assertListEqual(
+            sorted(os.path.basename(p) for p in glob(os.path.join(self.__cache_dir, f'*.{create_archiver(self.__cache_dir).ext}'))),
+            sorted(bdd_manager.get(id).archive_path for id in ['base', 'delta']))
+        bdd_manager.release_reader('delta', reader)
+        self.assertListEqual(self.__cache_manager.purge(), [])
+        self.assertListEqual(bdd_manager.items(), [])
+        self.assertEqual(bdd_manager.content_size, 0)
+
     @data(*get_id_data())
     def test_remove(self, id):
         laps = 4
@@ -188,6 +434,217 @@ class TestCacheConcurrent(unittest.TestCase):
             with ThreadPoolExecutor() as executor:
                 executor.submit(exec_cache, self.__cache_dir, self.__dir_to_cache, id, index)
 
+    @unittest.skipUnless(is_unix(), 'fcntl is only available on Unix')
+    def test_wait_for_writer(self):
+        import threading
+        import time
+        from xtremcache.lockmanager import LockManager
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('id', self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        held = threading.Event()
+
+        def _write():
+            with LockManager(self.__cache_dir).lock('id', True):
+                bdd_manager.acquire_writer('id')
+                held.set()
+                time.sleep(0.3)
+                bdd_manager.release_writer('id')
+
+        thread = threading.Thread(target=_write)
+        thread.start()
+        held.wait()
+        start_time = time.time()
+        cache_manager.uncache('id', os.path.join(self._temp_dir, 'dir_to_uncache'))
+        thread.join()
+        # Woken up by the release, not by the database polling.
+        self.assertLess(time.time() - start_time, 0.3 + CacheManager._DELAY_TIME)
+
+    @data('reader', 'writer')
+    def test_dead_lease_holder(self, kind):
+        import subprocess
+        import time
+        from sqlalchemy import text
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('id', self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        lease = bdd_manager.acquire_reader('id') if kind == 'reader' else bdd_manager.acquire_writer('id')
+        dead = subprocess.Popen(['true'])
+        dead.wait()
+        with bdd_manager.transaction(write=True) as session:
+            session.execute(text('UPDATE leases SET pid = :pid WHERE rowid = :lease'), {'pid': dead.pid, 'lease': lease})
+        start_time = time.time()
+        cache_manager.cache('id', self.__dir_to_cache, force=True, timeout=5)
+        self.assertLess(time.time() - start_time, 5)
+        dir_to_uncache = os.path.join(self._temp_dir, 'dir_to_uncache')
+        cache_manager.uncache('id', dir_to_uncache, timeout=5)
+        self.assertTrue(dircmp(dir_to_uncache, self.__dir_to_cache))
+        self.assertListEqual(bdd_manager.leases(), [])
+
+    def tearDown(self):
+        filesystem_remove(self._temp_dir)
+
+def read_tree(root):
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                tree[os.path.relpath(path, root)] = os.readlink(path)
+            elif os.path.isfile(path):
+                tree[os.path.relpath(path, root)] = Path(path).read_bytes()
+            else:
+                tree[os.path.relpath(path, root)] = None
+    return tree
+
+
+@ddt
+class TestCacheDelta(unittest.TestCase):
+    def setUp(self):
+        self._temp_dir = tempfile.mkdtemp()
+        self.__cache_dir = os.path.join(self._temp_dir, 'data')
+        self.__dir_to_cache = os.path.join(self._temp_dir, 'dir_to_cache')
+        generate_dir_to_cache(self.__dir_to_cache)
+        self.__dir_to_uncache = os.path.join(self._temp_dir, 'dir_to_uncache')
+
+    def __update_dir_to_cache(self):
+        files = sorted(glob(os.path.join(self.__dir_to_cache, '*', '*', '*.tmp')))
+        with open(files[0], 'a') as f:
+            f.write('changed')
+        os.remove(files[1])
+        os.makedirs(files[2] + '_dir')
+        filesystem_remove(files[3])
+        os.makedirs(files[3])
+        filesystem_remove(os.path.dirname(files[-1]))
+        with open(os.path.join(self.__dir_to_cache, 'added.txt'), 'w') as f:
+            f.write(get_random_text(100))
+
+    @data(('python', 'zip'), ('exec', 'zip'), ('python', 'tar.zst'), ('python', 'tar.lz4'))
+    @unpack
+    def test_cache_delta(self, archiver, archive_format):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, archiver=archiver, archive_format=archive_format)
+        cache_manager.cache('base', self.__dir_to_cache)
+        self.__update_dir_to_cache()
+        cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        self.__update_dir_to_cache()
+        cache_manager.cache('delta_of_delta', self.__dir_to_cache, base_id='delta')
+        bdd_manager = BddManager(self.__cache_dir)
+        self.assertLess(bdd_manager.get('delta').size, bdd_manager.get('base').size)
+        os.makedirs(self.__dir_to_uncache)
+        cache_manager.uncache('delta_of_delta', self.__dir_to_uncache)
+        self.assertEqual(read_tree(self.__dir_to_uncache), read_tree(self.__dir_to_cache))
+
+    def test_delta_manifest(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('base', self.__dir_to_cache)
+        self.__update_dir_to_cache()
+        cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        self.assertListEqual(
+            [e['path'] for e in cache_manager.manifest('delta')],
+            sorted(name for _, name in walk_tree(self.__dir_to_cache)))
+
+    def test_partial_delta_uncache(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('base', self.__dir_to_cache)
+        self.__update_dir_to_cache()
+        cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        selected = sorted(os.listdir(self.__dir_to_cache))[0]
+        os.makedirs(self.__dir_to_uncache)
+        cache_manager.uncache('delta', self.__dir_to_uncache, include=[selected])
+        self.assertEqual(
+            read_tree(os.path.join(self.__dir_to_uncache, selected)),
+            read_tree(os.path.join(self.__dir_to_cache, selected)))
+        self.assertListEqual(os.listdir(self.__dir_to_uncache), [selected])
+
+    def test_cache_unchanged_delta(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, archiver='exec')
+        cache_manager.cache('base', self.__dir_to_cache)
+        cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        cache_manager.uncache('delta', self.__dir_to_uncache)
+        self.assertEqual(read_tree(self.__dir_to_uncache), read_tree(self.__dir_to_cache))
+
+    def test_base_pinned(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('base', self.__dir_to_cache)
+        cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        self.assertRaises(XtremCacheBaseInUseError, cache_manager.remove, 'base')
+        self.assertRaises(XtremCacheBaseInUseError, cache_manager.cache, 'base', self.__dir_to_cache, force=True)
+        cache_manager.remove()
+        self.assertEqual(BddManager(self.__cache_dir).content_size, 0)
+
+    def test_reshard(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('base', self.__dir_to_cache)
+        self.__update_dir_to_cache()
+        cache_manager.cache('delta', self.__dir_to_cache, base_id='base')
+        cache_manager.cache('other', self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        flat = {id: bdd_manager.get(id).archive_path for id in ['base', 'delta', 'other']}
+        in_cache = lambda path: os.path.isfile(os.path.join(self.__cache_dir, path))
+        # The base is also read with its delta.
+        lease = bdd_manager.acquire_reader('delta')
+        sharded = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, shard_depth=2)
+        self.assertEqual(sharded.reshard(timeout=1), 3)
+        for id, path in flat.items():
+            self.assertEqual(bdd_manager.get(id).archive_path, os.path.join(path[:2], path[2:4], path))
+            self.assertTrue(in_cache(bdd_manager.get(id).archive_path))
+        self.assertTrue(in_cache(flat['base']))
+        self.assertTrue(in_cache(flat['delta']))
+        self.assertFalse(in_cache(flat['other']))
+        bdd_manager.release_reader('delta', lease)
+        self.assertEqual(sharded.reshard(), 0)
+        self.assertFalse(any(in_cache(path) for path in flat.values()))
+        sharded.uncache('delta', self.__dir_to_uncache)
+        self.assertEqual(read_tree(self.__dir_to_uncache), read_tree(self.__dir_to_cache))
+        sharded.cache('new', self.__dir_to_cache)
+        self.assertEqual(os.path.dirname(bdd_manager.get('new').archive_path).count(os.sep), 1)
+        # Back to the flat layout.
+        self.assertEqual(cache_manager.reshard(), 4)
+        self.assertEqual(bdd_manager.get('other').archive_path, flat['other'])
+        self.assertTrue(all(in_cache(path) for path in flat.values()))
+        cache_manager.remove()
+        self.assertEqual(BddManager(self.__cache_dir).content_size, 0)
+
+    def test_reshard_missing_archive(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('missing', self.__dir_to_cache)
+        cache_manager.cache('other', self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        archive_path = bdd_manager.get('missing').archive_path
+        os.remove(os.path.join(self.__cache_dir, archive_path))
+        with self.assertLogs(level='WARNING') as logs:
+            self.assertEqual(CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, shard_depth=1).reshard(), 1)
+        self.assertIn(f'{os.path.join(self.__cache_dir, archive_path)} is missing', logs.output[0])
+        self.assertEqual(bdd_manager.get('missing').archive_path, archive_path)
+        self.assertFalse(os.path.exists(os.path.join(self.__cache_dir, shard_path(os.path.basename(archive_path), 1))))
+        self.assertEqual(bdd_manager.get('other').archive_path.count(os.sep), 1)
+
+    def test_reshard_concurrent(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        cache_manager.cache('idle', self.__dir_to_cache)
+        cache_manager.cache('written', self.__dir_to_cache)
+        link = os.link
+        writes = []
+
+        def _link(src, dst):
+            # The database is not locked by the reshard meanwhile.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                writes.append(executor.submit(BddManager(self.__cache_dir).record_wait, 'idle', 'reader', 1).result(timeout=5))
+            link(src, dst)
+
+        # Written by another process, it is left to the next reshard.
+        with LockManager(self.__cache_dir).lock('written', True), mock.patch('os.link', _link):
+            self.assertEqual(CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, shard_depth=1).reshard(), 1)
+        self.assertEqual(len(writes), 1)
+        bdd_manager = BddManager(self.__cache_dir)
+        self.assertEqual(bdd_manager.get('idle').archive_path.count(os.sep), 1)
+        self.assertEqual(bdd_manager.get('written').archive_path.count(os.sep), 0)
+
+    def test_unknown_base(self):
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        self.assertRaises(XtremCacheItemNotFoundError, cache_manager.cache, 'delta', self.__dir_to_cache, base_id='base')
+        self.assertRaises(XtremCacheItemNotFoundError, BddManager(self.__cache_dir).get, 'delta')
+
     def tearDown(self):
         filesystem_remove(self._temp_dir)
 
@@ -210,6 +667,7 @@ class TestCacheCleanning(unittest.TestCase):
                         total_size += os.path.getsize(fp)
             return total_size
 
+        self.__grow()
         cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
         cache_manager.cache(id, self.__dir_to_cache)
         bdd_manager = BddManager(self.__cache_dir)
@@ -220,5 +678,125 @@ class TestCacheCleanning(unittest.TestCase):
             cache_manager.cache(f'{id}{i}', self.__dir_to_cache)
             self.assertLessEqual(get_dir_size(self.__cache_dir), max_size)
 
+    @data(('lru', 'cold'), ('lfu', 'cold'), ('fifo', 'hot'))
+    @unpack
+    def test_eviction_policy(self, policy, evicted):
+        self.__grow()
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, eviction=policy)
+        cache_manager.cache('hot', self.__dir_to_cache)
+        cache_manager.cache('cold', self.__dir_to_cache)
+        cache_manager.uncache('hot', os.path.join(self._temp_dir, 'out'))
+        bdd_manager = BddManager(self.__cache_dir)
+        bdd_manager.checkpoint()
+        max_size = bdd_manager.content_size * 3 // 2 + bdd_manager.size
+        cache_manager = CacheManager(self.__cache_dir, max_size, eviction=policy, low_watermark=100)
+        cache_manager.cache('new', self.__dir_to_cache)
+        ids = [i.id for i in bdd_manager.items()]
+        self.assertNotIn(evicted, ids)
+        self.assertIn('new', ids)
+        self.assertEqual(len(ids), 2)
+
+    def __grow(self) -> None:
+        """Make the ids big enough for the WAL left by an operation not to change how many of them fit."""
+
+        with open(os.path.join(self.__dir_to_cache, 'big.bin'), 'wb') as f:
+            f.write(os.urandom(1_000_000))
+
+    def __fill(self, count: int) -> tuple:
+        """Cache count ids, return a max_size exceeded by one more and a low watermark 1.5 ids below it."""
+
+        self.__grow()
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR)
+        for i in range(count):
+            cache_manager.cache(f'id{i}', self.__dir_to_cache)
+        bdd_manager = BddManager(self.__cache_dir)
+        bdd_manager.checkpoint()
+        item_size = bdd_manager.content_size // count
+        max_size = bdd_manager.content_size + bdd_manager.size + item_size // 2
+        return max_size, (max_size - item_size * 3 // 2) * 100 // max_size
+
+    def __usage(self) -> int:
+        bdd_manager = BddManager(self.__cache_dir)
+        bdd_manager.checkpoint()
+        return bdd_manager.content_size + bdd_manager.size
+
+    def test_watermarks(self):
+        max_size, low_watermark = self.__fill(4)
+        cache_manager = CacheManager(self.__cache_dir, max_size, low_watermark=low_watermark)
+        cache_manager.cache('id4', self.__dir_to_cache)
+        self.assertLess(self.__usage(), max_size * low_watermark // 100)
+        self.assertListEqual([i.id for i in BddManager(self.__cache_dir).items()], ['id3', 'id4'])
+
+    def test_min_free_space(self):
+        self.__fill(2)
+        cache_manager = CacheManager(self.__cache_dir, DEFAULT_TESTS_MAX_SIZE_STR, min_free_space=10**18)
+        cache_manager.cache('new', self.__dir_to_cache)
+        self.assertListEqual([i.id for i in BddManager(self.__cache_dir).items()], ['new'])
+
+    @data(('archive', 0), ('archive', 6), ('cas', 6))
+    @unpack
+    def test_too_big(self, storage, compression_level):
+        with open(os.path.join(self.__dir_to_cache, 'big.bin'), 'wb') as f:
+            f.write(os.urandom(4_000_000))
+        cache_manager = CacheManager(self.__cache_dir, '3m', storage=storage)
+        self.assertRaises(
+            XtremCacheMaxSizeCachedError,
+            cache_manager.cache, 'big', self.__dir_to_cache, compression_level=compression_level)
+        bdd_manager = BddManager(self.__cache_dir)
+        self.assertListEqual(bdd_manager.items(), [])
+        self.assertEqual(bdd_manager.content_size, 0)
+        self.assertListEqual([f for f in os.listdir(self.__cache_dir) if f.endswith('.zip') or f.endswith('.tmp')], [])
+
+    def test_compressed_reserve(self):
+        compressible = os.path.join(self._temp_dir, 'compressible')
+        os.makedirs(compressible)
+        zeros = os.path.join(compressible, 'zeros.bin')
+        with open(zeros, 'wb') as f:
+            f.write(bytes(1_000_000))
+        with open(os.path.join(self.__dir_to_cache, 'random.bin'), 'wb') as f:
+            f.write(os.urandom(1_000_000))
+        cache_manager = CacheManager(self.__cache_dir, '3m')
+        cache_manager.cache('id0', compressible)
+        cache_manager.cache('id1', self.__dir_to_cache)
+        with open(zeros, 'wb') as f:
+            f.write(bytes(1_900_000))
+        # Its input doesn't fit next to the others, its archive does without evicting anything.
+        cache_manager.cache('id2', compressible)
+        self.assertListEqual(sorted(i.id for i in BddManager(self.__cache_dir).items()), ['id0', 'id1', 'id2'])
+
+    def test_eviction_skips_busy(self):
+        max_size, low_watermark = self.__fill(3)
+        cache_manager = CacheManager(self.__cache_dir, max_size, low_watermark=low_watermark)
+        # The least recently used id is written by another process.
+        with LockManager(self.__cache_dir).lock('id0', True):
+            start = time.time()
+            cache_manager.cache('new', self.__dir_to_cache, timeout=5)
+            self.assertLess(time.time() - start, 2)
+        ids = [i.id for i in BddManager(self.__cache_dir).items()]
+        self.assertIn('id0', ids)
+        self.assertNotIn('id1', ids)
+        self.assertIn('new', ids)
+
+    def test_background_eviction(self):
+        max_size, low_watermark = self.__fill(4)
+        cache_manager = CacheManager(self.__cache_dir, max_size, eviction_mode='background', low_watermark=low_watermark)
+        cache_manager.cache('id4', self.__dir_to_cache)
+        cache_manager.wait_eviction()
+        self.assertLess(self.__usage(), max_size * low_watermark // 100)
+        self.assertListEqual([i.id for i in BddManager(self.__cache_dir).items()], ['id3', 'id4'])
+
+    def test_detached_eviction(self):
+        max_size, low_watermark = self.__fill(4)
+        cache_manager = CacheManager(
+            self.__cache_dir, max_size, detach_eviction=True, eviction_mode='background', low_watermark=low_watermark)
+        cache_manager.cache('id4', self.__dir_to_cache)
+        # Evicted by another process, which the cache call doesn't wait for.
+        bdd_manager = BddManager(self.__cache_dir)
+        deadline = time.time() + 30
+        while len(bdd_manager.items()) > 2 and time.time() < deadline:
+            time.sleep(0.1)
+        with LockManager(self.__cache_dir).eviction_lock():
+            self.assertListEqual([i.id for i in bdd_manager.items()], ['id3', 'id4'])
+
     def tearDown(self):
         filesystem_remove(self._temp_dir)
@@ -1,10 +1,14 @@
 import os
 import unittest
+import unittest.mock
 
 import yaml
 
-from xtremcache.configuration import (Configuration, ConfigurationManager,
-                                      FileConfiguration, RuntimeConfiguration)
+from xtremcache.configuration import (SETTINGS, Configuration,
+                                      ConfigurationManager,
+                                      ConfigurationSnapshot, FileConfiguration,
+                                      RuntimeConfiguration)
+from xtremcache.exceptions import XtremCacheInputError
 
 HARD_CODED_MAX_SIZE = 50_000_000_000
 
@@ -95,6 +99,19 @@ class TestFileConfiguration(unittest.TestCase):
         self.assertTrue(self.ftc.is_set_max_size)
         self.assertEqual(self.ftc.max_size, TEST_MAX_SIZE_INT)
 
+    def test_parsed_once(self):
+        create_config_file(TEST_CONFIG_FILE_PATH, TEST_CACHE_DIR_PATH, TEST_MAX_SIZE_STR)
+        self.assertEqual(self.ftc.max_size, TEST_MAX_SIZE_INT)
+        with unittest.mock.patch('yaml.safe_load') as safe_load:
+            self.assertEqual(self.ftc.cache_dir, TEST_CACHE_DIR_PATH)
+            self.assertEqual(self.ftc.max_size, TEST_MAX_SIZE_INT)
+            safe_load.assert_not_called()
+        # Modified by another process.
+        create_config_file(TEST_CONFIG_FILE_PATH, TEST_CACHE_DIR_PATH, TEST_MAX_SIZE_STR_2)
+        stat = os.stat(TEST_CONFIG_FILE_PATH)
+        os.utime(TEST_CONFIG_FILE_PATH, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        self.assertEqual(self.ftc.max_size, TEST_MAX_SIZE_INT_2)
+
 
 class TestConfiguration(unittest.TestCase):
     def test_strategy_priority(self):
@@ -118,3 +135,55 @@ class TestConfiguration(unittest.TestCase):
         cfg.set_max_size(TEST_MAX_SIZE_STR_2, TEST_FILE_CONFIG_ID)
         self.assertEqual(cfg.max_size, TEST_MAX_SIZE_INT_2)
 
+    def test_setting_default(self):
+        cfg = ConfigurationManager([EmptyConfiguration('test id')])
+        self.assertEqual(cfg.get('archiver'), SETTINGS['archiver'].default)
+
+    def test_setting_runtime(self):
+        cfg = ConfigurationManager([get_FileTestConfiguration()], archiver='exec')
+        self.assertEqual(cfg.get('archiver'), 'exec')
+
+    def test_workers_setting(self):
+        self.assertEqual(ConfigurationManager([], workers='3').get('workers'), 3)
+        self.assertRaises(XtremCacheInputError, ConfigurationManager([], workers='0').get, 'workers')
+        self.assertRaises(XtremCacheInputError, ConfigurationManager([], workers='many').get, 'workers')
+
+    def test_eviction_settings(self):
+        self.assertEqual(ConfigurationManager([], low_watermark='75').get('low_watermark'), 75)
+        self.assertRaises(XtremCacheInputError, ConfigurationManager([], high_watermark='101').get, 'high_watermark')
+        self.assertEqual(ConfigurationManager([], min_free_space='10g').get('min_free_space'), 10_000_000_000)
+        self.assertRaises(XtremCacheInputError, ConfigurationManager([], min_free_space='lots').get, 'min_free_space')
+
+    def test_set_setting(self):
+        cfg = ConfigurationManager([get_FileTestConfiguration()])
+        self.assertRaises(XtremCacheInputError, cfg.set, 'archiver', 'rar', TEST_FILE_CONFIG_ID)
+        cfg.set('archiver', 'exec', TEST_FILE_CONFIG_ID)
+        self.assertEqual(cfg.get('archiver'), 'exec')
+        os.remove(TEST_CONFIG_FILE_PATH)
+
+    def test_snapshot(self):
+        self.assertTupleEqual(ConfigurationSnapshot._fields, ('cache_dir', 'max_size', *SETTINGS))
+        cfg = ConfigurationManager([get_DummyConfiguration1()], workers='3', eviction='LFU')
+        snapshot = cfg.snapshot
+        self.assertEqual(snapshot.max_size, TEST_MAX_SIZE_INT)
+        self.assertEqual(snapshot.workers, 3)
+        self.assertEqual(snapshot.eviction, 'lfu')
+        self.assertEqual(snapshot.archiver, SETTINGS['archiver'].default)
+        self.assertIs(cfg.snapshot, snapshot)
+        self.assertRaises(AttributeError, setattr, snapshot, 'workers', 4)
+
+    def test_snapshot_invalidation(self):
+        cfg = ConfigurationManager([get_FileTestConfiguration()])
+        snapshot = cfg.snapshot
+        self.assertEqual(snapshot.archiver, SETTINGS['archiver'].default)
+        cfg.set('archiver', 'exec', TEST_FILE_CONFIG_ID)
+        self.assertEqual(cfg.snapshot.archiver, 'exec')
+        # The snapshots already taken are not modified.
+        self.assertEqual(snapshot.archiver, SETTINGS['archiver'].default)
+        # Modified by another process.
+        create_config_file(TEST_CONFIG_FILE_PATH, TEST_CACHE_DIR_PATH, TEST_MAX_SIZE_STR_2)
+        stat = os.stat(TEST_CONFIG_FILE_PATH)
+        os.utime(TEST_CONFIG_FILE_PATH, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000))
+        self.assertEqual(cfg.snapshot.max_size, TEST_MAX_SIZE_INT_2)
+        self.assertEqual(cfg.snapshot.archiver, SETTINGS['archiver'].default)
+        os.remove(TEST_CONFIG_FILE_PATH)
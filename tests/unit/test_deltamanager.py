@@ -0,0 +1,40 @@
+import unittest
+import tempfile
+import os
+from ddt import ddt, data
+
+from xtremcache.archivermanager import create_archiver, ARCHIVE_FORMATS
+from xtremcache.bddmanager import BddManager
+from xtremcache.deltamanager import DeltaManager
+from tests.test_utils import *
+
+
+@ddt
+class TestDeltaManager(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        self.__cache_dir = os.path.join(self.__temp_dir, 'data')
+        self.__dir_to_cache = os.path.join(self.__temp_dir, 'dir_to_cache')
+        os.makedirs(os.path.join(self.__dir_to_cache, 'dir'))
+        for name in ['same.txt', 'changed.txt', 'deleted.txt', 'dir/kind.txt']:
+            with open(os.path.join(self.__dir_to_cache, name), 'w') as f:
+                f.write(name)
+
+    @data(*ARCHIVE_FORMATS)
+    def test_diff(self, archive_format):
+        archiver = create_archiver(self.__cache_dir, archive_format=archive_format)
+        archive_path = archiver.archive('base', self.__dir_to_cache)
+        deltas = DeltaManager(self.__cache_dir, BddManager(self.__cache_dir), archiver)
+        with open(os.path.join(self.__dir_to_cache, 'changed.txt'), 'w') as f:
+            f.write('CHANGED.TXT')
+        os.remove(os.path.join(self.__dir_to_cache, 'deleted.txt'))
+        os.remove(os.path.join(self.__dir_to_cache, 'dir/kind.txt'))
+        os.makedirs(os.path.join(self.__dir_to_cache, 'dir/kind.txt'))
+        with open(os.path.join(self.__dir_to_cache, 'added.txt'), 'w') as f:
+            f.write('added.txt')
+        changed, deleted = deltas.diff(archiver.index(archive_path), self.__dir_to_cache)
+        self.assertListEqual(sorted(changed), ['added.txt', 'changed.txt', 'dir/kind.txt'])
+        self.assertListEqual(sorted(deleted), ['deleted.txt', 'dir/kind.txt'])
+
+    def tearDown(self):
+        filesystem_remove(self.__temp_dir)
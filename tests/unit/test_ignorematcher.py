@@ -0,0 +1,68 @@
+import unittest
+import tempfile
+import os
+from ddt import ddt, data, unpack
+
+from xtremcache.ignorematcher import IgnoreMatcher, IGNORE_FILE
+from tests.test_utils import *
+
+
+@ddt
+class TestIgnoreMatcher(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        for name in ['.hidden', 'a.o', 'keep.o', 'src/b.o', 'src/main.c', 'build/out', 'src/build/out', 'node_modules/x/y.js', 'logs/debug/today.log']:
+            full_path = os.path.join(self.__temp_dir, name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            with open(full_path, 'w') as f:
+                f.write(name)
+
+    @data(
+        (['*.o'], 'src/b.o', False, True),
+        (['*.o', '!keep.o'], 'keep.o', False, False),
+        (['/build'], 'src/build', True, False),
+        (['build/'], 'src/build', True, True),
+        (['build/'], 'build', False, False),
+        (['src/*.c'], 'src/main.c', False, True),
+        (['src/*.c'], 'lib/src/main.c', False, False),
+        (['**/debug/*.log'], 'logs/debug/today.log', False, True),
+        (['logs/**'], 'logs/debug/today.log', False, True),
+        (['logs/**'], 'logs', True, False),
+        (['a/**/b'], 'a/b', True, True),
+        (['a/**/b'], 'a/x/y/b', True, True),
+        (['# comment', ''], '# comment', False, False),
+        (['\\#file'], '#file', False, True),
+        (['file[0-9]'], 'file7', False, True),
+        (['file[!0-9]'], 'file7', False, False))
+    @unpack
+    def test_excluded(self, patterns, name, is_dir, excluded):
+        self.assertEqual(IgnoreMatcher(patterns).excluded(name, is_dir), excluded)
+
+    @data(
+        ('build', 'build', True),
+        ('build', 'src/build', False),
+        ('src/b.o', 'src/b.o', True))
+    @unpack
+    def test_from_paths(self, excl, name, excluded):
+        self.assertEqual(IgnoreMatcher.from_paths([excl]).excluded(name, True), excluded)
+
+    def test_walk_tree(self):
+        with open(os.path.join(self.__temp_dir, IGNORE_FILE), 'w') as f:
+            f.write('*.o\n!keep.o\nnode_modules/\n')
+        names = [name for _, name in walk_tree(self.__temp_dir, ['logs'])]
+        self.assertListEqual(names, [
+            '.hidden', IGNORE_FILE, 'build', 'build/out', 'keep.o',
+            'src', 'src/build', 'src/build/out', 'src/main.c'])
+        names = [name for _, name in walk_tree(self.__temp_dir, ignore_file=None)]
+        self.assertIn('node_modules/x/y.js', names)
+
+    def test_walk_tree_prunes_excluded_dirs(self):
+        os.chmod(os.path.join(self.__temp_dir, 'node_modules'), 0)
+        try:
+            names = [name for _, name in walk_tree(self.__temp_dir, ['node_modules/'])]
+        finally:
+            os.chmod(os.path.join(self.__temp_dir, 'node_modules'), 0o755)
+        self.assertNotIn('node_modules', names)
+
+    def tearDown(self):
+        filesystem_remove(self.__temp_dir)
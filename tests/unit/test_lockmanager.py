@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import threading
+import time
+import multiprocessing
+
+from xtremcache.lockmanager import LockManager
+from tests.test_utils import *
+
+
+def stress(cache_dir: str, exclusive: bool, hold: float, duration: float, waits) -> None:
+    """Lock the same Item in a loop during duration seconds, put the seconds waited each time in waits."""
+
+    locks = LockManager(cache_dir)
+    measured = []
+    end_time = time.time() + duration
+    while time.time() < end_time:
+        with locks.lock('hot', exclusive) as waited:
+            measured.append(waited)
+            time.sleep(hold)
+    waits.put((exclusive, measured))
+
+
+@unittest.skipUnless(is_unix(), 'fcntl is only available on Unix')
+class TestLockManager(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        self.__locks = LockManager(self.__temp_dir)
+
+    def __hold(self, id: str, exclusive: bool, duration: float) -> threading.Thread:
+        """Hold the lock of id during duration seconds in another thread, return once it is held."""
+
+        held = threading.Event()
+
+        def _hold():
+            with LockManager(self.__temp_dir).lock(id, exclusive):
+                held.set()
+                time.sleep(duration)
+
+        thread = threading.Thread(target=_hold)
+        thread.start()
+        held.wait()
+        return thread
+
+    def test_wake_up_on_release(self):
+        thread = self.__hold('id', True, 0.3)
+        start_time = time.time()
+        with self.__locks.lock('id', timeout=5):
+            waited = time.time() - start_time
+        thread.join()
+        self.assertGreaterEqual(waited, 0.2)
+        self.assertLess(waited, 1)
+
+    def test_timeout(self):
+        thread = self.__hold('id', True, 1)
+        start_time = time.time()
+        with self.assertRaises(FunctionRecallAsked):
+            with self.__locks.lock('id', timeout=0.2):
+                pass
+        self.assertGreaterEqual(time.time() - start_time, 0.2)
+        thread.join()
+        # The lock acquired by the abandoned waiter is released.
+        with self.__locks.lock('id', True, timeout=1):
+            pass
+
+    def test_shared(self):
+        thread = self.__hold('id', False, 0.5)
+        with self.__locks.lock('id', timeout=0):
+            pass
+        with self.assertRaises(FunctionRecallAsked):
+            with self.__locks.lock('id', True, timeout=0):
+                pass
+        thread.join()
+
+    def test_reentrant(self):
+        with self.__locks.lock('id', True, timeout=0):
+            with self.__locks.lock('id', True, timeout=0):
+                pass
+            with self.__locks.lock('id', timeout=0):
+                pass
+        with self.__locks.lock('other', True, timeout=0):
+            pass
+
+    def test_fairness_stress(self):
+        # Overlapping readers would never leave an unfair exclusive lock free.
+        waits = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(target=stress, args=(self.__temp_dir, exclusive, 0.02, 2, waits))
+            for exclusive in [False] * 4 + [True] * 2]
+        for process in processes:
+            process.start()
+        results = [waits.get(timeout=30) for _ in processes]
+        for process in processes:
+            process.join()
+        for exclusive in [False, True]:
+            measured = sorted(w for e, m in results if e == exclusive for w in m)
+            self.assertTrue(all(m for e, m in results if e == exclusive))
+            p99 = measured[int(len(measured) * 0.99)]
+            self.assertLess(p99, 1)
+
+    def tearDown(self):
+        filesystem_remove(self.__temp_dir)
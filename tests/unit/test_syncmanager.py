@@ -0,0 +1,48 @@
+import unittest
+import tempfile
+import os
+from ddt import ddt, data
+
+from xtremcache.archivermanager import ArchiveMember
+from xtremcache.syncmanager import SyncManager
+from tests.test_utils import *
+
+
+@ddt
+class TestSyncManager(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.__temp_dir, 'dir'))
+        self.__members = {'dir': ArchiveMember('dir', 0o755, 0, 0)}
+        for name in ['same.txt', 'touched.txt', 'changed.txt', 'dir/kind.txt']:
+            full_path = os.path.join(self.__temp_dir, name)
+            with open(full_path, 'w') as f:
+                f.write(name)
+            st = os.stat(full_path)
+            self.__members[name] = ArchiveMember('file', st.st_mode & 0o7777, st.st_size, st.st_mtime, hash=hash_file(full_path))
+        self.__members['missing.txt'] = ArchiveMember('file', 0o644, 1, 0, hash='0')
+
+    @data(1, 4)
+    def test_stale(self, workers):
+        touched = os.path.join(self.__temp_dir, 'touched.txt')
+        os.utime(touched, (0, 0))
+        with open(os.path.join(self.__temp_dir, 'changed.txt'), 'w') as f:
+            f.write('CHANGED.TXT')
+        filesystem_remove(os.path.join(self.__temp_dir, 'dir/kind.txt'))
+        os.makedirs(os.path.join(self.__temp_dir, 'dir/kind.txt'))
+        sync = SyncManager(workers)
+        stale = sync.stale(self.__members, self.__temp_dir, include_filter())
+        self.assertSetEqual(stale, {'changed.txt', 'dir/kind.txt', 'missing.txt'})
+        self.assertAlmostEqual(os.stat(touched).st_mtime, self.__members['touched.txt'].mtime, delta=SyncManager.MTIME_EPSILON)
+        self.assertFalse(os.path.exists(os.path.join(self.__temp_dir, 'dir/kind.txt')))
+
+    def test_extra(self):
+        os.makedirs(os.path.join(self.__temp_dir, 'extra_dir/sub'))
+        with open(os.path.join(self.__temp_dir, 'dir/extra.txt'), 'w') as f:
+            f.write('extra')
+        sync = SyncManager()
+        self.assertListEqual(sync.extra(self.__members, self.__temp_dir, include_filter()), ['dir/extra.txt', 'extra_dir'])
+        self.assertListEqual(sync.extra(self.__members, self.__temp_dir, include_filter(['dir'])), ['dir/extra.txt'])
+
+    def tearDown(self):
+        filesystem_remove(self.__temp_dir)
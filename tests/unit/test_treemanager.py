@@ -0,0 +1,69 @@
+import unittest
+import tempfile
+import os
+import shutil
+import stat
+from ddt import ddt, data
+
+from xtremcache.bddmanager import BddManager
+from xtremcache.treemanager import FileCloner, TreeManager
+from tests.test_utils import *
+
+
+@ddt
+class TestTreeManager(unittest.TestCase):
+    def setUp(self):
+        self.__temp_dir = tempfile.mkdtemp()
+        self.__cache_dir = os.path.join(self.__temp_dir, 'data')
+        self.__dir_to_cache = os.path.join(self.__temp_dir, 'dir_to_cache')
+        self.__dir_to_uncache = os.path.join(self.__temp_dir, 'dir_to_uncache')
+        self.__bdd = BddManager(self.__cache_dir)
+        generate_dir_to_cache(self.__dir_to_cache)
+
+    def __copy_tree(self, path):
+        shutil.copytree(self.__dir_to_cache, path, symlinks=True, dirs_exist_ok=True)
+
+    @data(False, True)
+    def test_materialize_uncache(self, hardlink):
+        trees = TreeManager(self.__cache_dir, self.__bdd, hardlink)
+        self.assertFalse(trees.exists('id'))
+        trees.materialize('id', self.__copy_tree)
+        self.assertTrue(trees.exists('id'))
+        self.assertGreater(self.__bdd.content_size, 0)
+        trees.uncache('id', self.__dir_to_uncache)
+        self.assertTrue(dircmp(self.__dir_to_cache, self.__dir_to_uncache))
+        trees.remove('id')
+        self.assertFalse(trees.exists('id'))
+        self.assertEqual(self.__bdd.content_size, 0)
+
+    def test_hardlink_shares_read_only_files(self):
+        trees = TreeManager(self.__cache_dir, self.__bdd, hardlink=True)
+        trees.materialize('id', self.__copy_tree)
+        trees.uncache('id', self.__dir_to_uncache)
+        file = next(os.path.join(r, f) for r, _, files in os.walk(self.__dir_to_uncache) for f in files)
+        st = os.stat(file)
+        self.assertGreater(st.st_nlink, 1)
+        self.assertFalse(st.st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    def test_failed_materialize(self):
+        def _fail(path):
+            raise OSError('extraction failed')
+        trees = TreeManager(self.__cache_dir, self.__bdd)
+        with self.assertRaises(XtremCacheArchiveExtractionError):
+            trees.materialize('id', _fail)
+        self.assertFalse(trees.exists('id'))
+        self.assertEqual(os.listdir(os.path.join(self.__cache_dir, 'trees')), [])
+
+    def test_clone_fallback(self):
+        src = os.path.join(self.__temp_dir, 'src')
+        with open(src, 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024 + 7))
+        cloner = FileCloner()
+        for i in range(2):
+            dst = os.path.join(self.__temp_dir, f'dst{i}')
+            self.assertFalse(cloner.clone(src, dst))
+            with open(src, 'rb') as f1, open(dst, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+    def tearDown(self):
+        filesystem_remove(self.__temp_dir)
@@ -1,32 +1,42 @@
 from abc import abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import io
 import os
+import stat
 import subprocess
-from glob import glob
-from typing import List
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+from typing import BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Set, Tuple
 
 from xtremcache.utils import *
 
 
-# Cache / Uncache
-class ArchiveManager():
-    """Create an archive from id."""
+class ArchiveMember(NamedTuple):
+    """File, dir or symlink stored in an archive."""
 
-    def __init__(self, cache_dir: str) -> None:
-        self._cache_dir = cache_dir
+    kind: str
+    mode: int
+    size: int
+    mtime: float
+    crc: int = None
+    link: str = None
+    hash: str = None
 
-    @property
-    @abstractmethod
-    def zip_exec(self) -> str:
-        """Path to the zip exe."""
 
-        pass
+# Cache / Uncache
+class ArchiveManager():
+    """Create an archive from id.
 
-    @property
-    @abstractmethod
-    def unzip_exec(self) -> str:
-        """Path to the unzip exe."""
+    Interface of all archivers, the engine and the format are choosen with create_archiver."""
 
-        pass
+    def __init__(self, cache_dir: str, workers: int = 1, shard_depth: int = 0) -> None:
+        self._cache_dir = cache_dir
+        self._workers = workers
+        self._shard_depth = shard_depth
 
     @property
     def ext(self) -> str:
@@ -42,118 +52,773 @@ class ArchiveManager():
     def id_to_filename(self, id: str) -> str:
         """Convert archive id into the archive file name."""
 
-        return f'{self.id_to_hash(id)}.zip'
+        return f'{self.id_to_hash(id)}.{self.ext}'
 
     def id_to_archive_path(self, id: str) -> str:
-        """Convert archive id into the archive path."""
+        """Convert archive id into the archive path, nested in shard_depth levels of hash prefix dirs."""
 
-        return os.path.join(self._cache_dir, self.id_to_filename(id))
+        return os.path.join(self._cache_dir, shard_path(self.id_to_filename(id), self._shard_depth))
 
+    @abstractmethod
     def archive(
             self,
             id: str,
             src_path: str,
             compression_level: int = 6,
-            excluded: List[str] = []) -> str:
+            excluded: List[str] = [],
+            members: List[str] = None,
+            manifest: List[Dict] = None,
+            max_size: int = None) -> str:
+        """Archive the dir or file at the given path with the given id.
+
+        With members, only the entries with these names are archived.
+        With manifest, the manifest entries of the archived members
+        (see utils.manifest_entry) are appended to this list.
+        With max_size, the archiving is aborted with XtremCacheMaxSizeCachedError
+        as soon as the archive grows past this size in bytes."""
+
+        pass
+
+    def index(self, archive_path: str) -> Dict[str, ArchiveMember]:
+        """Return the members of the given archive by name."""
+
+        ext = archive_format(archive_path)
+        if ext != self.ext:
+            return create_archiver(self._cache_dir, archive_format=ext).index(archive_path)
+        try:
+            return self._index(archive_path)
+        except Exception as e:
+            raise XtremCacheArchiveExtractionError(archive_path, e)
+
+    @abstractmethod
+    def _index(self, archive_path: str) -> Dict[str, ArchiveMember]:
+        """Read the members of the given archive."""
+
+        pass
+
+    def extract(
+            self,
+            id: str,
+            path: str,
+            archive_path: str = None,
+            workers: int = None,
+            include: List[str] = None,
+            members: Set[str] = None) -> None:
+        """Extract the id's archive at the given path.
+
+        The format is detected from the archive_path extension, so archives
+        created with another format than the configured one can still be read.
+        workers overrides the number of extraction threads of the archiver.
+        With include and members, only the members selected by these globs
+        and names are extracted (see utils.include_filter).
+        Only the errors reading the archive raise XtremCacheArchiveExtractionError,
+        the OSError raised writing the destination are raised unchanged."""
+
+        archive_path = archive_path or self.id_to_archive_path(id)
+        workers = workers or self._workers
+        ext = archive_format(archive_path)
+        if ext != self.ext:
+            return create_archiver(self._cache_dir, archive_format=ext, workers=workers).extract(
+                id, path, archive_path, include=include, members=members)
+        try:
+            os.makedirs(path, exist_ok=True)
+            included = include_filter(include, members) if include or members is not None else None
+            self._extract(archive_path, path, workers, included)
+        except OSError as e:
+            if e.filename != archive_path:
+                # The destination can't be written, the archive is not at fault.
+                raise e
+            raise XtremCacheArchiveExtractionError(path, e)
+        except Exception as e:
+            raise XtremCacheArchiveExtractionError(path, e)
+
+    @abstractmethod
+    def _extract(self, archive_path: str, path: str, workers: int, included: Callable[[str], bool] = None) -> None:
+        """Extract the archive at the given existing path with the given number of threads.
+
+        With included, only the members whose name is accepted by this predicate are extracted."""
+
+        pass
+
+
+class ExecArchiver(ArchiveManager):
+    """Zip archive format handled by the external zip and unzip executables."""
+
+    # Exit code of unzip when it can't write a file (disk full, permission denied...).
+    UNZIP_WRITE_ERROR = 50
+
+    # Seconds between two checks of the size of the archive being written.
+    POLL_TIME = 0.1
+
+    @property
+    @abstractmethod
+    def zip_exec(self) -> str:
+        """Path to the zip exe."""
+
+        pass
+
+    @property
+    @abstractmethod
+    def unzip_exec(self) -> str:
+        """Path to the unzip exe."""
+
+        pass
+
+    def archive(
+            self,
+            id: str,
+            src_path: str,
+            compression_level: int = 6,
+            excluded: List[str] = [],
+            members: List[str] = None,
+            manifest: List[Dict] = None,
+            max_size: int = None) -> str:
         """Archive the dir or file at the given path with the given id."""
 
         dest_path = self.id_to_archive_path(id)
         if not os.path.exists(src_path):
             raise XtremCacheFileNotFoundError(src_path)
+        if members is not None:
+            dest_path = self.__archive_members(id, src_path, compression_level, members, max_size)
+        else:
+            dest_path = self.__archive_tree(id, src_path, compression_level, excluded, max_size)
+        if manifest is not None:
+            try:
+                manifest += self.__scan(src_path, excluded, members)
+            except Exception as e:
+                raise XtremCacheArchiveCreationError(id, e)
+        return dest_path
+
+    @staticmethod
+    def __scan(src_path: str, excluded: List[str], members: List[str]) -> List[Dict]:
+        """Return the manifest entries of the archived members, files are read again to be hashed."""
+
+        entries = []
+        members = set(members) if members is not None else None
+        for full_path, name in walk_tree(src_path, excluded):
+            if members is not None and name not in members:
+                continue
+            entry = manifest_entry(full_path, name, os.lstat(full_path))
+            if entry is None:
+                continue
+            if entry['kind'] == 'file':
+                entry['hash'] = hash_file(full_path)
+            entries.append(entry)
+        return entries
+
+    def __archive_tree(self, id: str, src_path: str, compression_level: int, excluded: List[str], max_size: int = None) -> str:
+        """Archive the whole file or dir, but the excluded paths.
+
+        The tree is walked here rather than by zip -r, the excluded dirs are
+        then never read and the ignore file is applied."""
+
+        try:
+            members = [name for _, name in walk_tree(src_path, excluded)]
+        except Exception as e:
+            raise XtremCacheArchiveCreationError(id, e)
+        return self.__archive_members(id, src_path, compression_level, members, max_size)
+
+    def __archive_members(self, id: str, src_path: str, compression_level: int, members: List[str], max_size: int = None) -> str:
+        """Archive only the given members, their names are given to zip on stdin.
+
+        zip writes the archive in a temporary dir, with max_size its size is
+        polled there and zip is killed once it is exceeded."""
+
+        if not members:
+            # zip refuses to create an empty archive.
+            return ZipArchiver(self._cache_dir, shard_depth=self._shard_depth).archive(id, src_path, compression_level, members=members)
+        dest_path = self.id_to_archive_path(id)
+        tmp_dir = None
         try:
             os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-            exclude_args = []
-            for excl in excluded:
-                exclude_args += [
-                    '-x', rf"{excl}"
-                    if os.path.isfile(os.path.join(src_path, excl))
-                    else rf"'{excl}/*'"
-                ]
-            src_is_dir = os.path.isdir(src_path)
-            inputs = glob(os.path.join(src_path, '*')) if src_is_dir else glob(src_path)
-            inputs = list(map(lambda p: os.path.relpath(p, src_path), inputs))
-            subprocess.run([
+            if os.path.exists(dest_path):
+                os.remove(dest_path)
+            tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(dest_path), prefix=f'{self.id_to_hash(id)}.', suffix='.tmp')
+            process = subprocess.Popen([
                     self.zip_exec,
                     f'-{compression_level}',
                     '-y',
                     '-q',
-                    '-r',
-                    '-FS',
+                    '-b', tmp_dir,
+                    '-@',
                     dest_path
-                ] + inputs + exclude_args,
-                cwd=src_path if src_is_dir else os.path.dirname(src_path),
-                check=True)
+                ],
+                stdin=subprocess.PIPE,
+                cwd=tree_root(src_path))
+            process.stdin.write('\n'.join(members).encode())
+            process.stdin.close()
+            while True:
+                try:
+                    returncode = process.wait(self.POLL_TIME if max_size is not None else None)
+                    break
+                except subprocess.TimeoutExpired:
+                    if sum(e.stat().st_size for e in os.scandir(tmp_dir)) > max_size:
+                        process.kill()
+                        process.wait()
+                        raise XtremCacheMaxSizeCachedError(id)
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, self.zip_exec)
+            if max_size is not None and os.path.getsize(dest_path) > max_size:
+                # Written between two polls.
+                os.remove(dest_path)
+                raise XtremCacheMaxSizeCachedError(id)
+        except XtremCacheMaxSizeCachedError as e:
+            raise e
         except Exception as e:
             raise XtremCacheArchiveCreationError(id, e)
+        finally:
+            if tmp_dir:
+                filesystem_remove(tmp_dir)
         return dest_path
 
-    def extract(self, id: str, path: str) -> None:
-        """Extract the id's archive at the given path."""
-
-        archive_path = self.id_to_archive_path(id)
-        try:
-            os.makedirs(path, exist_ok=True)
-            subprocess.run([
-                    self.unzip_exec,
-                    '-qq',
-                    '-u',
-                    '-o',
-                    archive_path,
-                    '-d',
-                    path
-                ],
-                check=True)
-            pass
-        except Exception as e:
-            raise XtremCacheArchiveExtractionError(path, e)
-
-
-class WinArchiver(ArchiveManager):
+    def _index(self, archive_path: str) -> Dict[str, ArchiveMember]:
+        return ZipArchiver(self._cache_dir)._index(archive_path)
+
+    def _extract(self, archive_path: str, path: str, workers: int, included: Callable[[str], bool] = None) -> None:
+        if workers > 1 or included:
+            # unzip is single threaded and can't seek to the selected members from
+            # their names, the archives are the same as the in process ones.
+            return ZipArchiver(self._cache_dir, workers)._extract(archive_path, path, workers, included)
+        with zipfile.ZipFile(archive_path) as zf:
+            if not zf.infolist():
+                # unzip fails on an empty archive (as the one of an unchanged delta).
+                return
+        returncode = subprocess.run([
+                self.unzip_exec,
+                '-qq',
+                '-o',
+                archive_path,
+                '-d',
+                path
+            ]).returncode
+        if returncode == self.UNZIP_WRITE_ERROR:
+            raise OSError(f'{self.unzip_exec} could not write in {path}')
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, self.unzip_exec)
+
+
+class WinArchiver(ExecArchiver):
     """Zip archive format."""
 
     UNZIP_VERSION = 'v6.00'
     ZIP_VERSION = 'v3.0'
 
-    def __init__(self, cache_dir: str) -> None:
-        super().__init__(cache_dir)
+    def __init__(self, cache_dir: str, workers: int = 1, shard_depth: int = 0) -> None:
+        super().__init__(cache_dir, workers, shard_depth)
 
     @property
-    @abstractmethod
     def zip_exec(self) -> str:
         """Path to the zip exe."""
 
         return os.path.join(xtremcache_location(), 'ext', 'msys2', 'zip', self.ZIP_VERSION, 'bin', 'zip')
 
     @property
-    @abstractmethod
     def unzip_exec(self) -> str:
         """Path to the unzip exe."""
 
         return os.path.join(xtremcache_location(), 'ext', 'msys2', 'unzip', self.UNZIP_VERSION, 'bin', 'unzip')
 
 
-class LnxArchiver(ArchiveManager):
+class LnxArchiver(ExecArchiver):
     """Gztar archive format."""
 
-    def __init__(self, cache_dir: str) -> None:
-        super().__init__(cache_dir)
+    def __init__(self, cache_dir: str, workers: int = 1, shard_depth: int = 0) -> None:
+        super().__init__(cache_dir, workers, shard_depth)
 
     @property
-    @abstractmethod
     def zip_exec(self) -> str:
         """Path to the zip exe."""
 
         return 'zip'
 
     @property
-    @abstractmethod
     def unzip_exec(self) -> str:
         """Path to the unzip exe."""
 
         return 'unzip'
 
 
-def create_archiver(cache_dir: str) -> ArchiveManager:
-    """Factory of archvier depending of the os."""
+class StreamArchiver(ArchiveManager):
+    """Archive formats handled in process.
+
+    Archives are written in a temporary file renamed at the end, through
+    large buffers reused for every member of every archive (one per thread,
+    several archives can be handled at once)."""
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir: str, workers: int = 1, shard_depth: int = 0) -> None:
+        super().__init__(cache_dir, workers, shard_depth)
+        self.__local = threading.local()
+
+    @property
+    def _buffer(self) -> memoryview:
+        """I/O buffer of the current thread reused for every member of every archive."""
+
+        if getattr(self.__local, 'buffer', None) is None:
+            self.__local.buffer = memoryview(bytearray(self.BUFFER_SIZE))
+        return self.__local.buffer
+
+    def _copy(self, src, dst, buffer: memoryview = None, hasher: 'hashlib._Hash' = None) -> None:
+        """Copy the src file object into the dst one through the given or the shared buffer."""
+
+        buffer = buffer or self._buffer
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            dst.write(buffer[:n])
+            if hasher:
+                hasher.update(buffer[:n])
+
+    def archive(
+            self,
+            id: str,
+            src_path: str,
+            compression_level: int = 6,
+            excluded: List[str] = [],
+            members: List[str] = None,
+            manifest: List[Dict] = None,
+            max_size: int = None) -> str:
+        """Archive the dir or file at the given path with the given id.
+
+        The manifest entries are built while the members are written, so the
+        files are read once."""
+
+        dest_path = self.id_to_archive_path(id)
+        if not os.path.exists(src_path):
+            raise XtremCacheFileNotFoundError(src_path)
+        entries = walk_tree(src_path, excluded)
+        if members is not None:
+            members = set(members)
+            entries = (e for e in entries if e[1] in members)
+        tmp_path = None
+        guard = None
+        try:
+            os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(dest_path),
+                prefix=f'{self.id_to_hash(id)}.',
+                suffix='.tmp')
+            with open(fd, 'wb', buffering=self.BUFFER_SIZE) as f:
+                if max_size is not None:
+                    f = guard = SizeGuard(f, max_size)
+                written = []
+                self._write(f, entries, compression_level, written if manifest is not None else None)
+            os.replace(tmp_path, dest_path)
+            if manifest is not None:
+                manifest += written
+        except Exception as e:
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if guard and guard.exceeded:
+                # The writers may fail differently while being closed.
+                raise XtremCacheMaxSizeCachedError(id)
+            raise XtremCacheArchiveCreationError(id, e)
+        return dest_path
+
+    @abstractmethod
+    def _write(self, f: BinaryIO, entries: Iterator[Tuple[str, str]], compression_level: int, manifest: List[Dict] = None) -> None:
+        """Write the archive of the given (absolute path, member name) entries in f.
+
+        With manifest, the manifest entry of each written member is appended to it."""
+
+        pass
+
+
+class ZipArchiver(StreamArchiver):
+    """Zip archive format handled in process by zipfile.
+
+    Archives are the same as the ones of zip -y (symlinks are stored as links,
+    unix modes are kept), so both engines can read each other's archives."""
+
+    @staticmethod
+    def _zipinfo(name: str, st: os.stat_result) -> zipfile.ZipInfo:
+        """Build the zip member header of the given entry without following symlinks."""
+
+        date_time = time.localtime(max(st.st_mtime, 315532800))[:6]
+        if stat.S_ISDIR(st.st_mode):
+            name += '/'
+        zinfo = zipfile.ZipInfo(name, date_time)
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+        if stat.S_ISDIR(st.st_mode):
+            zinfo.external_attr |= 0x10
+        return zinfo
+
+    def _write(self, f: BinaryIO, entries: Iterator[Tuple[str, str]], compression_level: int, manifest: List[Dict] = None) -> None:
+        compression = zipfile.ZIP_DEFLATED if compression_level else zipfile.ZIP_STORED
+        with zipfile.ZipFile(f, 'w', compression, compresslevel=compression_level or None) as zf:
+            for full_path, name in entries:
+                st = os.lstat(full_path)
+                entry = manifest_entry(full_path, name, st)
+                if entry is None:
+                    continue
+                zinfo = self._zipinfo(name, st)
+                if entry['kind'] == 'link':
+                    zf.writestr(zinfo, entry['link'], zipfile.ZIP_STORED)
+                elif entry['kind'] == 'dir':
+                    zf.writestr(zinfo, b'', zipfile.ZIP_STORED)
+                else:
+                    zinfo.compress_type = compression
+                    zinfo.file_size = st.st_size
+                    hasher = content_hasher() if manifest is not None else None
+                    with open(full_path, 'rb', buffering=0) as src, zf.open(zinfo, 'w') as dst:
+                        self._copy(src, dst, hasher=hasher)
+                    entry['hash'] = hasher and hasher.hexdigest()
+                if manifest is not None:
+                    manifest.append(entry)
+
+    def _index(self, archive_path: str) -> Dict[str, ArchiveMember]:
+        members = {}
+        with zipfile.ZipFile(archive_path) as zf:
+            for zinfo in zf.infolist():
+                mode = zinfo.external_attr >> 16 if zinfo.create_system == 3 else 0
+                mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+                if zinfo.is_dir():
+                    member = ArchiveMember('dir', stat.S_IMODE(mode), 0, mtime)
+                elif stat.S_ISLNK(mode):
+                    member = ArchiveMember('link', stat.S_IMODE(mode), 0, mtime, link=zf.read(zinfo).decode())
+                else:
+                    member = ArchiveMember('file', stat.S_IMODE(mode), zinfo.file_size, mtime, zinfo.CRC)
+                members[zinfo.filename.rstrip('/')] = member
+        return members
+
+    def _extract(self, archive_path: str, path: str, workers: int, included: Callable[[str], bool] = None) -> None:
+        """Extract the archive, the regular files being spread over workers threads.
+
+        The central directory is read once, all the dirs are created up front
+        and each thread reads the archive through its own handle and buffer.
+        Only the selected members are read, from their offset in the archive."""
+
+        path = os.path.abspath(path)
+        dirs, links, files = [], [], []
+        with zipfile.ZipFile(archive_path) as zf:
+            for zinfo in zf.infolist():
+                if included and not included(zinfo.filename):
+                    continue
+                target = safe_join(path, zinfo.filename)
+                mode = zinfo.external_attr >> 16 if zinfo.create_system == 3 else 0
+                mtime = time.mktime(zinfo.date_time + (0, 0, -1))
+                if zinfo.is_dir():
+                    dirs.append((target, mode, mtime))
+                elif stat.S_ISLNK(mode):
+                    links.append((target, zf.read(zinfo).decode()))
+                else:
+                    files.append((zinfo, target, mode, mtime))
+        parents = {target for target, _, _ in dirs}
+        parents.update(os.path.dirname(target) for target, _ in links)
+        parents.update(os.path.dirname(target) for _, target, _, _ in files)
+        for parent in sorted(parents):
+            os.makedirs(parent, exist_ok=True)
+        for target, link in links:
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(link, target)
+
+        def _extract_files(chunk):
+            buffer = memoryview(bytearray(self.BUFFER_SIZE)) if workers > 1 else None
+            with zipfile.ZipFile(archive_path) as zf:
+                for zinfo, target, mode, mtime in chunk:
+                    # Replaced rather than overwritten, as unzip does: the existing
+                    # file may be read only or hardlinked to an extracted tree.
+                    if os.path.islink(target) or os.path.isfile(target):
+                        os.remove(target)
+                    with zf.open(zinfo) as src, open(target, 'wb', buffering=0) as dst:
+                        self._copy(src, dst, buffer)
+                    if mode & 0o7777:
+                        os.chmod(target, mode & 0o7777)
+                    os.utime(target, (mtime, mtime))
+
+        if workers > 1 and len(files) > 1:
+            # Each thread gets the members of one archive region, so its reads stay sequential.
+            chunk_size = -(-len(files) // (workers * 4))
+            chunks = [files[i:i+chunk_size] for i in range(0, len(files), chunk_size)]
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for _ in executor.map(_extract_files, chunks):
+                    pass
+        else:
+            _extract_files(files)
+        for target, mode, mtime in reversed(dirs):
+            if mode & 0o7777:
+                os.chmod(target, mode & 0o7777)
+            os.utime(target, (mtime, mtime))
+
+
+class ParallelFrameWriter(io.RawIOBase):
+    """Writable stream compressing fixed size chunks as independent frames on a thread pool.
+
+    Frames are written in order, so the output is a valid concatenation of frames."""
+
+    CHUNK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, fileobj: BinaryIO, compress: Callable[[bytes], bytes], workers: int) -> None:
+        super().__init__()
+        self.__fileobj = fileobj
+        self.__compress = compress
+        self.__executor = ThreadPoolExecutor(max_workers=workers)
+        self.__max_pending = workers * 2
+        self.__pending = deque()
+        self.__chunk = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.__chunk += b
+        while len(self.__chunk) >= self.CHUNK_SIZE:
+            self.__submit(bytes(self.__chunk[:self.CHUNK_SIZE]))
+            del self.__chunk[:self.CHUNK_SIZE]
+        return len(b)
+
+    def __submit(self, data: bytes) -> None:
+        self.__pending.append(self.__executor.submit(self.__compress, data))
+        while len(self.__pending) > self.__max_pending:
+            self.__fileobj.write(self.__pending.popleft().result())
+
+    def close(self) -> None:
+        if not self.closed:
+            try:
+                if self.__chunk:
+                    self.__submit(bytes(self.__chunk))
+                    self.__chunk = bytearray()
+                while self.__pending:
+                    self.__fileobj.write(self.__pending.popleft().result())
+            finally:
+                self.__executor.shutdown()
+        super().close()
+
+
+class SizeGuard():
+    """Writable file object wrapper failing once more than max_size bytes are written through it.
+
+    The bytes written are counted, not the file size: the zip headers
+    rewritten in place are counted twice, which is negligible."""
+
+    def __init__(self, fileobj: BinaryIO, max_size: int) -> None:
+        self.__fileobj = fileobj
+        self.__max_size = max_size
+        self.__written = 0
+        self.exceeded = False
+
+    def write(self, b) -> int:
+        self.__written += len(b)
+        if self.__written > self.__max_size:
+            self.exceeded = True
+            raise OSError(f'More than {self.__max_size} bytes written')
+        return self.__fileobj.write(b)
+
+    def __getattr__(self, name: str):
+        return getattr(self.__fileobj, name)
+
+
+class HashingReader(io.RawIOBase):
+    """Readable stream updating a hash object with all the data read from fileobj."""
+
+    def __init__(self, fileobj: BinaryIO, hasher: 'hashlib._Hash') -> None:
+        super().__init__()
+        self.__fileobj = fileobj
+        self.__hasher = hasher
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.__fileobj.readinto(b)
+        if n:
+            self.__hasher.update(memoryview(b)[:n])
+        return n
+
+
+class TarArchiver(StreamArchiver):
+    """Tar archive format compressed on several worker threads."""
+
+    @property
+    @abstractmethod
+    def ext(self) -> str:
+        pass
+
+    @abstractmethod
+    def _compressor(self, f: BinaryIO, compression_level: int) -> BinaryIO:
+        """Return a writable stream compressing into f."""
+
+        pass
+
+    @abstractmethod
+    def _decompressor(self, f: BinaryIO) -> BinaryIO:
+        """Return a readable stream decompressing f."""
+
+        pass
+
+    @staticmethod
+    def _tarinfo(full_path: str, name: str, st: os.stat_result) -> tarfile.TarInfo:
+        """Build the tar member header of the given entry without following symlinks.
+
+        Owners are not looked up (as zip, they are not restored)."""
+
+        tinfo = tarfile.TarInfo(name)
+        tinfo.mode = stat.S_IMODE(st.st_mode)
+        # A float mtime is kept with its sub-second part in a PAX header.
+        tinfo.mtime = st.st_mtime
+        if stat.S_ISLNK(st.st_mode):
+            tinfo.type = tarfile.SYMTYPE
+            tinfo.linkname = os.readlink(full_path)
+        elif stat.S_ISDIR(st.st_mode):
+            tinfo.type = tarfile.DIRTYPE
+        elif stat.S_ISREG(st.st_mode):
+            tinfo.size = st.st_size
+        else:
+            return None
+        return tinfo
+
+    def _write(self, f: BinaryIO, entries: Iterator[Tuple[str, str]], compression_level: int, manifest: List[Dict] = None) -> None:
+        with self._compressor(f, compression_level) as stream, \
+                tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT, bufsize=self.BUFFER_SIZE) as tf:
+            tf.copybufsize = self.BUFFER_SIZE
+            for full_path, name in entries:
+                st = os.lstat(full_path)
+                tinfo = self._tarinfo(full_path, name, st)
+                if tinfo is None:
+                    continue
+                entry = manifest_entry(full_path, name, st)
+                if tinfo.isreg():
+                    hasher = content_hasher() if manifest is not None else None
+                    with open(full_path, 'rb', buffering=0) as src:
+                        tf.addfile(tinfo, HashingReader(src, hasher) if hasher else src)
+                    entry['hash'] = hasher and hasher.hexdigest()
+                else:
+                    tf.addfile(tinfo)
+                if manifest is not None:
+                    manifest.append(entry)
+
+    def _members(self, tf: tarfile.TarFile, path: str, included: Callable[[str], bool] = None) -> Iterator[tarfile.TarInfo]:
+        """Yield the members to extract, replacing the existing symlinks and files instead of writing through them."""
+
+        for tinfo in tf:
+            if included and not included(tinfo.name):
+                continue
+            target = safe_join(path, tinfo.name)
+            if not tinfo.isdir() and (os.path.islink(target) or os.path.isfile(target)):
+                os.remove(target)
+            yield tinfo
+
+    def _index(self, archive_path: str) -> Dict[str, ArchiveMember]:
+        members = {}
+        with open(archive_path, 'rb', buffering=self.BUFFER_SIZE) as f, \
+                self._decompressor(f) as stream, \
+                tarfile.open(fileobj=stream, mode='r|', bufsize=self.BUFFER_SIZE) as tf:
+            for tinfo in tf:
+                if tinfo.isdir():
+                    member = ArchiveMember('dir', tinfo.mode, 0, tinfo.mtime)
+                elif tinfo.issym():
+                    member = ArchiveMember('link', tinfo.mode, 0, tinfo.mtime, link=tinfo.linkname)
+                else:
+                    member = ArchiveMember('file', tinfo.mode, tinfo.size, tinfo.mtime)
+                members[tinfo.name.rstrip('/')] = member
+        return members
+
+    def _extract(self, archive_path: str, path: str, workers: int, included: Callable[[str], bool] = None) -> None:
+        # A tar stream can only be read sequentially (the members not included are
+        # still decompressed), workers are used by the lz4 and zstd writers.
+        path = os.path.abspath(path)
+        kwargs = {'filter': 'fully_trusted'} if hasattr(tarfile, 'fully_trusted_filter') else {}
+        with open(archive_path, 'rb', buffering=self.BUFFER_SIZE) as f, \
+                self._decompressor(f) as stream, \
+                tarfile.open(fileobj=stream, mode='r|', bufsize=self.BUFFER_SIZE) as tf:
+            tf.copybufsize = self.BUFFER_SIZE
+            # As zip, owners are not restored.
+            tf.chown = lambda *args, **kwargs: None
+            tf.extractall(path, members=self._members(tf, path, included), **kwargs)
+
+
+class ZstdTarArchiver(TarArchiver):
+    """Tar archive format compressed with zstd (needs the zstandard package)."""
+
+    # zstd levels matching the 0-9 compression levels of zip.
+    LEVELS = (1, 1, 2, 2, 3, 3, 3, 6, 12, 19)
+
+    def __init__(self, cache_dir: str, workers: int = 1, shard_depth: int = 0) -> None:
+        super().__init__(cache_dir, workers, shard_depth)
+        self.__zstd = import_optional('zstandard', 'zstd')
+
+    @property
+    def ext(self) -> str:
+        return 'tar.zst'
+
+    def _compressor(self, f: BinaryIO, compression_level: int) -> BinaryIO:
+        cctx = self.__zstd.ZstdCompressor(
+            level=self.LEVELS[compression_level],
+            threads=self._workers if self._workers > 1 else 0,
+            write_checksum=True)
+        return cctx.stream_writer(f, write_size=self.BUFFER_SIZE, closefd=False)
+
+    def _decompressor(self, f: BinaryIO) -> BinaryIO:
+        dctx = self.__zstd.ZstdDecompressor()
+        return dctx.stream_reader(f, read_size=self.BUFFER_SIZE, read_across_frames=True, closefd=False)
+
+
+class Lz4TarArchiver(TarArchiver):
+    """Tar archive format compressed with lz4 frames (needs the lz4 package)."""
+
+    # lz4 levels matching the 0-9 compression levels of zip.
+    LEVELS = (0, 0, 0, 0, 0, 0, 0, 4, 9, 12)
+
+    def __init__(self, cache_dir: str, workers: int = 1, shard_depth: int = 0) -> None:
+        super().__init__(cache_dir, workers, shard_depth)
+        self.__lz4 = import_optional('lz4.frame', 'lz4')
+
+    @property
+    def ext(self) -> str:
+        return 'tar.lz4'
+
+    def _compressor(self, f: BinaryIO, compression_level: int) -> BinaryIO:
+        level = self.LEVELS[compression_level]
+        lz4 = self.__lz4
+        compress = lambda data: lz4.compress(data, compression_level=level, content_checksum=True)
+        return ParallelFrameWriter(f, compress, self._workers)
+
+    def _decompressor(self, f: BinaryIO) -> BinaryIO:
+        return self.__lz4.open(f, 'rb')
+
+
+ARCHIVERS = {
+    'python': ZipArchiver,
+    'exec': LnxArchiver if is_unix() else WinArchiver,
+}
+
+ARCHIVE_FORMATS = {
+    'zip': ZipArchiver,
+    'tar.zst': ZstdTarArchiver,
+    'tar.lz4': Lz4TarArchiver,
+}
+
+def archive_format(archive_path: str) -> str:
+    """Detect the archive format from the extension of the given path."""
+
+    for ext in ARCHIVE_FORMATS:
+        if archive_path.endswith(f'.{ext}'):
+            return ext
+    raise XtremCacheArchiveExtractionError(archive_path, ValueError('Unknown archive format.'))
+
+# Most levels of shard dirs.
+MAX_SHARD_DEPTH = 3
+
+def shard_path(filename: str, depth: int) -> str:
+    """Return the path of the archive filename relative to cache_dir, with the given number of shard dirs.
+
+    Each shard dir is named by the next 2 characters of the hash starting the filename, e.g. 'ab/cd/abcd....zip'."""
+
+    return os.path.join(*[filename[2 * i:2 * i + 2] for i in range(depth)], filename)
+
+def create_archiver(
+        cache_dir: str,
+        archiver: str = 'python',
+        archive_format: str = 'zip',
+        workers: int = 1,
+        shard_depth: int = 0) -> ArchiveManager:
+    """Factory of archvier depending of the wanted format, engine and of the os.
+
+    Only the zip format can be handled by the external zip executables."""
 
-    return LnxArchiver(cache_dir) if is_unix() else WinArchiver(cache_dir)
+    if archive_format == 'zip':
+        return ARCHIVERS[archiver](cache_dir, workers, shard_depth)
+    return ARCHIVE_FORMATS[archive_format](cache_dir, workers, shard_depth)
@@ -1,25 +1,125 @@
 import datetime
 import logging
 import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from functools import lru_cache
-from typing import Any, List, Type
-
-from sqlalchemy import (Boolean, Column, DateTime, Integer, String,
-                        create_engine)
-from sqlalchemy.orm import Session, declarative_base
-from sqlalchemy.orm.exc import NoResultFound
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type
 
 from xtremcache.exceptions import *
 from xtremcache.utils import *
 from xtremcache.version import __app_name__
 
+# SQLAlchemy is only imported to create the schema and by the ORM queries of
+# the listing commands: cache and uncache run their statements on sqlite3.
+
+
+class ItemMixin():
+    """Members of an Item, mapped by the ORM or read by a plain query."""
+
+    data_members_name = [
+        'id',
+        'size',
+        'readers',
+        'writer',
+        'archive_path',
+        'storage',
+        'base_id'
+    ]
+
+    def copy_from(self, item: 'ItemMixin'):
+        """Copy data members from another Item object."""
+
+        for m in self.data_members_name:
+            setattr(self, m, getattr(item, m, None))
+
+    def __eq__(self, other: 'ItemMixin'):
+        """Compare only data members between two Items (not can_modifie and can_read)."""
+
+        for m in self.data_members_name:
+            if getattr(self, m, None) != getattr(other, m, None):
+                return False
+        return True
+
+    @property
+    def can_modifie(self) -> bool:
+        """Return True if the Item can be modified safely."""
+
+        return self.can_read and self.readers == 0
+
+    @property
+    def can_read(self) -> bool:
+        """Return True if the Item can be read safely."""
+
+        return not self.writer
+
+    def __repr__(self) -> str:
+        return f"<Item(id='{self.id}')>"
+
+
+class ItemRow(ItemMixin):
+    """Item read from a row of the items table."""
+
+    def __init__(self, **columns) -> None:
+        self.__dict__.update(columns)
+        self.writer = bool(self.writer)
+        if isinstance(self.created_date, str):
+            self.created_date = datetime.datetime.fromisoformat(self.created_date)
+
+
+class BorrowedConnection():
+    """sqlite3 connection lent to SQLAlchemy during a transaction, which alone ends it and closes the connection."""
+
+    def __init__(self, connection: sqlite3.Connection) -> None:
+        self.__dict__['_connection'] = connection
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._connection, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self._connection, name, value)
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
 
 class BddManager():
-    """Manage database to valid operations on cached files."""
+    """Manage database to valid operations on cached files.
+
+    The database is shared by concurrent processes: it runs in WAL mode (the
+    readers don't block the writer), waits for the locks up to BUSY_TIMEOUT
+    and its connections are pooled by all the managers of a process (a
+    POOL_SIZE of 0 opens a connection per transaction). The schema is brought
+    to SCHEMA_VERSION by the first connection of a process to an older one (see
+    __MIGRATIONS)."""
+
+    JOURNAL_MODE = 'WAL'
+    SYNCHRONOUS = 'NORMAL'
+    BUSY_TIMEOUT = 30
+    # Bytes the WAL is truncated to when it restarts, it is part of the cache size.
+    JOURNAL_SIZE_LIMIT = 0
+    POOL_SIZE = 5
+
+    # Seconds a reader or writer lease lasts if it is not renewed.
+    LEASE_DURATION = 60
 
     def __init__(self, data_base_dir: str, log_level: int = logging.WARNING) -> None:
         self.__data_base_dir = os.path.realpath(data_base_dir)
         self.__log_level = log_level
+        self.__local = threading.local()
+        self.__tables = None
+        self.__tables_lock = threading.Lock()
 
     @property
     @lru_cache
@@ -30,50 +130,202 @@ class BddManager():
 
     @property
     def size(self) -> int:
-        """Current size of the database in bytes."""
+        """Current size of the database in bytes, its WAL files included."""
 
-        return os.path.getsize(self.__db_location)
+        size = 0
+        for suffix in ['', '-wal', '-shm']:
+            try:
+                size += os.path.getsize(self.__db_location + suffix)
+            except FileNotFoundError:
+                pass
+        return size
 
-    @property
-    @lru_cache
-    def __sqlite_db_location(self) -> str:
-        """str to give to sqlalchemy to bridge the sqlite db."""
+    def checkpoint(self, mode: str = 'TRUNCATE') -> None:
+        """Write the WAL content back to the database.
 
-        return f'sqlite:///{self.__db_location}'
+        TRUNCATE waits for the readers and writers to truncate it. PASSIVE
+        writes back what it can without waiting for anyone, the next write
+        then restarts the WAL, truncated to JOURNAL_SIZE_LIMIT, if no reader
+        still uses it."""
+
+        with self.__pooled() as connection:
+            connection.execute(f'PRAGMA wal_checkpoint({mode})')
 
     @property
     @lru_cache
-    def __engine(self) -> object:
-        """Generate a sqlalchemy engine to manage the sqlite db."""
+    def __pool(self) -> SimpleNamespace:
+        """Idle connections to the database, shared by the managers of the process."""
 
         dir = os.path.dirname(self.__db_location)
         os.makedirs(dir, exist_ok=True)
-        engine = create_engine(
-            self.__sqlite_db_location,
-            echo=self.__log_level<logging.INFO)
-        return engine
+        try:
+            # A removed then created again database gets another pool.
+            inode = os.stat(self.__db_location).st_ino
+        except FileNotFoundError:
+            inode = None
+        return self.__shared_pool(
+            self.__db_location,
+            inode,
+            self.JOURNAL_MODE,
+            self.SYNCHRONOUS,
+            self.BUSY_TIMEOUT,
+            self.POOL_SIZE)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def __shared_pool(
+            path: str,
+            inode: int,
+            journal_mode: str,
+            synchronous: str,
+            busy_timeout: int,
+            pool_size: int) -> SimpleNamespace:
+        """Return the pool of the database at path, created once per process."""
+
+        return SimpleNamespace(idle=queue.LifoQueue(pool_size), schema_lock=threading.Lock(), schema_ready=False)
+
+    def __connect(self) -> sqlite3.Connection:
+        """Open a connection to the database, the first one of the process checks its schema."""
+
+        connection = sqlite3.connect(
+            self.__db_location,
+            timeout=self.BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False)
+        # The transactions are begun explicitly, sqlite3 would only begin them on the first write.
+        connection.execute(f'PRAGMA journal_mode={self.JOURNAL_MODE}')
+        connection.execute(f'PRAGMA synchronous={self.SYNCHRONOUS}')
+        connection.execute(f'PRAGMA busy_timeout={self.BUSY_TIMEOUT * 1000}')
+        connection.execute(f'PRAGMA journal_size_limit={self.JOURNAL_SIZE_LIMIT}')
+        if self.__log_level < logging.INFO:
+            connection.set_trace_callback(logging.debug)
+        pool = self.__pool
+        if not pool.schema_ready:
+            with pool.schema_lock:
+                if not pool.schema_ready:
+                    version = self.__schema_version(connection)
+                    if version < self.SCHEMA_VERSION:
+                        self.__migrate(connection)
+                    elif version > self.SCHEMA_VERSION:
+                        logging.warning(f'The database schema is at version {version}, newer than {self.SCHEMA_VERSION}.')
+                    pool.schema_ready = True
+        return connection
+
+    @contextmanager
+    def __pooled(self) -> Iterator[sqlite3.Connection]:
+        """Lend an idle connection of the pool, or a new one if there is none."""
+
+        pool = self.__pool
+        try:
+            connection = pool.idle.get_nowait()
+        except queue.Empty:
+            connection = self.__connect()
+        try:
+            yield connection
+        finally:
+            pooled = False
+            if self.POOL_SIZE:
+                try:
+                    pool.idle.put_nowait(connection)
+                    pooled = True
+                except queue.Full:
+                    pass
+            if not pooled:
+                connection.close()
+
+    @contextmanager
+    def __connection(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        """Run the statements of the block on a single sqlite3 transaction (see transaction)."""
+
+        connection = getattr(self.__local, 'connection', None)
+        if connection is not None:
+            yield connection
+            return
+        with self.__pooled() as connection:
+            connection.execute('BEGIN IMMEDIATE' if write else 'BEGIN')
+            self.__local.connection = connection
+            try:
+                yield connection
+                connection.execute('COMMIT')
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                raise
+            finally:
+                self.__local.connection = None
+
+    @contextmanager
+    def transaction(self, write: bool = False) -> Iterator['Session']:
+        """Run all the database calls of the block in a single transaction.
+
+        With write, the write lock is taken at the beginning of the transaction:
+        a transaction reading then writing could otherwise fail without waiting
+        for the lock. Nested blocks join the outer transaction. The block gets
+        an SQLAlchemy Session running on the connection of the transaction."""
+
+        session = getattr(self.__local, 'session', None)
+        if session is not None:
+            yield session
+            return
+        from sqlalchemy.orm import Session
+
+        with self.__connection(write):
+            with Session(bind=self.__orm_engine, expire_on_commit=False) as session:
+                self.__local.session = session
+                try:
+                    yield session
+                    session.commit()
+                except BaseException:
+                    session.rollback()
+                    raise
+                finally:
+                    self.__local.session = None
 
     @property
     @lru_cache
-    def Item(self) -> Type:
-        """Abstract factory of Item (archive) in database.
+    def __orm_engine(self) -> object:
+        """SQLAlchemy engine running its queries on the connection of the current transaction."""
+
+        from sqlalchemy import create_engine
+        from sqlalchemy.pool import NullPool
+
+        return create_engine(
+            'sqlite://',
+            creator=lambda: BorrowedConnection(self.__local.connection),
+            poolclass=NullPool)
+
+    @staticmethod
+    def __records(cursor: sqlite3.Cursor, factory: Callable[..., Any] = SimpleNamespace) -> List[Any]:
+        """Return the rows of the cursor as objects with an attribute per column."""
+
+        columns = [c[0] for c in cursor.description]
+        return [factory(**dict(zip(columns, row))) for row in cursor]
+
+    @property
+    def __models(self) -> SimpleNamespace:
+        """Tables of the database, declared once even if the manager is shared by threads."""
+
+        if self.__tables is None:
+            with self.__tables_lock:
+                if self.__tables is None:
+                    self.__tables = self.__create_models()
+        return self.__tables
+
+    def __create_models(self) -> SimpleNamespace:
+        """Abstract factory of all the tables of the database.
 
         All element of database have to inhert the result of declarative_base(),
         that we don't what to expose globally."""
 
+        from sqlalchemy import Boolean, Column, DateTime, Float, Index, Integer, String
+        from sqlalchemy.orm import declarative_base
+
         self.__base = declarative_base()
 
-        class Item(self.__base):
+        class Item(ItemMixin, self.__base):
             """Item (archive) in database."""
 
             __tablename__ = 'items'
-            data_members_name = [
-                'id',
-                'size',
-                'readers',
-                'writer',
-                'archive_path'
-            ]
 
             id = Column(String, primary_key=True, unique=True)
             size = Column(Integer, nullable=False)
@@ -81,38 +333,232 @@ class BddManager():
             writer = Column(Boolean, nullable=False)
             archive_path = Column(String, nullable=False)
             created_date = Column(DateTime, default=datetime.datetime.utcnow)
+            storage = Column(String, nullable=False, default='archive', server_default='archive')
+            base_id = Column(String, index=True)
+            last_access = Column(Float, index=True, default=time.time)
+            hit_count = Column(Integer, nullable=False, default=0, server_default='0')
+            priority = Column(Float, index=True)
+
+            __table_args__ = (
+                Index('ix_items_created_date', 'created_date'),
+                Index('ix_items_hit_count_last_access', 'hit_count', 'last_access'))
+
+        class Blob(self.__base):
+            """Content addressed file stored once for all the Items referencing it."""
+
+            __tablename__ = 'blobs'
 
-            def copy_from(self, item: 'Item'):
-                """Copy data members from another Item object."""
+            hash = Column(String, primary_key=True)
+            size = Column(Integer, nullable=False)
+            refcount = Column(Integer, nullable=False, index=True)
+
+        class Manifest(self.__base):
+            """File, dir or symlink of a cached Item."""
 
-                for m in self.data_members_name:
-                    setattr(self, m, getattr(item, m, None))
+            __tablename__ = 'manifests'
+
+            rowid = Column(Integer, primary_key=True)
+            entry_id = Column(String, nullable=False)
+            path = Column(String, nullable=False)
+            kind = Column(String, nullable=False)
+            mode = Column(Integer, nullable=False)
+            mtime = Column(Float, nullable=False)
+            size = Column(Integer, nullable=False)
+            hash = Column(String)
+            link = Column(String)
 
-            def __eq__(self, other: 'Item'):
-                """Compare only data members between two Items (not can_modifie and can_read)."""
+            # The manifest of an Item is read in path order.
+            __table_args__ = (Index('ix_manifests_entry_id_path', 'entry_id', 'path'),)
+
+        class Deletion(self.__base):
+            """Path of the base of a delta Item removed in this Item."""
+
+            __tablename__ = 'deletions'
+
+            rowid = Column(Integer, primary_key=True)
+            entry_id = Column(String, nullable=False, index=True)
+            path = Column(String, nullable=False)
+
+        class Tree(self.__base):
+            """Extracted tree of a cached Item, kept to uncache it without decompression."""
+
+            __tablename__ = 'trees'
+
+            entry_id = Column(String, primary_key=True)
+            size = Column(Integer, nullable=False)
 
-                for m in self.data_members_name:
-                    if getattr(self, m, None) != getattr(other, m, None):
-                        return False
-                return True
+        class Lease(self.__base):
+            """Reader or writer of an Item, held by a process until it expires if not renewed."""
 
-            @property
-            def can_modifie(self) -> bool:
-                """Return True if the Item can be modified safely."""
+            __tablename__ = 'leases'
 
-                return self.can_read and self.readers == 0
+            rowid = Column(Integer, primary_key=True)
+            entry_id = Column(String, nullable=False, index=True)
+            kind = Column(String, nullable=False)
+            pid = Column(Integer, nullable=False)
+            hostname = Column(String, nullable=False)
+            expires = Column(Float, nullable=False)
 
-            @property
-            def can_read(self) -> bool:
-                """Return True if the Item can be read safely."""
+        class LockStat(self.__base):
+            """Time waited for the lock of an Item, by kind of lock (contended acquisitions only)."""
 
-                return not self.writer
+            __tablename__ = 'lock_stats'
+
+            entry_id = Column(String, primary_key=True)
+            kind = Column(String, primary_key=True)
+            waits = Column(Integer, nullable=False)
+            total = Column(Float, nullable=False)
+            max = Column(Float, nullable=False)
+
+        class Counter(self.__base):
+            """Named value shared by all the Items (the GDSF clock)."""
+
+            __tablename__ = 'counters'
+
+            name = Column(String, primary_key=True)
+            value = Column(Float, nullable=False)
+
+        class SchemaVersion(self.__base):
+            """Migration applied to the database."""
+
+            __tablename__ = 'schema_version'
+
+            version = Column(Integer, primary_key=True)
+            description = Column(String, nullable=False)
+            applied_date = Column(DateTime, nullable=False)
+
+        return SimpleNamespace(
+            Item=Item, Blob=Blob, Manifest=Manifest, Deletion=Deletion, Tree=Tree, Lease=Lease, LockStat=LockStat,
+            Counter=Counter, SchemaVersion=SchemaVersion)
+
+    @staticmethod
+    def __schema_version(connection: sqlite3.Connection) -> int:
+        """Return the version of the schema of the database, 0 if it is not versioned yet."""
+
+        try:
+            return connection.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+        except sqlite3.OperationalError:
+            return 0
+
+    def __migrate(self, connection: sqlite3.Connection) -> None:
+        """Apply the pending migrations in one transaction, holding the write lock of the database.
+
+        The concurrent processes wait for the lock and find the schema up to
+        date. The given connection must be out of a transaction."""
+
+        previous = getattr(self.__local, 'connection', None)
+        connection.execute('BEGIN IMMEDIATE')
+        # The SQLAlchemy schema operations run on this transaction too.
+        self.__local.connection = connection
+        try:
+            version = self.__schema_version(connection)
+            for number, (description, migration) in enumerate(self.__MIGRATIONS[version:], version + 1):
+                logging.info(f'Migrating the database to version {number}: {description}.')
+                if callable(migration):
+                    migration(self, connection)
+                else:
+                    for statement in migration:
+                        connection.execute(statement)
+                connection.execute(
+                    'INSERT INTO schema_version (version, description, applied_date) VALUES (:version, :description, :now)',
+                    {
+                        'version': number,
+                        'description': description,
+                        'now': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+                    })
+            connection.execute('COMMIT')
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+        finally:
+            self.__local.connection = previous
 
-            def __repr__(self) -> str:
-                return f"<Item(id='{self.id}')>"
+    def __adopt(self, connection: sqlite3.Connection) -> None:
+        """Create the declared tables, and the columns, indexes and triggers missing in a database older than the versioning."""
 
-        self.__base.metadata.create_all(self.__engine)
-        return Item
+        self.__models
+        self.__base.metadata.create_all(self.__orm_engine)
+        self.__add_missing_columns(self.__orm_engine)
+        self.__add_size_counter(connection)
+
+    def __add_missing_columns(self, engine: object) -> None:
+        """Add the columns and indexes missing in a database created by an older version."""
+
+        from sqlalchemy import inspect, text
+
+        inspector = inspect(engine)
+        for table in self.__base.metadata.sorted_tables:
+            existing = [c['name'] for c in inspector.get_columns(table.name)]
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(engine.dialect)
+                default = f" NOT NULL DEFAULT '{column.server_default.arg}'" if column.server_default is not None else ''
+                with engine.begin() as connection:
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}{default}'))
+            for index in table.indexes:
+                index.create(engine, checkfirst=True)
+
+    # Tables whose rows are accounted in the content size, with the condition for a row to be.
+    __SIZED_TABLES = {'items': "{row}.storage != 'cas'", 'blobs': '1', 'trees': '1'}
+
+    __CONTENT_SIZE = (
+        "(SELECT COALESCE(SUM(size), 0) FROM items WHERE storage != 'cas') "
+        "+ (SELECT COALESCE(SUM(size), 0) FROM blobs) "
+        "+ (SELECT COALESCE(SUM(size), 0) FROM trees)")
+
+    def __add_size_counter(self, connection: sqlite3.Connection) -> None:
+        """Keep the content size in the counters table.
+
+        Triggers update it in the transaction inserting, updating or deleting
+        a sized row, a database without it gets it computed once."""
+
+        triggers = {}
+        for table, counted in self.__SIZED_TABLES.items():
+            new = f"CASE WHEN {counted.format(row='NEW')} THEN NEW.size ELSE 0 END"
+            old = f"CASE WHEN {counted.format(row='OLD')} THEN OLD.size ELSE 0 END"
+            columns = 'size, storage' if table == 'items' else 'size'
+            events = [
+                ('insert', 'INSERT', new),
+                ('delete', 'DELETE', f'-({old})'),
+                ('update', f'UPDATE OF {columns}', f'{new} - {old}')]
+            for name, event, delta in events:
+                triggers[f'{table}_size_{name}'] = (
+                    f'CREATE TRIGGER IF NOT EXISTS {table}_size_{name} AFTER {event} ON {table} BEGIN '
+                    f"UPDATE counters SET value = value + {delta} WHERE name = 'content_size'; END")
+        for trigger in triggers.values():
+            connection.execute(trigger)
+        connection.execute(
+            f"INSERT OR IGNORE INTO counters (name, value) SELECT 'content_size', {self.__CONTENT_SIZE}")
+
+    # Forward migrations of the schema, the n-th one brings it from version
+    # n - 1 to n. A released migration is never changed: a schema change is
+    # a new migration, and a change of the declared tables too. The tables of
+    # a new database are created from the declared ones by the first
+    # migration, the next ones must leave them as they are.
+    __MIGRATIONS = [
+        ('Adopt the database of a version without schema versioning', __adopt),
+        ('Index the blobs by refcount and the manifests by entry and path', [
+            'CREATE INDEX IF NOT EXISTS ix_blobs_refcount ON blobs (refcount)',
+            'CREATE INDEX IF NOT EXISTS ix_manifests_entry_id_path ON manifests (entry_id, path)',
+            'DROP INDEX IF EXISTS ix_manifests_entry_id']),
+    ]
+
+    # Version of the schema of this version of the manager.
+    SCHEMA_VERSION = len(__MIGRATIONS)
+
+    @property
+    def Item(self) -> Type:
+        """Item (archive) class of the database."""
+
+        return self.__models.Item
+
+    @property
+    def Manifest(self) -> Type:
+        """Manifest (file of an Item) class of the database."""
+
+        return self.__models.Manifest
 
     def create_item(
             self,
@@ -120,7 +566,9 @@ class BddManager():
             size: int = 0,
             readers: int = 0,
             writer: bool = False,
-            archive_path: str = ''):
+            archive_path: str = '',
+            storage: str = 'archive',
+            base_id: str = None):
         """Factoty of database Item."""
 
         return self.Item(
@@ -128,79 +576,620 @@ class BddManager():
             size=size,
             readers=readers,
             writer=writer,
-            archive_path=archive_path)
+            archive_path=archive_path,
+            storage=storage,
+            base_id=base_id)
+
+    def __insert(self, connection: sqlite3.Connection, id: str, storage: str = 'archive', base_id: str = None) -> bool:
+        """Insert the Item id, written by the caller, return False if it already exists."""
 
-    def get(self, id: str, create: bool = False):
+        return connection.execute(
+            'INSERT OR IGNORE INTO items (id, size, readers, writer, archive_path, created_date, storage, base_id, '
+            'last_access, hit_count) '
+            'VALUES (:id, 0, 0, 1, \'\', :created_date, :storage, :base_id, :now, 0)',
+            {
+                'id': id,
+                'created_date': datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),
+                'storage': storage,
+                'base_id': base_id,
+                'now': time.time()
+            }).rowcount == 1
+
+    def get(self, id: str, create: bool = False) -> ItemRow:
         """Get a db Item by id.
 
         With create, create it if it's doesn't already exist."""
 
-        item = None
-        with Session(self.__engine) as session:
-            try:
-                item = session.query(self.Item).filter(self.Item.id.in_([id])).one()
-            except NoResultFound as e:
-                if create:
-                    session.add(self.create_item(
-                        id=id,
-                        writer=True))
-                    session.commit()
-                    return self.get(id)
-                else:
-                    raise XtremCacheItemNotFoundError(id)
-        return item
+        with self.__connection(write=create) as connection:
+            if create:
+                self.__insert(connection, id)
+            items = self.__records(connection.execute('SELECT * FROM items WHERE id = :id', {'id': id}), ItemRow)
+        if not items:
+            raise XtremCacheItemNotFoundError(id)
+        return items[0]
 
     def update(self, item) -> None:
         """Update a db Item by copy of a the given Item."""
 
-        item_from_bdd = self.get(item.id)
-        with Session(self.__engine) as session:
-            try:
-                item_from_bdd = session.query(self.Item).filter(self.Item.id.in_([item.id])).one()
-                item_from_bdd.copy_from(item)
-                session.commit()
-            except Exception as e:
+        members = ItemMixin.data_members_name
+        with self.__connection(write=True) as connection:
+            updated = connection.execute(
+                f"UPDATE items SET {', '.join(f'{m} = :{m}' for m in members)} WHERE id = :id",
+                {m: getattr(item, m, None) for m in members}).rowcount
+            if not updated:
                 raise XtremCacheItemNotFoundError(item.id)
 
+    def __transition(self, id: str, statement: str, lease: str = None, **params) -> Any:
+        """Run a conditional UPDATE of the Item id, return False if its condition didn't hold.
+
+        With lease, a lease of this kind is taken by the current process on
+        success and its id is returned, else True is returned.
+        Raise XtremCacheItemNotFoundError if the Item doesn't exist."""
+
+        with self.__connection(write=True) as connection:
+            if connection.execute(statement, dict(params, id=id)).rowcount:
+                return self.__add_lease(connection, id, lease) if lease else True
+            if connection.execute('SELECT 1 FROM items WHERE id = :id', {'id': id}).fetchone() is None:
+                raise XtremCacheItemNotFoundError(id)
+            return False
+
+    def __add_lease(self, connection: sqlite3.Connection, id: str, kind: str) -> int:
+        """Take a lease of the given kind on the Item id for the current process, return its id."""
+
+        return connection.execute(
+            'INSERT INTO leases (entry_id, kind, pid, hostname, expires) VALUES (:id, :kind, :pid, :hostname, :expires)',
+            {
+                'id': id,
+                'kind': kind,
+                'pid': os.getpid(),
+                'hostname': socket.gethostname(),
+                'expires': time.time() + self.LEASE_DURATION
+            }).lastrowid
+
+    def __release_lease(self, connection: sqlite3.Connection, id: str, kind: str, lease: int = None) -> None:
+        """Drop the given lease, or one of the given kind held by the current process on the Item id."""
+
+        if lease is not None:
+            connection.execute('DELETE FROM leases WHERE rowid = :lease', {'lease': lease})
+        else:
+            connection.execute(
+                'DELETE FROM leases WHERE rowid IN (SELECT rowid FROM leases WHERE entry_id = :id '
+                'AND kind = :kind AND pid = :pid AND hostname = :hostname LIMIT 1)',
+                {'id': id, 'kind': kind, 'pid': os.getpid(), 'hostname': socket.gethostname()})
+
+    # GDSF priority of an Item: the clock plus its accesses (its write being
+    # the first one) per byte. An UPDATE reads the hit_count before it.
+    __PRIORITY = (
+        "COALESCE((SELECT value FROM counters WHERE name = 'gdsf_clock'), 0) "
+        "+ ({accesses}) / MAX({size}, 1)")
+
+    def acquire_new(self, id: str, storage: str = 'archive', base_id: str = None) -> int:
+        """Create the Item id, written by the caller, return its writer lease id or None if it already exists.
+
+        The base of a delta is pinned by the insertion itself."""
+
+        with self.__connection(write=True) as connection:
+            return self.__add_lease(connection, id, 'writer') if self.__insert(connection, id, storage, base_id) else None
+
+    def acquire_reader(self, id: str) -> int:
+        """Take a reader on the Item id, return its lease id or False if the Item is written.
+
+        The read is a hit: the last access, hit count and GDSF priority of the
+        Item are updated by the same statement."""
+
+        return self.__transition(
+            id,
+            'UPDATE items SET readers = readers + 1, last_access = :now, hit_count = hit_count + 1, '
+            f'priority = {self.__PRIORITY.format(accesses="hit_count + 2.0", size="size")} WHERE id = :id AND writer = 0',
+            'reader',
+            now=time.time())
+
+    def release_reader(self, id: str, lease: int = None) -> None:
+        """Release a reader taken on the Item id, by default the one of the current process."""
+
+        with self.__connection(write=True) as connection:
+            self.__transition(id, 'UPDATE items SET readers = readers - 1 WHERE id = :id AND readers > 0')
+            self.__release_lease(connection, id, 'reader', lease)
+
+    def acquire_writer(self, id: str) -> int:
+        """Take the writer of the Item id, return its lease id or False if it is read, written or the base of a delta."""
+
+        return self.__transition(
+            id,
+            'UPDATE items SET writer = 1 WHERE id = :id AND writer = 0 AND readers = 0 '
+            'AND NOT EXISTS (SELECT 1 FROM items AS delta WHERE delta.base_id = :id)',
+            'writer')
+
+    def release_writer(self, id: str, size: int = None, archive_path: str = None, lease: int = None) -> None:
+        """Release the writer of the Item id, recording its size and archive path when given."""
+
+        with self.__connection(write=True) as connection:
+            self.__transition(
+                id,
+                'UPDATE items SET writer = 0, size = COALESCE(:size, size), '
+                'archive_path = COALESCE(:archive_path, archive_path), last_access = :now, '
+                f'priority = {self.__PRIORITY.format(accesses="hit_count + 1.0", size="COALESCE(:size, size)")} WHERE id = :id',
+                size=size,
+                archive_path=archive_path,
+                now=time.time())
+            self.__release_lease(connection, id, 'writer', lease)
+
+    def __acquire_each(self, acquire: Callable[[str], int], ids: List[str]) -> List[Any]:
+        """Call acquire on each id in one transaction, return its results, None for the missing Items."""
+
+        leases = []
+        with self.__connection(write=True):
+            for id in ids:
+                try:
+                    leases.append(acquire(id))
+                except XtremCacheItemNotFoundError:
+                    leases.append(None)
+        return leases
+
+    def acquire_new_many(self, entries: List[Tuple[str, str, str]]) -> List[Optional[int]]:
+        """Create the Items of the (id, storage, base_id) entries in one transaction, see acquire_new.
+
+        Return the writer lease id of each one, None if it already exists."""
+
+        with self.__connection(write=True):
+            return [self.acquire_new(*entry) for entry in entries]
+
+    def acquire_readers(self, ids: List[str]) -> List[Any]:
+        """Take a reader on each Item of ids in one transaction, see acquire_reader.
+
+        Return the lease id of each one, False if it is written or None if it doesn't exist."""
+
+        return self.__acquire_each(self.acquire_reader, ids)
+
+    def release_readers(self, leases: List[Tuple[str, int]]) -> None:
+        """Release the (id, lease) readers in one transaction."""
+
+        with self.__connection(write=True):
+            for id, lease in leases:
+                self.release_reader(id, lease)
+
+    def acquire_writers(self, ids: List[str]) -> List[Any]:
+        """Take the writer of each Item of ids in one transaction, see acquire_writer.
+
+        Return the lease id of each one, False if it is busy or None if it doesn't exist."""
+
+        return self.__acquire_each(self.acquire_writer, ids)
+
+    def release_writers(self, writers: List[Tuple[str, int, str, int]]) -> None:
+        """Release the (id, size, archive_path, lease) writers in one transaction, see release_writer."""
+
+        with self.__connection(write=True):
+            for writer in writers:
+                self.release_writer(*writer)
+
+    def acquire_purge(self) -> List[Any]:
+        """Take the writer of every idle Item, but the bases of the busy ones, with a writer lease on each.
+
+        The Items are taken by a single UPDATE, the (id, storage, archive_path,
+        lease) of each one are returned."""
+
+        # The Items neither read nor written, and no base (even indirect) of such an Item.
+        idle = (
+            'WITH RECURSIVE pinned(id) AS ('
+            'SELECT base_id FROM items WHERE base_id IS NOT NULL AND (writer = 1 OR readers > 0) '
+            'UNION SELECT items.base_id FROM items JOIN pinned ON items.id = pinned.id WHERE items.base_id IS NOT NULL) '
+            '{} items {} WHERE writer = 0 AND readers = 0 AND id NOT IN pinned')
+        with self.__connection(write=True) as connection:
+            items = connection.execute(idle.format('SELECT id, storage, archive_path FROM', '')).fetchall()
+            connection.execute(idle.format('UPDATE', 'SET writer = 1'))
+            return [(id, storage, archive_path, self.__add_lease(connection, id, 'writer')) for id, storage, archive_path in items]
+
+    def purge(self, ids: List[str], remove_blobs: Callable[[List[str]], None] = None) -> None:
+        """Delete the given Items with their manifests, deletions, trees and leases in one transaction.
+
+        The references of the cas Items on their blobs are released, the blobs
+        not referenced anymore are given to remove_blobs before the commit (see
+        remove_manifest)."""
+
+        with self.__connection(write=True) as connection:
+            connection.execute('CREATE TEMP TABLE IF NOT EXISTS purged (id VARCHAR PRIMARY KEY)')
+            connection.execute('DELETE FROM purged')
+            connection.executemany('INSERT OR IGNORE INTO purged (id) VALUES (:id)', [{'id': id} for id in ids])
+            references = (
+                "SELECT DISTINCT manifests.entry_id, manifests.hash FROM manifests JOIN items ON items.id = manifests.entry_id "
+                "WHERE items.storage = 'cas' AND manifests.hash IS NOT NULL AND manifests.entry_id IN purged")
+            connection.execute(
+                f'UPDATE blobs SET refcount = refcount - (SELECT COUNT(*) FROM ({references}) AS r WHERE r.hash = blobs.hash) '
+                f'WHERE hash IN (SELECT hash FROM ({references}))')
+            unused = [h for h, in connection.execute('SELECT hash FROM blobs WHERE refcount <= 0')]
+            connection.execute('DELETE FROM blobs WHERE refcount <= 0')
+            for table in ['manifests', 'deletions', 'trees', 'leases']:
+                connection.execute(f'DELETE FROM {table} WHERE entry_id IN purged')
+            connection.execute('DELETE FROM items WHERE id IN purged')
+            connection.execute('DELETE FROM purged')
+            if unused and remove_blobs:
+                remove_blobs(unused)
+
+    def leases(self, id: str = None) -> List[Any]:
+        """Return the leases of the Item id, or of all the Items."""
+
+        with self.__connection() as connection:
+            return self.__records(connection.execute(
+                'SELECT * FROM leases '
+                f"{'WHERE entry_id = :id ' if id else ''}ORDER BY entry_id, rowid",
+                {'id': id}))
+
+    @staticmethod
+    def lease_state(lease) -> str:
+        """Return 'expired', 'dead' (its process doesn't run anymore on this host) or 'alive'."""
+
+        if lease.expires < time.time():
+            return 'expired'
+        if lease.hostname == socket.gethostname() and not pid_alive(lease.pid):
+            return 'dead'
+        return 'alive'
+
+    def renew(self, leases: List[int]) -> None:
+        """Extend the given leases by LEASE_DURATION."""
+
+        with self.__connection(write=True) as connection:
+            connection.executemany(
+                'UPDATE leases SET expires = :expires WHERE rowid = :lease',
+                [{'expires': time.time() + self.LEASE_DURATION, 'lease': lease} for lease in leases])
+
+    @contextmanager
+    def keep(self, *leases: int) -> Iterator[None]:
+        """Renew the given leases in the background during the block."""
+
+        stop = threading.Event()
+
+        def _renew():
+            while not stop.wait(self.LEASE_DURATION / 3):
+                try:
+                    self.renew(list(leases))
+                except Exception as e:
+                    logging.warning(f'Impossible to renew a lease: {e}')
+
+        thread = threading.Thread(target=_renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def record_wait(self, id: str, kind: str, seconds: float) -> None:
+        """Add a wait of the given seconds for the lock of the given kind of the Item id to its stats."""
+
+        params = {'id': id, 'kind': kind, 'seconds': seconds}
+        with self.__connection(write=True) as connection:
+            connection.execute(
+                'INSERT OR IGNORE INTO lock_stats (entry_id, kind, waits, total, max) VALUES (:id, :kind, 0, 0, 0)',
+                params)
+            connection.execute(
+                'UPDATE lock_stats SET waits = waits + 1, total = total + :seconds, max = MAX(max, :seconds) '
+                'WHERE entry_id = :id AND kind = :kind',
+                params)
+
+    def lock_stats(self, id: str = None) -> List[Any]:
+        """Return the lock wait stats of the Item id, or of all the Items."""
+
+        LockStat = self.__models.LockStat
+        with self.transaction() as session:
+            query = session.query(LockStat)
+            if id:
+                query = query.filter(LockStat.entry_id == id)
+            return query.order_by(LockStat.entry_id, LockStat.kind).all()
+
+    def reclaim(self, id: str = None) -> List[Any]:
+        """Drop the expired leases and the ones of dead processes, of the Item id or of all the Items.
+
+        The readers and writer they held are released, the dropped leases are returned."""
+
+        with self.__connection(write=True) as connection:
+            reclaimed = [lease for lease in self.leases(id) if self.lease_state(lease) != 'alive']
+            for lease in reclaimed:
+                connection.execute('DELETE FROM leases WHERE rowid = :lease', {'lease': lease.rowid})
+                if lease.kind == 'writer':
+                    connection.execute('UPDATE items SET writer = 0 WHERE id = :id', {'id': lease.entry_id})
+                else:
+                    connection.execute(
+                        'UPDATE items SET readers = readers - 1 WHERE id = :id AND readers > 0',
+                        {'id': lease.entry_id})
+        return reclaimed
+
     def delete(self, id: str):
         """Delete a db Item based on its id."""
 
-        with Session(self.__engine) as session:
-            try:
-                session.query(self.Item).filter(self.Item.id.in_([id])).delete()
-                session.commit()
-                logging.info(f'"{id}" have been removed from cache db.')
-            except Exception as e:
-                raise XtremCacheRemoveError(e)
+        try:
+            with self.__connection(write=True) as connection:
+                connection.execute('DELETE FROM items WHERE id = :id', {'id': id})
+                connection.execute('DELETE FROM leases WHERE entry_id = :id', {'id': id})
+            logging.info(f'"{id}" have been removed from cache db.')
+        except Exception as e:
+            raise XtremCacheRemoveError(e)
 
     def delete_all(self):
         """Delete all db Items."""
 
-        with Session(self.__engine) as session:
-            try:
-                session.query(self.Item).delete()
-                session.commit()
-            except Exception as e:
-                session.rollback()
-                raise XtremCacheRemoveError(e)
+        try:
+            with self.__connection(write=True) as connection:
+                connection.execute('DELETE FROM items')
+                connection.execute('DELETE FROM leases')
+        except Exception as e:
+            raise XtremCacheRemoveError(e)
 
     def get_all_values(self, member: str) -> List[Any]:
         """Return a list of the values of all Items member."""
 
-        with Session(self.__engine) as session:
-            try:
+        try:
+            with self.transaction() as session:
                 values = session.query(member).all()
-            except Exception as e:
-                raise XtremCacheItemNotFoundError('anything')
+        except Exception as e:
+            raise XtremCacheItemNotFoundError('anything')
         return list(map(lambda v: v[0], values))
 
+    def existing(self, ids: Iterable[str]) -> Set[str]:
+        """Return the given ids of existing Items."""
+
+        ids = list(ids)
+        existing = set()
+        with self.__connection() as connection:
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i+500]
+                existing.update(id for id, in connection.execute(
+                    f"SELECT id FROM items WHERE id IN ({', '.join('?' * len(chunk))})", chunk))
+        return existing
+
+    def items(self) -> List[Any]:
+        """Return all the db Items, the oldest first."""
+
+        with self.transaction() as session:
+            return session.query(self.Item).order_by(self.Item.created_date.asc()).all()
+
     @property
     def oldest(self):
         """Return the older db Item."""
 
-        with Session(self.__engine) as session:
-            try:
-                item = session.query(self.Item).order_by(self.Item.created_date.asc()).first()
-            except Exception as e:
-                raise XtremCacheItemNotFoundError('the oldest item')
-        return item
+        try:
+            with self.transaction() as session:
+                return session.query(self.Item).order_by(self.Item.created_date.asc()).first()
+        except Exception as e:
+            raise XtremCacheItemNotFoundError('the oldest item')
+
+    # Index walked by each eviction policy.
+    __EVICTION_ORDERS = {
+        'lru': 'last_access',
+        'lfu': 'hit_count, last_access',
+        'fifo': 'created_date',
+        'gdsf': 'priority'
+    }
+
+    def victims(self, policy: str = 'lru', limit: int = 1, keep: Iterable[str] = ()) -> List[ItemRow]:
+        """Return up to limit idle Items (neither read, written nor used as a base), the first to evict first.
+
+        The policy orders them by last access (lru), hit count then last access
+        (lfu), creation (fifo) or GDSF priority (gdsf). Each order is an index
+        walked until limit idle Items are found. The Items in keep are never returned."""
+
+        keep = list(keep)
+        kept = f"AND id NOT IN ({', '.join('?' * len(keep))}) " if keep else ''
+        with self.__connection() as connection:
+            return self.__records(connection.execute(
+                'SELECT * FROM items WHERE readers = 0 AND writer = 0 '
+                'AND NOT EXISTS (SELECT 1 FROM items AS delta WHERE delta.base_id = items.id) '
+                f'{kept}ORDER BY {self.__EVICTION_ORDERS[policy]} LIMIT ?',
+                keep + [limit]), ItemRow)
+
+    def age(self, priority: float) -> None:
+        """Advance the GDSF clock to the priority of an evicted Item, the next accesses weigh more than the old ones."""
+
+        if priority is None:
+            return
+        with self.__connection(write=True) as connection:
+            connection.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('gdsf_clock', 0)")
+            connection.execute(
+                "UPDATE counters SET value = MAX(value, :priority) WHERE name = 'gdsf_clock'",
+                {'priority': priority})
+
+    @property
+    def content_size(self) -> int:
+        """Size in bytes of all the archives, blobs and extracted trees in cache, kept up to date by the database."""
+
+        with self.__connection() as connection:
+            return int(connection.execute("SELECT value FROM counters WHERE name = 'content_size'").fetchone()[0])
+
+    def reconcile(self) -> int:
+        """Compute the content size again from the sizes of all the archives, blobs and trees.
+
+        Return the drift of the maintained one, which is corrected."""
+
+        with self.__connection(write=True) as connection:
+            content_size = self.content_size
+            connection.execute(f"UPDATE counters SET value = {self.__CONTENT_SIZE} WHERE name = 'content_size'")
+            return self.content_size - content_size
+
+    def archives(self, ids: List[str] = None) -> List[Tuple[str, str]]:
+        """Return the (id, archive_path) of the Items stored in an archive, only the ones of ids if given."""
+
+        statement = "SELECT id, archive_path FROM items WHERE storage != 'cas' AND archive_path IS NOT NULL AND archive_path != ''"
+        if ids is not None:
+            ids = list(ids)
+            statement += f" AND id IN ({', '.join('?' * len(ids))})"
+        with self.__connection() as connection:
+            return connection.execute(statement, ids or []).fetchall()
+
+    def switch_archives(self, moves: List[Tuple[str, str, str]]) -> List[str]:
+        """Switch each (id, archive_path, new_path) Item to its new archive path in one transaction, return the ids switched.
+
+        An Item is only switched if it is not written and still at archive_path,
+        its archive must already be under new_path. The old path is kept for
+        the readers which already got it (see release_archives)."""
+
+        switched = []
+        with self.__connection(write=True) as connection:
+            for id, archive_path, new_path in moves:
+                if connection.execute(
+                        'UPDATE items SET archive_path = :new_path WHERE id = :id AND writer = 0 AND archive_path = :archive_path',
+                        {'id': id, 'archive_path': archive_path, 'new_path': new_path}).rowcount:
+                    switched.append(id)
+        return switched
+
+    def release_archives(self, paths: List[Tuple[str, str]]) -> Tuple[List[Tuple[str, str]], List[Tuple[str, str]]]:
+        """Split the (id, path) former archive paths between the ones no process can be using anymore and the others.
+
+        A former path is used while its Item, or a delta based on it, is read
+        or written. The current archive path of an Item is never released.
+        Once it is not the archive path of its Item, no new reader gets a
+        former path: it can be removed after the transaction."""
+
+        # The Items read or written, and their bases (even indirect).
+        in_use = (
+            'WITH RECURSIVE busy(id) AS ('
+            'SELECT id FROM items WHERE writer = 1 OR readers > 0 '
+            'UNION SELECT items.base_id FROM items JOIN busy ON items.id = busy.id WHERE items.base_id IS NOT NULL) '
+            'SELECT id FROM busy')
+        free, used = [], []
+        with self.__connection() as connection:
+            busy = {id for id, in connection.execute(in_use)}
+            for id, path in paths:
+                current = connection.execute('SELECT archive_path FROM items WHERE id = :id', {'id': id}).fetchone()
+                if id in busy:
+                    used.append((id, path))
+                elif not current or current[0] != path:
+                    free.append((id, path))
+        return free, used
+
+    def compression_ratio(self, member_overhead: int = 0, count: int = 32) -> Optional[float]:
+        """Return the ratio of the size of the last count full archives cached to the size of their input, None without any.
+
+        The input size is the one of their files plus member_overhead bytes by member, as estimated before archiving."""
+
+        with self.__connection() as connection:
+            archived, input = connection.execute(
+                'SELECT SUM(recent.size), SUM((SELECT SUM(size) + :overhead * COUNT(*) FROM manifests WHERE entry_id = recent.id)) '
+                'FROM (SELECT id, size FROM items '
+                "WHERE writer = 0 AND storage = 'archive' AND base_id IS NULL "
+                'AND EXISTS (SELECT 1 FROM manifests WHERE entry_id = items.id) '
+                'ORDER BY created_date DESC LIMIT :count) AS recent',
+                {'overhead': member_overhead, 'count': count}).fetchone()
+        return archived / input if input else None
+
+    def bases(self) -> Dict[str, str]:
+        """Return the base id of each delta Item."""
+
+        with self.__connection() as connection:
+            return dict(connection.execute('SELECT id, base_id FROM items WHERE base_id IS NOT NULL'))
+
+    def dependents(self, id: str) -> List[str]:
+        """Return the ids of the delta Items based on id."""
+
+        with self.__connection() as connection:
+            return [i for i, in connection.execute('SELECT id FROM items WHERE base_id = :id', {'id': id})]
+
+    def add_deletions(self, id: str, paths: List[str]) -> None:
+        """Record the paths of its base removed in the delta Item id."""
+
+        if not paths:
+            return
+        with self.__connection(write=True) as connection:
+            connection.executemany(
+                'INSERT INTO deletions (entry_id, path) VALUES (:id, :path)',
+                [{'id': id, 'path': p} for p in paths])
+
+    def deletions(self, id: str) -> List[str]:
+        """Return the paths of its base removed in the delta Item id."""
+
+        with self.__connection() as connection:
+            return [p for p, in connection.execute('SELECT path FROM deletions WHERE entry_id = :id', {'id': id})]
+
+    def delete_deletions(self, id: str) -> None:
+        """Forget the removed paths of the delta Item id."""
+
+        with self.__connection(write=True) as connection:
+            connection.execute('DELETE FROM deletions WHERE entry_id = :id', {'id': id})
+
+    def add_tree(self, id: str, size: int) -> None:
+        """Record the extracted tree of id."""
+
+        with self.__connection(write=True) as connection:
+            # An upsert, a replace would not run the delete trigger of the content size.
+            connection.execute(
+                'INSERT INTO trees (entry_id, size) VALUES (:id, :size) '
+                'ON CONFLICT (entry_id) DO UPDATE SET size = excluded.size',
+                {'id': id, 'size': size})
+
+    def delete_tree(self, id: str) -> None:
+        """Forget the extracted tree of id."""
+
+        with self.__connection(write=True) as connection:
+            connection.execute('DELETE FROM trees WHERE entry_id = :id', {'id': id})
+
+    def missing_blobs(self, hashes: Iterable[str]) -> Set[str]:
+        """Return the given hashes not known as blobs."""
+
+        hashes = list(hashes)
+        missing = set(hashes)
+        with self.__connection() as connection:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i+500]
+                missing.difference_update(h for h, in connection.execute(
+                    f"SELECT hash FROM blobs WHERE hash IN ({', '.join('?' * len(chunk))})", chunk))
+        return missing
+
+    def add_manifest(self, id: str, entries: List[Dict], blobs: bool = True) -> None:
+        """Record the manifest of id.
+
+        With blobs, the files are stored as blobs and a reference is taken on each of them."""
+
+        blobs = {e['hash']: e['size'] for e in entries if e['hash']} if blobs else {}
+        with self.__connection(write=True) as connection:
+            connection.executemany(
+                'INSERT INTO manifests (entry_id, path, kind, mode, mtime, size, hash, link) '
+                'VALUES (:entry_id, :path, :kind, :mode, :mtime, :size, :hash, :link)',
+                [dict({k: e[k] for k in ['path', 'kind', 'mode', 'mtime', 'size', 'hash', 'link']}, entry_id=id) for e in entries])
+            if blobs:
+                connection.executemany(
+                    'INSERT OR IGNORE INTO blobs (hash, size, refcount) VALUES (:hash, :size, 0)',
+                    [{'hash': h, 'size': size} for h, size in blobs.items()])
+                connection.executemany(
+                    'UPDATE blobs SET refcount = refcount + 1 WHERE hash = :hash',
+                    [{'hash': h} for h in blobs])
+
+    def add_manifests(self, manifests: List[Tuple[str, List[Dict]]], blobs: bool = True) -> None:
+        """Record the (id, entries) manifests in one transaction, see add_manifest."""
+
+        with self.__connection(write=True):
+            for id, entries in manifests:
+                self.add_manifest(id, entries, blobs)
+
+    def manifest(self, id: str) -> List[Any]:
+        """Return the manifest entries of id, parents before children."""
+
+        with self.__connection() as connection:
+            return self.__records(connection.execute(
+                'SELECT * FROM manifests WHERE entry_id = :id ORDER BY path', {'id': id}))
+
+    def unique_size(self, id: str) -> int:
+        """Size in bytes of the blobs only referenced by id."""
+
+        with self.__connection() as connection:
+            return connection.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM blobs WHERE refcount = 1 '
+                'AND hash IN (SELECT hash FROM manifests WHERE entry_id = :id)',
+                {'id': id}).fetchone()[0]
+
+    def remove_manifest(self, id: str, remove_blobs: Callable[[List[str]], None] = None) -> None:
+        """Delete the manifest of id.
+
+        With remove_blobs, its blobs references are released and the blobs not
+        referenced anymore are given to remove_blobs before the commit, so no
+        other manifest can reference them in the meantime."""
+
+        with self.__connection(write=True) as connection:
+            hashes = [h for h, in connection.execute(
+                'SELECT DISTINCT hash FROM manifests WHERE entry_id = :id AND hash IS NOT NULL',
+                {'id': id})] if remove_blobs else []
+            connection.execute('DELETE FROM manifests WHERE entry_id = :id', {'id': id})
+            if hashes:
+                connection.executemany(
+                    'UPDATE blobs SET refcount = refcount - 1 WHERE hash = :hash',
+                    [{'hash': h} for h in hashes])
+                unused = [h for h, in connection.execute('SELECT hash FROM blobs WHERE refcount <= 0')]
+                connection.execute('DELETE FROM blobs WHERE refcount <= 0')
+                remove_blobs(unused)
@@ -0,0 +1,148 @@
+import os
+import shutil
+import stat
+import tempfile
+from typing import Dict, List, Set
+
+from xtremcache.bddmanager import BddManager
+from xtremcache.utils import *
+
+
+class BlobManager():
+    """Content addressed store: the content of each file is stored once, named by its hash.
+
+    Each cached id is a manifest in the database referencing these blobs, so
+    the files shared by several ids are stored only once. Blobs are reference
+    counted and removed with the last manifest using them."""
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir: str, bdd_manager: BddManager) -> None:
+        self.__blob_dir = os.path.join(cache_dir, 'blobs')
+        self.__bdd_manager = bdd_manager
+
+    def blob_path(self, hash: str) -> str:
+        """Convert a content hash into the blob path."""
+
+        return os.path.join(self.__blob_dir, hash[:2], hash)
+
+    def hash_file(self, path: str) -> str:
+        """Return the content hash of the given file."""
+
+        return hash_file(path, self.BUFFER_SIZE)
+
+    def scan(self, src_path: str, excluded: List[str] = []) -> List[Dict]:
+        """Return the manifest entries of the file or dir at the given path."""
+
+        entries = []
+        for full_path, name in walk_tree(src_path, excluded):
+            entry = manifest_entry(full_path, name, os.lstat(full_path))
+            if entry is None:
+                continue
+            if entry['kind'] == 'file':
+                entry['hash'] = self.hash_file(full_path)
+                entry['source'] = full_path
+            entries.append(entry)
+        return entries
+
+    def __store(self, entry: Dict) -> None:
+        """Copy the source of the entry as a blob, if it is not already there."""
+
+        blob_path = self.blob_path(entry['hash'])
+        if os.path.exists(blob_path):
+            return
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob_path), suffix='.tmp')
+        try:
+            with open(fd, 'wb') as dst, open(entry['source'], 'rb') as src:
+                shutil.copyfileobj(src, dst, self.BUFFER_SIZE)
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(tmp_path, blob_path)
+        except Exception as e:
+            os.remove(tmp_path)
+            raise e
+
+    def cache(self, id: str, src_path: str, excluded: List[str] = [], max_size: int = None) -> int:
+        """Store the file or dir at the given path as the manifest of id.
+
+        With max_size, XtremCacheMaxSizeCachedError is raised before any copy
+        if the missing blobs are bigger than this size in bytes.
+        Return the size of the blobs only referenced by this id."""
+
+        if not os.path.exists(src_path):
+            raise XtremCacheFileNotFoundError(src_path)
+        bdd = self.__bdd_manager
+        try:
+            entries = self.scan(src_path, excluded)
+            files = {e['hash']: e for e in entries if e['kind'] == 'file'}
+            missing = bdd.missing_blobs(files)
+            if max_size is not None and sum(files[hash]['size'] for hash in missing) > max_size:
+                raise XtremCacheMaxSizeCachedError(id)
+            for hash in missing:
+                self.__store(files[hash])
+            bdd.add_manifest(id, entries)
+            # A blob seen as stored may have been reclaimed by a concurrent
+            # remove before being referenced by this manifest.
+            for entry in files.values():
+                self.__store(entry)
+        except XtremCacheMaxSizeCachedError as e:
+            raise e
+        except Exception as e:
+            raise XtremCacheArchiveCreationError(id, e)
+        return bdd.unique_size(id)
+
+    def uncache(self, id: str, path: str, include: List[str] = None, members: Set[str] = None) -> None:
+        """Restore the manifest of id at the given path.
+
+        With include and members, only the entries selected by these globs and
+        names are restored. Only the errors reading the blobs raise
+        XtremCacheArchiveExtractionError, the OSError raised writing the
+        destination are raised unchanged."""
+
+        included = include_filter(include, members)
+        try:
+            os.makedirs(path, exist_ok=True)
+            path = os.path.abspath(path)
+            dirs = []
+            for entry in self.__bdd_manager.manifest(id):
+                if not included(entry.path):
+                    continue
+                target = safe_join(path, entry.path)
+                if entry.kind == 'dir':
+                    os.makedirs(target, exist_ok=True)
+                    dirs.append((target, entry))
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                # Replaced rather than written through, a read only file can't be opened for writing.
+                if os.path.islink(target) or os.path.isfile(target):
+                    os.remove(target)
+                if entry.kind == 'link':
+                    os.symlink(entry.link, target)
+                    continue
+                shutil.copyfile(self.blob_path(entry.hash), target)
+                os.chmod(target, entry.mode)
+                os.utime(target, (entry.mtime, entry.mtime))
+            for target, entry in reversed(dirs):
+                os.chmod(target, entry.mode)
+                os.utime(target, (entry.mtime, entry.mtime))
+        except OSError as e:
+            if not (isinstance(e.filename, str) and e.filename.startswith(self.__blob_dir + os.sep)):
+                # The destination can't be written, the blobs are not at fault.
+                raise e
+            raise XtremCacheArchiveExtractionError(path, e)
+        except Exception as e:
+            raise XtremCacheArchiveExtractionError(path, e)
+
+    def remove(self, id: str) -> None:
+        """Remove the manifest of id and the blobs not referenced anymore."""
+
+        def _remove_blobs(hashes: List[str]) -> None:
+            for hash in hashes:
+                blob_path = self.blob_path(hash)
+                if os.path.exists(blob_path):
+                    os.remove(blob_path)
+
+        try:
+            self.__bdd_manager.remove_manifest(id, _remove_blobs)
+        except Exception as e:
+            raise XtremCacheArchiveRemovingError(id, e)
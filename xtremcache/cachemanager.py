@@ -1,11 +1,27 @@
+import datetime
+import inspect
+import json
 import logging
 import os
+import shutil
+import stat
+import subprocess
+import sys
+import threading
 import time
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from itertools import groupby
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
 
-from xtremcache.archivermanager import create_archiver
+from xtremcache.archivermanager import MAX_SHARD_DEPTH, create_archiver, shard_path
 from xtremcache.bddmanager import BddManager
-from xtremcache.configuration import ConfigurationLevel, ConfigurationManager
+from xtremcache.blobmanager import BlobManager
+from xtremcache.configuration import ConfigurationLevel, ConfigurationManager, raw_to_small_size
+from xtremcache.deltamanager import DeltaManager
+from xtremcache.lockmanager import LockManager
+from xtremcache.syncmanager import SyncManager
+from xtremcache.treemanager import TreeManager
 from xtremcache.utils import *
 
 
@@ -19,22 +35,73 @@ class CacheManager():
     _DELAY_TIME = 0.5
     _DEFAULT_TIMEOUT = 60
 
-    def __init__(self, cache_dir: str = None, max_size: str = None, log_level: int = logging.WARNING) -> None:
-        self.__config = ConfigurationManager(cache_dir=cache_dir, max_size=max_size)
-        self.__archiver = create_archiver(self.__config.cache_dir)
+    # Shorter waits for a lock are not recorded in its stats.
+    _CONTENDED_WAIT = 0.001
+
+    # Number of eviction candidates selected by query.
+    _EVICTION_BATCH = 16
+
+    # Number of archives moved by transaction when resharding.
+    _RESHARD_BATCH = 256
+
+    # Number of entries of cache_many, uncache_many and remove_many taken and released by transaction.
+    _MANY_BATCH = 64
+
+    # Bytes of the headers of an archive member, besides its name (zip local and central headers with their extra fields).
+    _MEMBER_OVERHEAD = 128
+
+    def __init__(
+            self,
+            cache_dir: str = None,
+            max_size: str = None,
+            log_level: int = logging.WARNING,
+            detach_eviction: bool = False,
+            **settings) -> None:
+        """With detach_eviction, the background eviction runs in a detached process
+        instead of a thread, so that a short lived process exits right away."""
+
+        self.__detach_eviction = detach_eviction
+        self.__log_level = log_level
+        self.__config = ConfigurationManager(cache_dir=cache_dir, max_size=max_size, **settings)
         logging.basicConfig(
             level=log_level,
             format='[xtremcache %(levelname)s - %(asctime)s]: %(message)s',
             datefmt='%H:%M:%S')
-        self.__bdd_manager = BddManager(self.__config.cache_dir, log_level)
+        self.__load()
+        self.__eviction_lock = threading.Lock()
+        self.__eviction_thread = None
+        self.__eviction_pending = False
+        self.__eviction_keep = set()
+        self.__deferred_keep = None
+
+    def __load(self) -> None:
+        """Resolve the configuration and build the managers from its values.
+
+        Resolved once, again only after a set_* call."""
+
+        self.__settings = self.__config.snapshot
+        self.__archiver = create_archiver(
+            self.__settings.cache_dir,
+            self.__settings.archiver,
+            self.__settings.archive_format,
+            self.__settings.workers,
+            self.__settings.shard_depth)
+        self.__bdd_manager = BddManager(self.__settings.cache_dir, self.__log_level)
+        self.__blob_manager = BlobManager(self.__settings.cache_dir, self.__bdd_manager)
+        self.__delta_manager = DeltaManager(self.__settings.cache_dir, self.__bdd_manager, self.__archiver)
+        self.__tree_manager = TreeManager(
+            self.__settings.cache_dir,
+            self.__bdd_manager,
+            self.__settings.tree_store == 'hardlink')
+        self.__lock_manager = LockManager(self.__settings.cache_dir)
 
     @property
     def cache_dir(self):
-        return self.__config.cache_dir
+        return self.__settings.cache_dir
 
     @property
     def max_size(self):
-        return self.__config.max_size
+        return self.__settings.max_size
 
     def cache(
             self,
@@ -43,134 +110,1085 @@ class CacheManager():
             force: bool = False,
             compression_level: int = 6,
             excluded: List[str] = [],
-            timeout: int = _DEFAULT_TIMEOUT) -> None:
-        """Put the file or dir at the given path in cache."""
+            timeout: int = _DEFAULT_TIMEOUT,
+            base_id: str = None) -> None:
+        """Put the file or dir at the given path in cache.
+
+        With base_id, only the differences with this cached archive are stored
+        and the base can't be removed while this delta is cached.
+        The input is measured first: room is made for it, and an entry that
+        can't fit is rejected before being archived. The archiving is aborted
+        as soon as the entry outgrows the cache."""
 
         def _cache(
                 id: str,
                 path: str,
                 force: bool,
                 compression_level: int = 6,
-                excluded: List[str] = []) -> None:
+                excluded: List[str] = []) -> bool:
             bdd = self.__bdd_manager
-            cache_dir = self.cache_dir
-            archiver = self.__archiver
-            try:
-                item = bdd.get(id)
-            except XtremCacheItemNotFoundError:
-                item = bdd.get(id, create=True)
-                try:
-                    archive_path = archiver.archive(
-                        id,
-                        path,
-                        compression_level,
-                        excluded)
-                except Exception as e:
-                    item.writer = False
-                    bdd.update(item)
-                    self.remove(id)
-                    raise e
+            storage = self.__settings.storage
+            if base_id == id:
+                raise XtremCacheInputError(f'"{id}" can\'t be its own base')
+            with self.__lock_manager.lock(id, True, self.__remaining(deadline)) as waited:
+                self.__record_wait(id, 'writer', waited)
+                lease = bdd.acquire_new(id, storage, base_id if storage != 'cas' else None)
+                if lease:
+                    with bdd.keep(lease):
+                        # The entry can't use more than the room left by the database.
+                        limit = self.max_size - bdd.size
+                        try:
+                            size, archive_path, manifest, deleted = self.__store(
+                                id, path, compression_level, excluded, base_id, limit)
+                            if manifest:
+                                bdd.add_manifest(id, manifest, blobs=False)
+                            bdd.add_deletions(id, deleted)
+                        except Exception as e:
+                            bdd.release_writer(id, lease=lease)
+                            self.remove(id)
+                            raise e
+                        else:
+                            bdd.release_writer(id, size, archive_path, lease)
+                            logging.info(f'"{id}" is cached.')
+                            if size >= (self.max_size - bdd.size):
+                                self.remove(id)
+                                raise XtremCacheMaxSizeCachedError(id)
+                            return True
+                elif self.__reclaim(id):
+                    # The entry was left by a dead process.
+                    return _cache(id, path, force, compression_level, excluded)
                 else:
-                    item.size = os.path.getsize(archive_path)
-                    item.writer = False
-                    item.archive_path = os.path.relpath(archive_path, cache_dir)
-                    bdd.update(item)
-                    logging.info(f'"{id}" is cached.')
-                    if item.size < (self.max_size - bdd.size):
-                        self.__max_size_cleaning()
-                    else:
+                    if force:
                         self.remove(id)
-                        raise XtremCacheMaxSizeCachedError(id)
-            else:
-                if force:
-                    self.remove(id)
-                    _cache(id, path, False)
-                else:
-                    raise XtremCacheAlreadyCachedError(id)
+                        return _cache(id, path, False, compression_level, excluded)
+                    else:
+                        raise XtremCacheAlreadyCachedError(id)
 
-        timeout_exec(timeout, _cache, id, path, force, compression_level, excluded)
+        # The WAL is part of the cache size, it restarts with the next write once written back.
+        self.__bdd_manager.checkpoint('PASSIVE')
+        if not base_id:
+            self.__preflight(id, path, compression_level, excluded, force)
+        deadline = self.__deadline(timeout)
+        if timeout_exec(timeout, _cache, id, path, force, compression_level, excluded):
+            # Once the lock of the entry is released, its readers don't wait for the eviction.
+            self.__evict([id])
 
-    def uncache(self, id: str, path: str, timeout: int = _DEFAULT_TIMEOUT) -> None:
-        """Extract the archive with the given id at the given path."""
+    def __preflight(self, id: str, path: str, compression_level: int, excluded: List[str], force: bool) -> None:
+        """Make room for the entry of the file or dir at path before it is archived.
 
-        def _uncache(id: str, path: str) -> None:
-            bdd = self.__bdd_manager
-            archiver = self.__archiver
+        Its size is estimated by the one of its files plus the headers of its
+        members, the most it takes once compressed or deduplicated. A compressed
+        archive is expected to take this estimate times the compression ratio
+        of the last cached archives. Raise XtremCacheMaxSizeCachedError if the
+        expected size can't fit in the cache."""
+
+        if not os.path.exists(path):
+            return
+        if not force:
             try:
-                item = bdd.get(id)
-            except XtremCacheItemNotFoundError as e:
-                logging.info(f'Impossible to find "{id}"')
-                raise e
-            if item.can_read:
-                item.readers = item.readers + 1
-                bdd.update(item)
+                self.__bdd_manager.get(id)
+                # Already cached, it is refused without being archived.
+                return
+            except XtremCacheItemNotFoundError:
+                pass
+        bdd = self.__bdd_manager
+        estimate = tree_size(path, excluded, self._MEMBER_OVERHEAD)
+        stored = compression_level == 0 and self.__settings.archive_format == 'zip'
+        if self.__settings.storage != 'cas' and not stored:
+            ratio = bdd.compression_ratio(self._MEMBER_OVERHEAD)
+            if ratio is not None:
+                # Underestimated, the room missing is made once the entry is committed.
+                estimate = int(estimate * min(ratio, 1))
+        if estimate >= self.max_size - bdd.size:
+            raise XtremCacheMaxSizeCachedError(id)
+        if self.__settings.eviction_mode == 'sync' and self.__deferred_keep is None:
+            # In background or in a batch, the eviction runs once the entries are committed.
+            self.__max_size_cleaning(reserve=estimate)
+
+    def __store(
+            self,
+            id: str,
+            path: str,
+            compression_level: int,
+            excluded: List[str],
+            base_id: str,
+            limit: int) -> Tuple[int, Optional[str], List[Dict], List[str]]:
+        """Archive the file or dir at path as the Item id, written by the caller, within limit bytes.
+
+        Return its size, its archive path relative to cache_dir, its manifest
+        and the paths of its base it deleted, left to the caller to record. The
+        cas storage has no archive and records its manifest itself."""
+
+        if self.__settings.storage == 'cas':
+            return self.__blob_manager.cache(id, path, excluded, limit), None, [], []
+        archiver = self.__archiver
+        manifest = []
+        deleted = []
+        if base_id:
+            # The base is pinned by the new Item.
+            base = self.__bdd_manager.get(base_id)
+            if base.writer or base.storage == 'cas':
+                raise XtremCacheInputError(f'"{base_id}" can\'t be used as a base')
+            deltas = self.__delta_manager
+            changed, deleted = deltas.diff(deltas.listing(base), path, excluded)
+            archive_path = archiver.archive(id, path, compression_level, excluded, changed, manifest, limit)
+        else:
+            archive_path = archiver.archive(
+                id,
+                path,
+                compression_level,
+                excluded,
+                manifest=manifest,
+                max_size=limit)
+        return os.path.getsize(archive_path), os.path.relpath(archive_path, self.cache_dir), manifest, deleted
+
+    def uncache(
+            self,
+            id: str,
+            path: str,
+            timeout: int = _DEFAULT_TIMEOUT,
+            workers: int = None,
+            include: List[str] = None,
+            incremental: bool = False,
+            delete: bool = False) -> None:
+        """Extract the archive with the given id at the given path.
+
+        workers overrides the configured number of extraction threads.
+        With include, only the entries whose path (or the one of a parent dir)
+        matches one of these globs are extracted.
+        With incremental, only the files differing from the ones already at
+        the given path are written. delete implies incremental and also
+        removes the files that are not part of the cached tree from the path."""
+
+        def _uncache(id: str, path: str) -> None:
+            with self.__lock_manager.lock(id, False, self.__remaining(deadline)) as waited:
+                bdd = self.__bdd_manager
+                self.__record_wait(id, 'reader', waited)
                 try:
-                    archiver.extract(id, path)
-                    logging.info(f'"{id}" was uncached to {path}.')
-                except XtremCacheArchiveExtractionError as e:
-                    item.readers = item.readers - 1
-                    bdd.update(item)
-                    self.remove(id)
+                    lease = bdd.acquire_reader(id)
+                except XtremCacheItemNotFoundError as e:
+                    logging.info(f'Impossible to find "{id}"')
                     raise e
-                else:
-                    item.readers = item.readers - 1
-                    bdd.update(item)
-            else:
-                time.sleep(self._DELAY_TIME)
+                if lease:
+                    with bdd.keep(lease):
+                        try:
+                            self.__extract(bdd.get(id), path, workers, include, incremental, delete)
+                            logging.info(f'"{id}" was uncached to {path}.')
+                        except XtremCacheArchiveExtractionError as e:
+                            bdd.release_reader(id, lease)
+                            self.remove(id)
+                            raise e
+                        except Exception as e:
+                            # The destination is faulty, not the cached archive.
+                            bdd.release_reader(id, lease)
+                            raise e
+                        else:
+                            bdd.release_reader(id, lease)
+            if not lease:
+                # Only busy in the database, as after a crash or without file locks.
+                if not self.__reclaim(id):
+                    time.sleep(self._DELAY_TIME)
                 raise FunctionRecallAsked(_uncache)
 
+        deadline = self.__deadline(timeout)
         timeout_exec(timeout, _uncache, id, path)
 
-    def __max_size_cleaning(self, removed_list=None) -> None:
-        """Delete the oldest archives to match the max_size limitation.
-        
-        Return the list of deleted Item."""
+    def __extract(
+            self,
+            item,
+            path: str,
+            workers: int = None,
+            include: List[str] = None,
+            incremental: bool = False,
+            delete: bool = False) -> None:
+        """Extract the Item, read by the caller, at the given path, see uncache."""
+
+        def _restore(item, path: str, include: List[str] = None, members: Set[str] = None) -> None:
+            if item.storage == 'cas':
+                self.__blob_manager.uncache(item.id, path, include, members)
+            else:
+                if item.base_id:
+                    _restore(self.__bdd_manager.get(item.base_id), path, include, members)
+                    self.__delta_manager.remove_deleted(item.id, path, include, members)
+                self.__archiver.extract(
+                    item.id,
+                    path,
+                    os.path.join(self.cache_dir, item.archive_path),
+                    workers,
+                    include,
+                    members)
+
+        def _fill(item, path: str, members: Set[str] = None) -> None:
+            trees = self.__tree_manager
+            tree_store = self.__settings.tree_store
+            if tree_store == 'off' or ((include or members is not None) and not trees.exists(item.id)):
+                # A partial uncache doesn't pay the extraction of the full tree.
+                _restore(item, path, include, members)
+            else:
+                if not trees.exists(item.id):
+                    trees.materialize(item.id, lambda tree_path: _restore(item, tree_path))
+                    self.__evict()
+                trees.uncache(item.id, path, include, members)
+
+        def _sync(item, path: str) -> None:
+            sync = SyncManager(workers or self.__settings.workers)
+            members = self.__delta_manager.listing(item)
+            included = include_filter(include)
+            changed = sync.stale(members, path, included)
+            if delete:
+                sync.remove(path, sync.extra(members, path, included))
+            if changed:
+                _fill(item, path, changed)
+                sync.fix_metadata(members, path, changed)
+            logging.info(f'{len(changed)} entries of "{item.id}" differed from {path}.')
+
+        if incremental or delete:
+            _sync(item, path)
+        else:
+            _fill(item, path)
+
+    def manifest(self, id: str, timeout: int = _DEFAULT_TIMEOUT) -> List[Dict]:
+        """Return the entries of the full tree cached with the given id, sorted by path.
+
+        Each entry is a dict with the path, kind (file, dir or link), size,
+        mode, mtime, content hash (files only) and link target (links only)."""
+
+        def _manifest(id: str) -> List[Dict]:
+            item = self.__bdd_manager.get(id)
+            if not item.can_read:
+                time.sleep(self._DELAY_TIME)
+                raise FunctionRecallAsked(_manifest)
+            return [
+                {
+                    'path': path,
+                    'kind': member.kind,
+                    'size': member.size,
+                    'mode': member.mode,
+                    'mtime': member.mtime,
+                    'hash': member.hash,
+                    'link': member.link,
+                }
+                for path, member in sorted(self.__delta_manager.listing(item).items())
+            ]
+
+        return timeout_exec(timeout, _manifest, id)
+
+    def ls(self, id: str = None) -> None:
+        """Print the cached ids, or the content of the given id, thanks to tabulate lib."""
+
+        from tabulate import tabulate
+
+        if id:
+            kinds = {'file': stat.S_IFREG, 'dir': stat.S_IFDIR, 'link': stat.S_IFLNK}
+            rows = [
+                [
+                    stat.filemode(kinds[e['kind']] | e['mode']),
+                    e['size'],
+                    datetime.datetime.fromtimestamp(e['mtime']).strftime('%Y-%m-%d %H:%M:%S'),
+                    e['hash'] or '',
+                    f"{e['path']} -> {e['link']}" if e['link'] else e['path'],
+                ]
+                for e in self.manifest(id)
+            ]
+            print(tabulate(rows, headers=['mode', 'size', 'mtime', 'hash', 'path']))
+        else:
+            rows = [
+                [i.id, i.size, i.storage, i.base_id or '', i.created_date.strftime('%Y-%m-%d %H:%M:%S')]
+                for i in self.__bdd_manager.items()
+            ]
+            print(tabulate(rows, headers=['id', 'size', 'storage', 'base', 'created']))
+
+    def locks(self, id: str = None, clear: bool = False) -> None:
+        """Print the reader and writer leases of the given id, or of all the ids, thanks to tabulate lib.
+
+        The time waited for their locks is printed too. With clear, the leases of dead processes and the expired ones are
+        reclaimed first, the entries left by a dead writer are removed."""
+
+        from tabulate import tabulate
+
+        bdd = self.__bdd_manager
+        if clear:
+            self.__reclaim(id)
+        rows = [
+            [
+                lease.entry_id,
+                lease.kind,
+                lease.pid,
+                lease.hostname,
+                datetime.datetime.fromtimestamp(lease.expires).strftime('%Y-%m-%d %H:%M:%S'),
+                bdd.lease_state(lease),
+            ]
+            for lease in bdd.leases(id)
+        ]
+        print(tabulate(rows, headers=['id', 'kind', 'pid', 'host', 'expires', 'state']))
+        rows = [
+            [stat.entry_id, stat.kind, stat.waits, f'{stat.total / stat.waits:.3f}', f'{stat.max:.3f}']
+            for stat in bdd.lock_stats(id)
+        ]
+        if rows:
+            print()
+            print(tabulate(rows, headers=['id', 'kind', 'contended waits', 'mean (s)', 'max (s)']))
+
+    def reconcile(self) -> int:
+        """Compute the size of the cache content from scratch, correcting the running total used by the max_size checks.
+
+        Return the drift that was corrected."""
+
+        drift = self.__bdd_manager.reconcile()
+        if drift:
+            logging.warning(f'The cache content size drifted by {drift} bytes, it is corrected.')
+        print(f'Content size: {raw_to_small_size(self.__bdd_manager.content_size)}, drift: {drift} bytes')
+        return drift
+
+    def reshard(self, timeout: int = _DEFAULT_TIMEOUT) -> int:
+        """Move the archives in cache to the dirs of the shard_depth setting, return the number moved.
+
+        The cache stays in use: each archive is hardlinked under its new path,
+        under the shared lock of its Item which holds its writers off, before
+        the database switches to it in a short transaction. Its former path is
+        removed once no reader can be using it. The archives being written and
+        the former paths still in use after timeout seconds are left to the
+        next reshard."""
+
+        bdd = self.__bdd_manager
+        cache_dir = self.cache_dir
+        depth = self.__settings.shard_depth
+
+        def _link(archive_path: str, new_path: str) -> bool:
+            src, dst = os.path.join(cache_dir, archive_path), os.path.join(cache_dir, new_path)
+            try:
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                # Left by an interrupted reshard, the Item is not written.
+                self.__remove_file(dst)
+                try:
+                    os.link(src, dst)
+                except FileNotFoundError:
+                    # Removed behind the cache, its Item fails on the next uncache.
+                    logging.warning(f'{src} is missing, it is not moved.')
+                    return False
+                except OSError:
+                    # No hardlinks on this filesystem.
+                    shutil.copy2(src, dst)
+                return True
+            except OSError as e:
+                logging.warning(f'Unable to move {src} to {dst}: {e}')
+                return False
+
+        moves, former = [], []
+        for id, archive_path in bdd.archives():
+            filename = os.path.basename(archive_path)
+            new_path = shard_path(filename, depth)
+            if archive_path != new_path:
+                moves.append((id, archive_path, new_path))
+            former += [(id, shard_path(filename, d)) for d in range(MAX_SHARD_DEPTH + 1) if d != depth]
+        moved = 0
+        written = 0
+        for i in range(0, len(moves), self._RESHARD_BATCH):
+            batch = moves[i:i + self._RESHARD_BATCH]
+            with self.__try_locks([id for id, *_ in batch], False) as locked:
+                written += len([id for id, *_ in batch if id not in locked])
+                # Read again once locked, the archives listed may have been replaced meanwhile.
+                current = dict(bdd.archives(locked)) if locked else {}
+                linked = [move for move in batch if current.get(move[0]) == move[1] and _link(*move[1:])]
+                switched = set(bdd.switch_archives(linked)) if linked else set()
+                for id, _, new_path in linked:
+                    if id not in switched and dict(bdd.archives([id])).get(id) != new_path:
+                        # Replaced after all, without file locks.
+                        self.__remove_file(os.path.join(cache_dir, new_path))
+            moved += len(switched)
+        if written:
+            logging.warning(f'{written} archives are being written, run reshard again to move them.')
+        former = [(id, path) for id, path in former if os.path.exists(os.path.join(cache_dir, path))]
+        deadline = self.__deadline(timeout)
+        while True:
+            free, former = bdd.release_archives(former)
+            for _, path in free:
+                self.__remove_file(os.path.join(cache_dir, path))
+            if not former or self.__remaining(deadline) == 0:
+                break
+            self.__reclaim()
+            time.sleep(self._DELAY_TIME)
+        if former:
+            logging.warning(f'{len(former)} former archive paths are still in use, run reshard again to remove them.')
+        print(f'Archives moved: {moved}, shard depth: {depth}')
+        return moved
+
+    def __record_wait(self, id: str, kind: str, waited: float) -> None:
+        """Add the seconds waited for the lock of id to its stats, if it was contended."""
+
+        if waited >= self._CONTENDED_WAIT:
+            self.__bdd_manager.record_wait(id, kind, waited)
+
+    @staticmethod
+    def __deadline(timeout: int) -> float:
+        """Return the time at which an operation with the given timeout expires, None without timeout."""
+
+        return time.time() + timeout if timeout else None
+
+    @staticmethod
+    def __remaining(deadline: float) -> float:
+        """Return the seconds left before the deadline, None without deadline."""
+
+        return None if deadline is None else max(0, deadline - time.time())
+
+    def __reclaim(self, id: str = None) -> bool:
+        """Release the leases of id (of all the Items without id) held by dead processes or expired.
+
+        The Items left by a dead writer are incomplete and removed. Return True
+        if a lease was reclaimed."""
+
+        leases = self.__bdd_manager.reclaim(id)
+        for lease in leases:
+            logging.warning(f'The {lease.kind} lease of "{lease.entry_id}" held by {lease.pid} on {lease.hostname} has been reclaimed.')
+            if lease.kind == 'writer':
+                try:
+                    self.remove(lease.entry_id)
+                except XtremCacheItemNotFoundError:
+                    pass
+        return bool(leases)
+
+    def __excess(self, watermark: int, reserve: int = 0) -> int:
+        """Return the bytes to free for the cache, plus reserve bytes, to be below watermark percent of max_size.
+
+        It is raised to the bytes missing on the filesystem of cache_dir to
+        keep min_free_space free."""
+
+        bdd = self.__bdd_manager
+        excess = bdd.content_size + bdd.size + reserve - self.max_size * watermark // 100
+        min_free_space = self.__settings.min_free_space
+        if min_free_space:
+            excess = max(excess, min_free_space + reserve - shutil.disk_usage(self.cache_dir).free)
+        return excess
+
+    def __max_size_cleaning(self, keep: List[str] = [], reserve: int = 0) -> List:
+        """Delete idle Items, in the order of the eviction policy, to match the max_size limitation.
+
+        Nothing is deleted below the high watermark, above it the cache is
+        brought down to the low watermark. reserve bytes are counted as used,
+        to make room for an entry being cached. The Items in keep are never
+        deleted, nor the busy ones. Return the list of deleted Item."""
 
-        if removed_list == None:
-            removed_list = []
         bdd = self.__bdd_manager
-        all_sizes = bdd.get_all_values(bdd.Item.size)
-        all_sizes.append(bdd.size)
-        if len(all_sizes):
-            if sum(all_sizes) >= self.max_size:
-                self.remove(bdd.oldest.id)
-                removed_list.append(bdd.oldest)
-                self.__max_size_cleaning(removed_list)
+        policy = self.__settings.eviction
+        high_watermark = self.__settings.high_watermark
+        low_watermark = min(self.__settings.low_watermark, high_watermark)
+        removed_list = []
+        # The Items held by dead processes would never be idle.
+        self.__reclaim()
+        if self.__excess(high_watermark, reserve) < 0:
+            return removed_list
+        excess = self.__excess(low_watermark, reserve)
+        keep = list(keep)
+        while excess >= 0:
+            victims = bdd.victims(policy, self._EVICTION_BATCH, keep)
+            if not victims:
+                break
+            for victim in victims:
+                if not self.__remove_idle(victim.id):
+                    # Taken meanwhile, the next victims are evicted instead of waiting for it.
+                    keep.append(victim.id)
+                    continue
+                removed_list.append(victim)
+                if policy == 'gdsf':
+                    bdd.age(victim.priority)
+                # Estimated, the blobs and trees freed are measured below.
+                excess -= victim.size
+                if excess < 0:
+                    break
+            excess = self.__excess(low_watermark, reserve)
         return removed_list
 
+    def __evict(self, keep: List[str] = []) -> None:
+        """Run the max_size cleaning, or have it run by the eviction thread in background mode.
+
+        The calls made while the thread runs are merged in its next run, the
+        ones made in a batch are deferred to its end."""
+
+        with self.__eviction_lock:
+            if self.__deferred_keep is not None:
+                self.__deferred_keep.update(keep)
+                return
+        if self.__settings.eviction_mode == 'sync':
+            self.__max_size_cleaning(keep)
+            return
+        if self.__detach_eviction:
+            self.__spawn_eviction()
+            return
+        with self.__eviction_lock:
+            self.__eviction_pending = True
+            self.__eviction_keep.update(keep)
+            if self.__eviction_thread is None:
+                # Not a daemon: the process ends once the eviction is done.
+                self.__eviction_thread = threading.Thread(target=self.__eviction_worker, name='xtremcache-eviction')
+                self.__eviction_thread.start()
+
+    def __spawn_eviction(self) -> None:
+        """Run the evict command in a detached process, with the settings of this manager."""
+
+        env = dict(os.environ)
+        env.update({f'XCACHE_{var.upper()}': str(value) for var, value in self.__settings._asdict().items()})
+        if getattr(sys, 'frozen', False):
+            command = [sys.executable]
+        else:
+            command = [sys.executable, '-m', 'xtremcache']
+            package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+        if is_unix():
+            detached = {'start_new_session': True}
+        else:
+            detached = {'creationflags': subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP}
+        subprocess.Popen(
+            command + ['--quietly', 'evict'],
+            env=env,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            **detached)
+
+    def evict(self) -> None:
+        """Delete idle Items, in the order of the eviction policy, until the cache is below its watermarks.
+
+        The processes evicting this way run one at a time."""
+
+        with self.__lock_manager.eviction_lock():
+            self.__max_size_cleaning()
+
+    def __eviction_worker(self) -> None:
+        """Run the max_size cleaning until no more run is asked."""
+
+        while True:
+            with self.__eviction_lock:
+                if not self.__eviction_pending:
+                    self.__eviction_thread = None
+                    return
+                self.__eviction_pending = False
+                keep, self.__eviction_keep = self.__eviction_keep, set()
+            try:
+                with self.__lock_manager.eviction_lock():
+                    self.__max_size_cleaning(list(keep))
+            except Exception as e:
+                logging.warning(f'Background eviction failed: {e}')
+
+    def wait_eviction(self, timeout: float = None) -> None:
+        """Wait for the end of the background eviction, if it runs."""
+
+        thread = self.__eviction_thread
+        if thread is not None:
+            thread.join(timeout)
+
     def remove(self, id: str = None, timeout: int = _DEFAULT_TIMEOUT) -> None:
         """Delete an archive based on its id."""
 
         def _remove(id: int) -> None:
             bdd = self.__bdd_manager
-            cache_dir = self.cache_dir
-            ids = [id] if id else bdd.get_all_values(bdd.Item.id)
-            if not ids:
-                logging.info('Empty cache, nothing to remove.')
+            ids = [id] if id else list(bdd.existing(skipped))
+            if len(ids) > 1:
+                # Deltas before their bases.
+                bases = bdd.bases()
+                depth = lambda i: 1 + depth(bases[i]) if i in bases else 0
+                ids = sorted(ids, key=depth, reverse=True)
             for id in ids:
+                with self.__lock_manager.lock(id, True, self.__remaining(deadline)) as waited:
+                    self.__record_wait(id, 'writer', waited)
+                    try:
+                        lease = bdd.acquire_writer(id)
+                    except XtremCacheItemNotFoundError as e:
+                        logging.error(f'Unable to find "{id}".')
+                        raise e
+                    if lease:
+                        self.__remove_item(id, lease)
+                    else:
+                        dependents = bdd.dependents(id)
+                        if dependents:
+                            raise XtremCacheBaseInUseError(id, dependents)
+                if not lease:
+                    # Only busy in the database, as after a crash or without file locks.
+                    if not bdd.reclaim(id):
+                        time.sleep(self._DELAY_TIME)
+                    raise FunctionRecallAsked(_remove)
+
+        deadline = self.__deadline(timeout)
+        # Without id, the idle Items are purged at once, only the busy ones are waited for.
+        skipped = set() if id else set(self.purge())
+        if id or skipped:
+            timeout_exec(timeout, _remove, id)
+
+    def __remove_item(self, id: str, lease: int) -> None:
+        """Delete the files and the Item id, whose writer is taken with lease."""
+
+        bdd = self.__bdd_manager
+        with bdd.keep(lease):
+            item = bdd.get(id)
+            try:
+                if item.storage == 'cas':
+                    self.__blob_manager.remove(id)
+                else:
+                    bdd.remove_manifest(id)
+                    self.__remove_file(item.archive_path and os.path.join(self.cache_dir, item.archive_path))
+                self.__tree_manager.remove(id)
+                bdd.delete_deletions(id)
+            except Exception as e:
+                raise XtremCacheArchiveRemovingError(id, e)
+            bdd.delete(item.id)
+
+    def __remove_idle(self, id: str) -> bool:
+        """Delete the Item id if it is idle, return False without waiting if it is busy or already deleted."""
+
+        try:
+            with self.__lock_manager.lock(id, True, 0):
+                lease = self.__bdd_manager.acquire_writer(id)
+                if lease:
+                    self.__remove_item(id, lease)
+                return bool(lease)
+        except (FunctionRecallAsked, XtremCacheItemNotFoundError):
+            return False
+
+    @staticmethod
+    def __remove_file(path: str) -> None:
+        """Delete the given file if any."""
+
+        if path:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __remove_files(self, id: str, storage: str, archive_path: str) -> None:
+        """Delete the archive and the extracted tree of the Item id, its blobs and rows are left to the caller."""
+
+        if storage != 'cas':
+            self.__remove_file(archive_path and os.path.join(self.cache_dir, archive_path))
+        if self.__tree_manager.exists(id):
+            filesystem_remove(self.__tree_manager.tree_path(id))
+
+    def purge(self, workers: int = None) -> List[str]:
+        """Delete all the idle Items at once, return the ids of the ones skipped because busy.
+
+        The idle Items (but the bases of busy deltas) are taken in a single
+        statement, their files are deleted on workers threads and their rows in
+        a single transaction."""
+
+        bdd = self.__bdd_manager
+        self.__reclaim()
+        present = bdd.get_all_values(bdd.Item.id)
+        if not present:
+            logging.info('Empty cache, nothing to remove.')
+            return []
+        taken = bdd.acquire_purge()
+        if taken:
+            workers = min(workers or self.__settings.workers, len(taken))
+            with bdd.keep(*[lease for *_, lease in taken]), ThreadPoolExecutor(max_workers=workers) as executor:
+
+                def _remove_blobs(hashes: List[str]) -> None:
+                    list(executor.map(lambda h: self.__remove_file(self.__blob_manager.blob_path(h)), hashes))
+
                 try:
-                    item = bdd.get(id)
-                except XtremCacheItemNotFoundError as e:
-                    logging.error(f'Unable to find "{id}".')
-                    raise e
-                if item.can_modifie:
-                    item.writer = True
-                    bdd.update(item)
+                    list(executor.map(lambda t: self.__remove_files(*t[:3]), taken))
+                    bdd.purge([id for id, *_ in taken], _remove_blobs)
+                except Exception as e:
+                    raise XtremCacheArchiveRemovingError(', '.join(id for id, *_ in taken), e)
+            logging.info(f'{len(taken)} Items have been removed from cache.')
+        purged = {id for id, *_ in taken}
+        skipped = sorted(bdd.existing(id for id in present if id not in purged))
+        for id in skipped:
+            logging.warning(f'"{id}" is busy and has been skipped.')
+        return skipped
+
+    @contextmanager
+    def __deferred_eviction(self) -> Iterator[None]:
+        """Defer the evictions asked during the block to a single one at its end."""
+
+        with self.__eviction_lock:
+            outer = self.__deferred_keep is None
+            if outer:
+                self.__deferred_keep = set()
+        try:
+            yield
+        finally:
+            if outer:
+                with self.__eviction_lock:
+                    keep, self.__deferred_keep = self.__deferred_keep, None
+                self.__evict(list(keep))
+
+    def __run_many(self, fn: Callable, entries: List[Dict[str, Any]], workers: int = None) -> List[Optional[Exception]]:
+        """Call fn with each entry as kwargs on workers threads, return the error of each call, None on success."""
+
+        def _run(kwargs: Dict[str, Any]) -> Optional[Exception]:
+            try:
+                fn(**kwargs)
+            except Exception as e:
+                logging.error(f'{fn.__name__} {kwargs.get("id")}: {e}')
+                return e
+
+        workers = min(workers or self.__settings.workers, len(entries)) or 1
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_run, entries))
+
+    def __missing(self, entries: List[Dict[str, Any]]) -> List[Optional[Exception]]:
+        """Return XtremCacheItemNotFoundError for the entries whose id isn't cached, looked up in one query."""
+
+        existing = self.__bdd_manager.existing(e.get('id') for e in entries)
+        return [None if e.get('id') in existing else XtremCacheItemNotFoundError(e.get('id')) for e in entries]
+
+    @contextmanager
+    def __try_locks(self, ids: List[str], exclusive: bool) -> Iterator[Set[str]]:
+        """Hold the locks of the given ids which are free during the block, yield these ids.
+
+        The busy ones are not waited for, which could deadlock with another
+        process holding some of the others."""
+
+        locked = set()
+        with ExitStack() as stack:
+            for id in ids:
+                try:
+                    stack.enter_context(self.__lock_manager.lock(id, exclusive, 0))
+                    locked.add(id)
+                except FunctionRecallAsked:
+                    pass
+            yield locked
+
+    @staticmethod
+    def __arguments(fn: Callable, entry: Dict[str, Any]) -> Dict[str, Any]:
+        """Return the arguments of fn called with entry as kwargs, defaults included.
+
+        Raise TypeError as the call would."""
+
+        arguments = inspect.signature(fn).bind(**entry)
+        arguments.apply_defaults()
+        return arguments.arguments
+
+    def __run_chunks(
+            self,
+            run_chunk: Callable,
+            fn: Callable,
+            entries: List[Dict[str, Any]],
+            indexes: List[int],
+            errors: List[Optional[Exception]],
+            workers: int = None) -> None:
+        """Run the entries of indexes by chunks of _MANY_BATCH with run_chunk, then the ones it left with fn, one by one.
+
+        run_chunk(entries, chunk, errors, workers) sets the error of each entry
+        of the chunk it ran and returns the indexes of the other ones: busy or
+        needing a retry, a force or a reclaim."""
+
+        left = []
+        for start in range(0, len(indexes), self._MANY_BATCH):
+            left += run_chunk(entries, indexes[start:start + self._MANY_BATCH], errors, workers)
+        for i, error in zip(left, self.__run_many(fn, [entries[i] for i in left], workers)):
+            errors[i] = error
+
+    def __bind_chunk(
+            self,
+            fn: Callable,
+            entries: List[Dict[str, Any]],
+            chunk: List[int],
+            errors: List[Optional[Exception]]) -> List[Tuple[int, Dict[str, Any]]]:
+        """Return the (index, arguments of fn) of the entries of chunk, setting the error of the invalid ones."""
+
+        bound = []
+        for i in chunk:
+            try:
+                bound.append((i, self.__arguments(fn, entries[i])))
+            except Exception as e:
+                logging.error(f'{fn.__name__} {entries[i].get("id")}: {e}')
+                errors[i] = e
+        return bound
+
+    def __cache_chunk(
+            self,
+            entries: List[Dict[str, Any]],
+            chunk: List[int],
+            errors: List[Optional[Exception]],
+            workers: int = None) -> List[int]:
+        """Cache the entries of chunk, created then committed in one transaction each, see __run_chunks."""
+
+        bdd = self.__bdd_manager
+        storage = self.__settings.storage
+        left = []
+        todo = []
+        # The WAL is part of the cache size, it restarts with the next write once written back.
+        bdd.checkpoint('PASSIVE')
+        for i, arguments in self.__bind_chunk(self.cache, entries, chunk, errors):
+            if arguments['force'] or arguments['base_id'] == arguments['id']:
+                # Replaced or refused by cache itself.
+                left.append(i)
+                continue
+            try:
+                if not arguments['base_id']:
+                    self.__preflight(
+                        arguments['id'], arguments['path'], arguments['compression_level'], arguments['excluded'], False)
+                todo.append((i, arguments))
+            except Exception as e:
+                logging.error(f'cache {arguments["id"]}: {e}')
+                errors[i] = e
+        committed = []
+        with self.__try_locks([a['id'] for _, a in todo], True) as locked:
+            left += [i for i, a in todo if a['id'] not in locked]
+            todo = [(i, a) for i, a in todo if a['id'] in locked]
+            leases = bdd.acquire_new_many(
+                [(a['id'], storage, a['base_id'] if storage != 'cas' else None) for _, a in todo]) if todo else []
+            # Already cached, or twice in the chunk, they are refused, reclaimed or waited for by cache.
+            left += [i for (i, _), lease in zip(todo, leases) if not lease]
+            taken = [(i, a, lease) for (i, a), lease in zip(todo, leases) if lease]
+            if not taken:
+                return left
+            # The entries can't use more than the room left by the database.
+            limit = self.max_size - bdd.size
+
+            def _store(arguments: Dict[str, Any]) -> Any:
+                try:
+                    return self.__store(
+                        arguments['id'],
+                        arguments['path'],
+                        arguments['compression_level'],
+                        arguments['excluded'],
+                        arguments['base_id'],
+                        limit)
+                except Exception as e:
+                    return e
+
+            workers = min(workers or self.__settings.workers, len(taken))
+            with bdd.keep(*[lease for *_, lease in taken]), ThreadPoolExecutor(max_workers=workers) as executor:
+                stored = list(executor.map(lambda t: _store(t[1]), taken))
+                failed = []
+                done = []
+                for (i, arguments, lease), result in zip(taken, stored):
+                    (failed if isinstance(result, Exception) else done).append((i, arguments['id'], lease, result))
+                try:
+                    bdd.add_manifests([(id, result[2]) for _, id, _, result in done if result[2]], blobs=False)
+                    for _, id, _, result in done:
+                        bdd.add_deletions(id, result[3])
+                except Exception as e:
+                    failed += [(i, id, lease, e) for i, id, lease, _ in done]
+                    done = []
+                bdd.release_writers(
+                    [(id, result[0], result[1], lease) for _, id, lease, result in done]
+                    + [(id, None, None, lease) for _, id, lease, _ in failed])
+            for i, id, _, e in failed:
+                logging.error(f'cache {id}: {e}')
+                errors[i] = e
+                try:
+                    self.remove(id)
+                except Exception as e:
+                    errors[i] = e
+            for i, id, _, result in done:
+                if result[0] >= (self.max_size - bdd.size):
+                    errors[i] = XtremCacheMaxSizeCachedError(id)
+                    logging.error(f'cache {id}: {errors[i]}')
+                    self.remove(id)
+                else:
+                    logging.info(f'"{id}" is cached.')
+                    committed.append(id)
+        self.__evict(committed)
+        return left
+
+    def cache_many(self, entries: List[Dict[str, Any]], workers: int = None) -> List[Optional[Exception]]:
+        """Cache each entry, a dict of cache arguments (id, path, force...), on workers threads.
+
+        The entries are created, then committed, by chunks of _MANY_BATCH in a
+        transaction each. The ones to force, busy or already cached are cached
+        one by one afterwards. The cache is cleaned once, after all the entries
+        are cached. Return the error of each entry, None on success."""
+
+        errors = [None] * len(entries)
+        with self.__deferred_eviction():
+            self.__run_chunks(self.__cache_chunk, self.cache, entries, list(range(len(entries))), errors, workers)
+        return errors
+
+    def __uncache_chunk(
+            self,
+            entries: List[Dict[str, Any]],
+            chunk: List[int],
+            errors: List[Optional[Exception]],
+            workers: int = None) -> List[int]:
+        """Uncache the entries of chunk, read and released in one transaction each, see __run_chunks."""
+
+        bdd = self.__bdd_manager
+        left = []
+        todo = self.__bind_chunk(self.uncache, entries, chunk, errors)
+        with self.__try_locks([a['id'] for _, a in todo], False) as locked:
+            left += [i for i, a in todo if a['id'] not in locked]
+            todo = [(i, a) for i, a in todo if a['id'] in locked]
+            leases = bdd.acquire_readers([a['id'] for _, a in todo]) if todo else []
+            taken = []
+            for (i, arguments), lease in zip(todo, leases):
+                if lease is None:
+                    errors[i] = XtremCacheItemNotFoundError(arguments['id'])
+                    logging.info(f'Impossible to find "{arguments["id"]}"')
+                elif lease:
+                    taken.append((i, arguments, lease))
+                else:
+                    # Written, it is waited for by uncache.
+                    left.append(i)
+            if not taken:
+                return left
+
+            def _extract(arguments: Dict[str, Any]) -> Optional[Exception]:
+                try:
+                    self.__extract(
+                        bdd.get(arguments['id']),
+                        arguments['path'],
+                        arguments['workers'],
+                        arguments['include'],
+                        arguments['incremental'],
+                        arguments['delete'])
+                    logging.info(f'"{arguments["id"]}" was uncached to {arguments["path"]}.')
+                except Exception as e:
+                    logging.error(f'uncache {arguments["id"]}: {e}')
+                    return e
+
+            workers = min(workers or self.__settings.workers, len(taken))
+            with bdd.keep(*[lease for *_, lease in taken]), ThreadPoolExecutor(max_workers=workers) as executor:
+                extracted = list(executor.map(lambda t: _extract(t[1]), taken))
+                bdd.release_readers([(a['id'], lease) for _, a, lease in taken])
+            for (i, arguments, _), e in zip(taken, extracted):
+                errors[i] = e
+                if isinstance(e, XtremCacheArchiveExtractionError):
+                    # The cached archive is faulty.
                     try:
-                        c_cwd = os.getcwd()
-                        os.makedirs(cache_dir, exist_ok=True)
-                        os.chdir(cache_dir)
-                        if item.archive_path and os.path.exists(item.archive_path):
-                            os.remove(item.archive_path)
-                        os.chdir(c_cwd)
+                        self.remove(arguments['id'])
                     except Exception as e:
-                        raise XtremCacheArchiveRemovingError(id, e)
-                    bdd.delete(item.id)
+                        errors[i] = e
+        return left
+
+    def uncache_many(self, entries: List[Dict[str, Any]], workers: int = None) -> List[Optional[Exception]]:
+        """Uncache each entry, a dict of uncache arguments (id, path, include...), on workers threads.
+
+        The workers are shared out between the entries to extract them. The
+        readers of the entries are taken, then released, by chunks of
+        _MANY_BATCH in a transaction each, the written ones are uncached one by
+        one afterwards. Return the error of each entry, None on success."""
+
+        workers = workers or self.__settings.workers
+        errors = self.__missing(entries)
+        todo = [i for i, error in enumerate(errors) if error is None]
+        extract_workers = max(1, self.__settings.workers // max(1, min(workers, len(todo))))
+        entries = [dict({'workers': extract_workers}, **entry) for entry in entries]
+        self.__run_chunks(self.__uncache_chunk, self.uncache, entries, todo, errors, workers)
+        return errors
+
+    def __remove_chunk(
+            self,
+            entries: List[Dict[str, Any]],
+            chunk: List[int],
+            errors: List[Optional[Exception]],
+            workers: int = None) -> List[int]:
+        """Remove the entries of chunk, taken and deleted in one transaction each, see __run_chunks."""
+
+        bdd = self.__bdd_manager
+        left = []
+        todo = self.__bind_chunk(self.remove, entries, chunk, errors)
+        with self.__try_locks([a['id'] for _, a in todo], True) as locked:
+            left += [i for i, a in todo if a['id'] not in locked]
+            todo = [(i, a) for i, a in todo if a['id'] in locked]
+            leases = bdd.acquire_writers([a['id'] for _, a in todo]) if todo else []
+            taken = []
+            for (i, arguments), lease in zip(todo, leases):
+                if lease is None:
+                    errors[i] = XtremCacheItemNotFoundError(arguments['id'])
+                    logging.error(f'Unable to find "{arguments["id"]}".')
+                elif lease:
+                    taken.append((i, arguments['id'], lease))
                 else:
-                    time.sleep(self._DELAY_TIME)
-                    raise FunctionRecallAsked(_remove)
+                    # Busy or the base of a delta, it is waited for or refused by remove.
+                    left.append(i)
+            if not taken:
+                return left
+            removed = []
+            failed = []
+            with bdd.keep(*[lease for *_, lease in taken]):
+                for i, id, lease in taken:
+                    try:
+                        item = bdd.get(id)
+                        self.__remove_files(id, item.storage, item.archive_path)
+                        removed.append(id)
+                    except Exception as e:
+                        errors[i] = XtremCacheArchiveRemovingError(id, e)
+                        logging.error(f'remove {id}: {errors[i]}')
+                        failed.append((id, None, None, lease))
 
-        timeout_exec(timeout, _remove, id)
+                def _remove_blobs(hashes: List[str]) -> None:
+                    for hash in hashes:
+                        self.__remove_file(self.__blob_manager.blob_path(hash))
+
+                if failed:
+                    bdd.release_writers(failed)
+                try:
+                    if removed:
+                        bdd.purge(removed, _remove_blobs)
+                        logging.info(f'{len(removed)} Items have been removed from cache.')
+                except Exception as e:
+                    # Their writers are released once their leases expire.
+                    for i, id, _ in taken:
+                        if id in removed:
+                            errors[i] = XtremCacheArchiveRemovingError(id, e)
+                            logging.error(f'remove {id}: {errors[i]}')
+        return left
+
+    def remove_many(self, entries: List[Dict[str, Any]]) -> List[Optional[Exception]]:
+        """Remove each entry, a dict of remove arguments (id, timeout), the deltas before their bases.
+
+        The entries of each depth of deltas are taken, then deleted, by chunks
+        of _MANY_BATCH in a transaction each, the busy ones are removed one by
+        one afterwards. Return the error of each entry, None on success."""
+
+        errors = self.__missing(entries)
+        bases = self.__bdd_manager.bases()
+        depth = lambda i: 1 + depth(bases[i]) if i in bases else 0
+        todo = sorted((i for i, error in enumerate(errors) if error is None), key=lambda i: -depth(entries[i]['id']))
+        for _, level in groupby(todo, key=lambda i: depth(entries[i]['id'])):
+            self.__run_chunks(self.__remove_chunk, self.remove, entries, list(level), errors, 1)
+        return errors
+
+    def batch(self, manifest: str = '-', workers: int = None) -> None:
+        """Run the operations of a JSON lines manifest (a file, or stdin with '-'), print the result of each one as a JSON line.
+
+        Each line is an object with an "op" (cache, uncache or remove) and the
+        arguments of this operation. The consecutive operations of the same
+        kind are run together, by cache_many, uncache_many or remove_many.
+        Raise XtremCacheBatchError if any operation failed."""
+
+        runners = {
+            'cache': lambda entries: self.cache_many(entries, workers),
+            'uncache': lambda entries: self.uncache_many(entries, workers),
+            'remove': self.remove_many
+        }
+        if manifest == '-':
+            # Not closed, it isn't ours.
+            content = sys.stdin.read()
+        else:
+            with open(manifest) as f:
+                content = f.read()
+        lines = [line for line in content.splitlines() if line.strip()]
+        # (op, arguments) of each line, or (None, error) if it is invalid.
+        operations = []
+        for line in lines:
+            try:
+                arguments = json.loads(line)
+                op = arguments.pop('op', None)
+                if op not in runners:
+                    raise XtremCacheInputError(f'Unknown operation "{op}", expected one of {", ".join(runners)}')
+                operations.append((op, arguments))
+            except Exception as e:
+                operations.append((None, e))
+        failed = 0
+        start = 0
+        while start < len(operations):
+            op = operations[start][0]
+            end = start + 1
+            while op and end < len(operations) and operations[end][0] == op:
+                end += 1
+            group = [arguments for _, arguments in operations[start:end]]
+            errors = runners[op]([dict(a) for a in group]) if op else group
+            for arguments, error in zip(group, errors):
+                result = {'op': op, 'id': arguments.get('id') if op else None, 'status': 'error' if error else 'ok'}
+                if error:
+                    failed += 1
+                    result['error'] = f'{error.__class__.__name__}: {error}'
+                print(json.dumps(result))
+            start = end
+        if failed:
+            raise XtremCacheBatchError(failed, len(operations))
 
     def display(self):
         """Print the full configuration thanks to tabulate lib."""
@@ -182,6 +1200,7 @@ class CacheManager():
         If it is not possible, raise an Exception"""
 
         self.__config.set_cache_dir(value, level)
+        self.__load()
         logging.info(f'Cache dir have been updated at {level} level.')
 
     def set_max_size(self, value: str, level: ConfigurationLevel):
@@ -189,4 +1208,13 @@ class CacheManager():
         If it is not possible, raise an Exception"""
 
         self.__config.set_max_size(value, level)
+        self.__load()
         logging.info(f'Max size have been updated at {level} level.')
+
+    def set_setting(self, var: str, value: str, level: ConfigurationLevel):
+        """Update the given tuning variable at the given level.
+        If it is not possible, raise an Exception"""
+
+        self.__config.set(var, value, level)
+        self.__load()
+        logging.info(f'{var} have been updated at {level} level.')
@@ -2,13 +2,10 @@ import os
 import re
 from abc import ABC, abstractproperty
 from enum import Enum
-from functools import lru_cache
-from typing import List
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple
 from pathlib import Path
 
-import yaml
-from tabulate import tabulate, SEPARATING_LINE
-
+from xtremcache.archivermanager import MAX_SHARD_DEPTH
 from xtremcache.utils import *
 from xtremcache.version import __app_name__
 
@@ -21,6 +18,131 @@ class ConfigurationLevel(Enum):
     RUNTIME = 'Runtime'
 
 
+class Setting():
+    """Tuning variable that can be set at any configuration level."""
+
+    def __init__(self, name: str, default: Any, parser: Callable[[Any], Any], help: str) -> None:
+        self.name = name
+        self.default = default
+        self.parser = parser
+        self.help = help
+
+    def parse(self, value: Any) -> Any:
+        """Convert the raw value (from file, env or runtime) to its typed value.
+
+        Raise XtremCacheInputError if the value is not valid."""
+
+        try:
+            return self.parser(value)
+        except XtremCacheInputError as e:
+            raise e
+        except Exception as e:
+            raise XtremCacheInputError(f'Invalid {self.name} value "{value}": {e}')
+
+
+def int_parser(min: int, max: int = None) -> Callable[[Any], int]:
+    """Return a parser accepting only integers greater or equal to min (and lower or equal to max)."""
+
+    def _parse(value: Any) -> int:
+        value = int(value)
+        if value < min or (max is not None and value > max):
+            raise XtremCacheInputError(f'Get {value}, expected an integer >= {min}' + (f' and <= {max}' if max is not None else ''))
+        return value
+    return _parse
+
+def size_parser(value: Any) -> int:
+    """Parse a size in bytes, given like max_size (e.g. '5000', '100m' or '5g')."""
+
+    return small_to_raw_size(str(value))
+
+def choice_parser(*choices: str) -> Callable[[Any], str]:
+    """Return a parser accepting only one of the given choices."""
+
+    def _parse(value: Any) -> str:
+        value = str(value).lower()
+        if value not in choices:
+            raise XtremCacheInputError(f'Get "{value}", expected one of {", ".join(choices)}')
+        return value
+    return _parse
+
+
+SETTINGS: Dict[str, Setting] = {s.name: s for s in [
+    Setting(
+        'archiver',
+        'python',
+        choice_parser('python', 'exec'),
+        'Archive engine: "python" (in process) or "exec" (external zip and unzip).'),
+    Setting(
+        'archive_format',
+        'zip',
+        choice_parser('zip', 'tar.zst', 'tar.lz4'),
+        'Format of the created archives, tar formats are always handled in process.'),
+    Setting(
+        'shard_depth',
+        0,
+        int_parser(0, MAX_SHARD_DEPTH),
+        'Number of levels of hash prefix dirs the archives are nested in (e.g. "ab/cd/<hash>.zip" with 2), run reshard after a change.'),
+    Setting(
+        'storage',
+        'archive',
+        choice_parser('archive', 'cas'),
+        'Storage of the cached files: "archive" (one archive per id) or "cas" (content addressed files shared between ids).'),
+    Setting(
+        'tree_store',
+        'off',
+        choice_parser('off', 'clone', 'hardlink'),
+        'Keep an extracted tree of each uncached id to fill the next destinations by "clone" (reflink or copy) or "hardlink".'),
+    Setting(
+        'eviction',
+        'lru',
+        choice_parser('lru', 'lfu', 'fifo', 'gdsf'),
+        'Items evicted first when the cache is full: least recently used, least frequently used, oldest or lowest hits per byte (gdsf).'),
+    Setting(
+        'high_watermark',
+        100,
+        int_parser(1, 100),
+        'Percentage of max_size at which the eviction starts.'),
+    Setting(
+        'low_watermark',
+        90,
+        int_parser(1, 100),
+        'Percentage of max_size the eviction brings the cache size down to, in one batch.'),
+    Setting(
+        'min_free_space',
+        0,
+        size_parser,
+        'Free space to keep on the filesystem of cache_dir (e.g. "10g"), the eviction also starts below it, 0 to ignore it.'),
+    Setting(
+        'eviction_mode',
+        'sync',
+        choice_parser('sync', 'background'),
+        'Evict in the cache call ("sync"), or on a worker thread of the process once the entry is committed ("background").'),
+    Setting(
+        'workers',
+        os.cpu_count() or 1,
+        int_parser(1),
+        'Number of worker threads used to compress and extract archives.'),
+]}
+
+
+class ConfigurationSnapshot(NamedTuple):
+    """Values resolved from all the configuration levels, parsed to their types."""
+
+    cache_dir: str
+    max_size: int
+    archiver: str
+    archive_format: str
+    shard_depth: int
+    storage: str
+    tree_store: str
+    eviction: str
+    high_watermark: int
+    low_watermark: int
+    min_free_space: int
+    eviction_mode: str
+    workers: int
+
+
 class Configuration(ABC):
     @abstractproperty
     def cache_dir(self) -> str:
@@ -43,6 +165,12 @@ class Configuration(ABC):
 
         return self.__id
 
+    @property
+    def stamp(self) -> Hashable:
+        """Return a value changing each time the values of this config may have changed."""
+
+        return None
+
     @property
     def is_set_cache_dir(self) -> bool:
         """Return True if the cache_dir variable is set in this config."""
@@ -65,6 +193,21 @@ class Configuration(ABC):
 
         raise NotImplementedError(f'This type of configuration ({self.id_}) do not allow max_size updates.')
 
+    def get(self, var: str) -> Any:
+        """Return the raw value of the given tuning variable, None if it is not set in this config."""
+
+        return None
+
+    def is_set(self, var: str) -> bool:
+        """Return True if the given tuning variable is set in this config."""
+
+        return self.get(var) != None
+
+    def set(self, var: str, value: str) -> None:
+        """Update the given tuning variable. (Not mandatory)"""
+
+        raise NotImplementedError(f'This type of configuration ({self.id_}) do not allow {var} updates.')
+
 
 class HardcodedConfiguration(Configuration):
     @property
@@ -83,18 +226,43 @@ class HardcodedConfiguration(Configuration):
     def is_set_max_size(self) -> bool:
         return True
 
+    def get(self, var: str) -> Any:
+        return SETTINGS[var].default
+
 
 class FileConfiguration(Configuration, ABC):
     def __init__(self, id_, confg_path) -> None:
         self.__config_path = confg_path
+        # Content of the file as last parsed, and the stamp of the file then (None if it did not exist).
+        self.__properties = dict()
+        self.__stamp = None
         super().__init__(id_)
 
+    @property
+    def stamp(self) -> Hashable:
+        try:
+            stat = os.stat(self.config_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
     def _read_yaml_properties(self) -> dict:
-        file_content = dict()
-        if os.path.isfile(self.config_path):
-            with open(self.config_path, 'r') as f:
-                file_content = yaml.safe_load(f)
-        return file_content
+        stamp = self.stamp
+        if stamp != self.__stamp:
+            file_content = dict()
+            if stamp is not None:
+                import yaml
+                with open(self.config_path, 'r') as f:
+                    file_content = yaml.safe_load(f) or dict()
+            self.__properties, self.__stamp = file_content, stamp
+        return dict(self.__properties)
+
+    def _write_yaml_properties(self, file_content: dict) -> None:
+        import yaml
+        os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
+        with open(self.config_path, 'w') as f:
+            yaml.safe_dump(file_content, f, default_flow_style=False)
+        self.__properties, self.__stamp = dict(file_content), self.stamp
 
     @property
     def config_path(self) -> str:
@@ -111,9 +279,7 @@ class FileConfiguration(Configuration, ABC):
     def set_cache_dir(self, value: str) -> None:
         file_content = self._read_yaml_properties()
         file_content['cache_dir'] = value
-        os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-        with open(self.config_path, 'w') as f:
-            yaml.safe_dump(file_content, f, default_flow_style=False)
+        self._write_yaml_properties(file_content)
 
     def set_max_size(self, value: str) -> None:
         if not re.match(r'^\d+[TGMtgm]$', value):
@@ -121,12 +287,22 @@ class FileConfiguration(Configuration, ABC):
                 f'Invalid max_size format: get {value}, correct format is \d+[TGMtgm] e.g.: \'5g\', \'100m\' or \'1t\'.')
         file_content = self._read_yaml_properties()
         file_content['max_size'] = value
-        os.makedirs(os.path.dirname(self.config_path), exist_ok=True)
-        with open(self.config_path, 'w') as f:
-            yaml.safe_dump(file_content, f, default_flow_style=False)
+        self._write_yaml_properties(file_content)
+
+    def get(self, var: str) -> Any:
+        return self._read_yaml_properties().get(var)
+
+    def set(self, var: str, value: str) -> None:
+        file_content = self._read_yaml_properties()
+        file_content[var] = value
+        self._write_yaml_properties(file_content)
 
 
 class EnvironementConfiguration(Configuration):
+    @property
+    def stamp(self) -> Hashable:
+        return tuple(sorted((k, v) for k, v in os.environ.items() if k.startswith('XCACHE_')))
+
     @property
     def cache_dir(self) -> str:
         return self.__env_cache_dir()
@@ -141,11 +317,15 @@ class EnvironementConfiguration(Configuration):
     def __env_max_size(self) -> str:
         return os.getenv('XCACHE_MAX_SIZE')
 
+    def get(self, var: str) -> Any:
+        return os.getenv(f'XCACHE_{var.upper()}')
+
 
 class RuntimeConfiguration(Configuration):
-    def __init__(self, id_, cache_dir: str, max_size: str) -> None:
+    def __init__(self, id_, cache_dir: str, max_size: str, **settings) -> None:
         self.__max_size = small_to_raw_size(max_size)
         self.__cache_dir = cache_dir
+        self.__settings = settings
         super().__init__(id_)
 
     @property
@@ -156,13 +336,17 @@ class RuntimeConfiguration(Configuration):
     def max_size(self) -> int:
         return self.__max_size
 
+    def get(self, var: str) -> Any:
+        return self.__settings.get(var)
+
 
 class ConfigurationManager:
     def __init__(
             self,
             configuration_priority: List[Configuration] = None,
             cache_dir: str = None,
-            max_size: str = None) -> None:
+            max_size: str = None,
+            **settings) -> None:
         # If no configuration list are past use the standard one.
         if configuration_priority:
             self.__configuration_priority = configuration_priority
@@ -175,22 +359,53 @@ class ConfigurationManager:
             ]
         # In anycase the runtime configuration is top level priority.
         self.__configuration_priority.append(
-            RuntimeConfiguration(ConfigurationLevel.RUNTIME.value, cache_dir, max_size))
-
+            RuntimeConfiguration(ConfigurationLevel.RUNTIME.value, cache_dir, max_size, **settings))
+        self.__snapshot = None
+        self.__stamps = None
 
     @property
-    @lru_cache
-    def cache_dir(self) -> str:
+    def snapshot(self) -> ConfigurationSnapshot:
+        """Return all the values resolved from the configuration levels.
+
+        The levels are resolved again only once one of them has changed (e.g. a file modified)."""
+
+        stamps = [config.stamp for config in self.__configuration_priority]
+        if self.__snapshot is None or stamps != self.__stamps:
+            self.__snapshot = self.__resolve()
+            self.__stamps = stamps
+        return self.__snapshot
+
+    def __resolve(self) -> ConfigurationSnapshot:
+        values = dict(cache_dir=None, max_size=None)
         for config in reversed(self.__configuration_priority):
             if config.is_set_cache_dir:
-                return config.cache_dir
+                values['cache_dir'] = config.cache_dir
+                break
+        for config in reversed(self.__configuration_priority):
+            if config.is_set_max_size:
+                values['max_size'] = config.max_size
+                break
+        for var, setting in SETTINGS.items():
+            value = setting.default
+            for config in reversed(self.__configuration_priority):
+                if config.is_set(var):
+                    value = config.get(var)
+                    break
+            values[var] = setting.parse(value)
+        return ConfigurationSnapshot(**values)
+
+    @property
+    def cache_dir(self) -> str:
+        return self.snapshot.cache_dir
 
     @property
-    @lru_cache
     def max_size(self) -> int:
-        for config in reversed(self.__configuration_priority):
-            if config.is_set_max_size:
-                return config.max_size
+        return self.snapshot.max_size
+
+    def get(self, var: str) -> Any:
+        """Return the typed value of the given tuning variable."""
+
+        return getattr(self.snapshot, SETTINGS[var].name)
 
     def set_cache_dir(self, value: Any, level: ConfigurationLevel):
         """Update cache_dir variable."""
@@ -201,8 +416,7 @@ class ConfigurationManager:
         for config in reversed(self.__configuration_priority):
             if config.id_ == level:
                 config.set_cache_dir(value)
-                # reset the lru_cache value for futur usage.
-                ConfigurationManager.cache_dir.fget.cache_clear()
+                self.__snapshot = None
                 return
         raise ValueError(f'The given configuration "{level}" is not known.')
 
@@ -212,23 +426,38 @@ class ConfigurationManager:
         for config in reversed(self.__configuration_priority):
             if config.id_ == level:
                 config.set_max_size(value)
-                # reset the lru_cache value for futur usage.
-                ConfigurationManager.max_size.fget.cache_clear()
+                self.__snapshot = None
+                return
+        raise ValueError(f'The given configuration "{level}" is not known.')
+
+    def set(self, var: str, value: str, level: ConfigurationLevel):
+        """Update the given tuning variable."""
+
+        if var not in SETTINGS:
+            raise XtremCacheInputError(f'Unknown variable "{var}"')
+        SETTINGS[var].parse(value)
+        for config in reversed(self.__configuration_priority):
+            if config.id_ == level:
+                config.set(var, value)
+                self.__snapshot = None
                 return
         raise ValueError(f'The given configuration "{level}" is not known.')
 
     def display(self):
         """Print the full configuration thanks to tabulate lib."""
+        from tabulate import tabulate, SEPARATING_LINE
+
         config_table = [
             [
                 c.id_,
                 c.cache_dir,
                 raw_to_small_size(c.max_size)
-            ]
+            ] + [c.get(var) for var in SETTINGS]
             for c in self.__configuration_priority
         ]
-        header = ['', 'cache_dir', 'max_size']
-        footer = [SEPARATING_LINE, ['Used', self.cache_dir, raw_to_small_size(self.max_size)]]
+        header = ['', 'cache_dir', 'max_size'] + list(SETTINGS)
+        snapshot = self.snapshot
+        footer = [SEPARATING_LINE, ['Used', snapshot.cache_dir, raw_to_small_size(snapshot.max_size)] + [getattr(snapshot, var) for var in SETTINGS]]
         print(tabulate(config_table + footer, header, tablefmt='simple', missingval="Not defined"))
 
 
@@ -0,0 +1,119 @@
+import os
+import stat
+import zlib
+from typing import Dict, List, Set, Tuple
+
+from xtremcache.archivermanager import ArchiveManager, ArchiveMember
+from xtremcache.bddmanager import BddManager
+from xtremcache.utils import *
+
+
+class DeltaManager():
+    """Delta Items: only the entries added or changed since a base Item are archived.
+
+    The paths of the base removed in the delta are recorded in the database,
+    a delta is restored by restoring its base, removing these paths and
+    extracting its archive over them."""
+
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, cache_dir: str, bdd_manager: BddManager, archiver: ArchiveManager) -> None:
+        self.__cache_dir = cache_dir
+        self.__bdd_manager = bdd_manager
+        self.__archiver = archiver
+
+    def listing(self, item) -> Dict[str, ArchiveMember]:
+        """Return the members of the full tree of the given Item, its bases included.
+
+        They are read from the manifests, or from the archive index for the
+        Items cached before the manifests were recorded."""
+
+        bdd = self.__bdd_manager
+        members = self.listing(bdd.get(item.base_id)) if item.base_id else {}
+        for path in bdd.deletions(item.id):
+            members.pop(path, None)
+        manifest = bdd.manifest(item.id)
+        if manifest or item.storage == 'cas':
+            members.update({e.path: ArchiveMember(e.kind, e.mode, e.size, e.mtime, link=e.link, hash=e.hash) for e in manifest})
+        else:
+            members.update(self.__archiver.index(os.path.join(self.__cache_dir, item.archive_path)))
+        return members
+
+    def __crc(self, path: str) -> int:
+        """Return the zip CRC32 of the given file."""
+
+        crc = 0
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(self.BUFFER_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+        return crc
+
+    def __unchanged(self, member: ArchiveMember, full_path: str, st: os.stat_result) -> bool:
+        """Return True if the entry at full_path is the same as the base member.
+
+        Files are compared by size, mode and content hash from the manifest,
+        or CRC when the archive has one (zip only keeps mtimes at 2 seconds
+        resolution), else by mtime."""
+
+        if member is None or member.mode != stat.S_IMODE(st.st_mode):
+            return False
+        if member.kind == 'dir':
+            return True
+        if member.kind == 'link':
+            return member.link == os.readlink(full_path)
+        if member.size != st.st_size:
+            return False
+        if member.hash is not None:
+            return member.hash == hash_file(full_path, self.BUFFER_SIZE)
+        if member.crc is not None:
+            return member.crc == self.__crc(full_path)
+        return member.mtime == st.st_mtime
+
+    def diff(self, base: Dict[str, ArchiveMember], src_path: str, excluded: List[str] = []) -> Tuple[List[str], List[str]]:
+        """Compare the file or dir at the given path with the base members.
+
+        Return the names of the added or changed entries and the ones of
+        the base entries to remove (deleted or replaced by another kind)."""
+
+        changed, deleted, seen = [], [], set()
+        for full_path, name in walk_tree(src_path, excluded):
+            st = os.lstat(full_path)
+            if stat.S_ISLNK(st.st_mode):
+                kind = 'link'
+            elif stat.S_ISDIR(st.st_mode):
+                kind = 'dir'
+            elif stat.S_ISREG(st.st_mode):
+                kind = 'file'
+            else:
+                continue
+            seen.add(name)
+            member = base.get(name)
+            if member is not None and member.kind != kind:
+                deleted.append(name)
+                member = None
+            if not self.__unchanged(member, full_path, st):
+                changed.append(name)
+        deleted += [name for name in base if name not in seen]
+        return changed, deleted
+
+    def remove_deleted(self, id: str, path: str, include: List[str] = None, members: Set[str] = None) -> None:
+        """Remove from the restored base at path the entries deleted by the delta id.
+
+        With include and members, only the entries selected by these globs and
+        names are removed."""
+
+        included = include_filter(include, members)
+        try:
+            for name in sorted(self.__bdd_manager.deletions(id), reverse=True):
+                if not included(name):
+                    continue
+                target = safe_join(path, name)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    filesystem_remove(target)
+                elif os.path.lexists(target):
+                    os.remove(target)
+        except Exception as e:
+            raise XtremCacheArchiveExtractionError(path, e)
@@ -1,4 +1,4 @@
-from typing import Callable
+from typing import Callable, List
 
 
 # --- Global --- #
@@ -35,6 +35,14 @@ class XtremCacheMaxSizeCachedError(XtremCacheException):
         super().__init__(msg)
 
 
+class XtremCacheBaseInUseError(XtremCacheException):
+    """Item used as base by delta items."""
+
+    def __init__(self, id: str, dependents: List[str]) -> None:
+        msg = f'"{id}" is the base of {", ".join(map(repr, dependents))}, remove them first.'
+        super().__init__(msg)
+
+
 class XtremCacheRemoveError(XtremCacheException):
     """Impossible to remove item."""
 
@@ -67,6 +75,22 @@ class XtremCacheInputError(XtremCacheException):
         super().__init__(msg)
 
 
+class XtremCacheBatchError(XtremCacheException):
+    """Some operations of a batch failed."""
+
+    def __init__(self, failed: int, total: int) -> None:
+        msg = f'{failed} of the {total} operations of the batch failed.'
+        super().__init__(msg)
+
+
+class XtremCacheMissingDependencyError(XtremCacheException):
+    """An optional dependency is needed."""
+
+    def __init__(self, module: str, extra: str) -> None:
+        msg = f'The "{module}" module is needed, install it with: pip install xtremcache[{extra}]'
+        super().__init__(msg)
+
+
 class XtremCacheArchiveException(XtremCacheException):
     """All exceptions related to the archive."""
 
@@ -0,0 +1,125 @@
+import os
+import re
+from typing import List, Tuple
+
+
+IGNORE_FILE = '.xtremcacheignore'
+
+
+class IgnoreMatcher():
+    """Exclusion patterns with the gitignore syntax, compiled once.
+
+    Patterns are relative to the root of the cached dir: a pattern containing
+    a / (but a trailing one) is anchored to the root, else it matches at any
+    depth. A trailing / only matches dirs, ** matches any number of dirs and
+    a leading ! re-includes what a previous pattern excluded. The last
+    matching pattern wins, and nothing is re-included in an excluded dir, as
+    its content is never walked."""
+
+    def __init__(self, patterns: List[str] = []) -> None:
+        self.__rules = []
+        for pattern in patterns:
+            rule = self.__compile(pattern)
+            if rule:
+                self.__rules.append(rule)
+        self.__rules.reverse()
+
+    @classmethod
+    def from_paths(cls, excluded: List[str] = []) -> 'IgnoreMatcher':
+        """Build a matcher from the excluded argument of cache.
+
+        For compatibility, the entries without any glob char or negation
+        are relative paths from the root, as before the gitignore syntax."""
+
+        patterns = []
+        for excl in excluded:
+            excl = excl.replace(os.sep, '/')
+            if not re.search(r'[*?\[!]', excl):
+                excl = '/' + os.path.normpath(excl).replace(os.sep, '/').lstrip('/')
+            patterns.append(excl)
+        return cls(patterns)
+
+    @classmethod
+    def from_tree(cls, src_path: str, excluded: List[str] = [], ignore_file: str = IGNORE_FILE) -> 'IgnoreMatcher':
+        """Build a matcher from the ignore file at the root of the dir at src_path, then the excluded entries."""
+
+        patterns = []
+        ignore_path = os.path.join(src_path, ignore_file) if ignore_file else None
+        if ignore_path and os.path.isfile(ignore_path):
+            with open(ignore_path, encoding='utf-8') as f:
+                patterns = f.read().splitlines()
+        matcher = cls.from_paths(excluded)
+        matcher.__rules += cls(patterns).__rules
+        return matcher
+
+    @staticmethod
+    def __translate(pattern: str) -> str:
+        """Convert the glob part of a gitignore pattern into a regex."""
+
+        regex = ''
+        i, n = 0, len(pattern)
+        while i < n:
+            c = pattern[i]
+            if pattern.startswith('**/', i) and (i == 0 or pattern[i - 1] == '/'):
+                regex += '(?:.*/)?'
+                i += 3
+                continue
+            if pattern.startswith('**', i) and i + 2 == n and (i == 0 or pattern[i - 1] == '/'):
+                regex += '.*'
+                i += 2
+                continue
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '\\' and i + 1 < n:
+                i += 1
+                regex += re.escape(pattern[i])
+            elif c == '[':
+                j = pattern.find(']', i + 2 if pattern.startswith('[!', i) or pattern.startswith('[^', i) else i + 1)
+                if j < 0:
+                    regex += re.escape(c)
+                else:
+                    content = pattern[i + 1:j]
+                    if content[0] in '!^':
+                        content = '^' + content[1:]
+                    regex += f"[{content.replace(chr(92), chr(92) * 2)}]"
+                    i = j
+            else:
+                regex += re.escape(c)
+            i += 1
+        return regex
+
+    def __compile(self, pattern: str) -> Tuple['re.Pattern', bool, bool]:
+        """Return (regex, negate, dir_only) of a gitignore line, None for blank lines and comments."""
+
+        pattern = pattern.rstrip('\n')
+        # Trailing spaces are ignored unless escaped.
+        while pattern.endswith(' ') and not pattern.endswith('\\ '):
+            pattern = pattern[:-1]
+        if not pattern or pattern.startswith('#'):
+            return None
+        negate = pattern.startswith('!')
+        if negate:
+            pattern = pattern[1:]
+        elif pattern.startswith('\\!') or pattern.startswith('\\#'):
+            pattern = pattern[1:]
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if not pattern:
+            return None
+        anchored = '/' in pattern
+        regex = self.__translate(pattern.lstrip('/'))
+        if not anchored:
+            regex = '(?:.*/)?' + regex
+        return re.compile(regex, re.DOTALL), negate, dir_only
+
+    def excluded(self, name: str, is_dir: bool = False) -> bool:
+        """Return True if the '/' separated relative name is excluded."""
+
+        for regex, negate, dir_only in self.__rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.fullmatch(name):
+                return not negate
+        return False
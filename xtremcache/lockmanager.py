@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import ContextManager, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from xtremcache.utils import *
+
+
+class LockManager():
+    """Per Item file locks, shared by the readers and exclusive for the writers.
+
+    A busy Item is waited for in the kernel: the waiter wakes up as soon as the
+    lock is released instead of polling the database. The lock files are kept
+    in <cache_dir>/locks and never removed, removing them would let two
+    processes lock two different files for the same Item.
+    The waiters are served in FIFO order: each one takes a numbered ticket,
+    holds its ticket file locked until it gets the Item lock and waits for
+    the ticket file of its predecessor before asking for it. A queued writer
+    then blocks the next readers, which can't starve it.
+    Locks are reentrant in a thread, a lock already held satisfies any nested
+    request on the same Item. Without fcntl (Windows), nothing is locked and
+    the callers keep polling the database."""
+
+    def __init__(self, cache_dir: str) -> None:
+        self.__locks_dir = os.path.join(cache_dir, 'locks')
+        self.__local = threading.local()
+
+    @property
+    def __held(self) -> dict:
+        """Count of the locks held by the current thread, by path of their files without extension."""
+
+        if not hasattr(self.__local, 'held'):
+            self.__local.held = {}
+        return self.__local.held
+
+    @staticmethod
+    def __flock(fd: int, operation: int, timeout: float = None) -> bool:
+        """Lock fd, waiting up to timeout seconds (forever with None), return False on timeout.
+
+        The blocking call can't be interrupted, it is made on a helper thread
+        which releases the lock and closes fd itself if it is acquired too late."""
+
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if timeout is not None and timeout <= 0:
+                os.close(fd)
+                return False
+        acquired = threading.Event()
+        guard = threading.Lock()
+        abandoned = []
+
+        def _wait():
+            fcntl.flock(fd, operation)
+            with guard:
+                if abandoned:
+                    os.close(fd)
+                else:
+                    acquired.set()
+
+        threading.Thread(target=_wait, daemon=True).start()
+        if acquired.wait(timeout):
+            return True
+        with guard:
+            if acquired.is_set():
+                return True
+            abandoned.append(True)
+        return False
+
+    @staticmethod
+    def __take_ticket(base: str) -> Tuple[str, int, str]:
+        """Take the next ticket of the queue of the lock at base.
+
+        Return the path of its ticket file, the fd locking it and the path of
+        the ticket file of the predecessor."""
+
+        fd = os.open(f'{base}.queue', os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            number = int(os.pread(fd, 32, 0) or 0) + 1
+            os.pwrite(fd, str(number).encode().ljust(32), 0)
+            ticket_path = f'{base}.{number}.ticket'
+            ticket_fd = os.open(ticket_path, os.O_RDWR | os.O_CREAT, 0o666)
+            fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+        finally:
+            os.close(fd)
+        return ticket_path, ticket_fd, f'{base}.{number - 1}.ticket'
+
+    @staticmethod
+    def __release_ticket(ticket_path: str, ticket_fd: int) -> None:
+        """Let the successor of the ticket ask for the lock."""
+
+        try:
+            os.remove(ticket_path)
+        except FileNotFoundError:
+            pass
+        os.close(ticket_fd)
+
+    def __wait_turn(self, predecessor_path: str, timeout: float = None) -> bool:
+        """Wait until the predecessor got the lock, return False on timeout."""
+
+        try:
+            fd = os.open(predecessor_path, os.O_RDWR)
+        except FileNotFoundError:
+            return True
+        if not self.__flock(fd, fcntl.LOCK_SH, timeout):
+            return False
+        os.close(fd)
+        return True
+
+    def lock(self, id: str, exclusive: bool = False, timeout: float = None) -> ContextManager[float]:
+        """Hold the lock of the Item id during the block, yield the seconds waited for it.
+
+        Raise FunctionRecallAsked if it is not acquired within timeout seconds."""
+
+        return self.__lock(os.path.join(self.__locks_dir, str_to_md5(id)), exclusive, timeout)
+
+    def eviction_lock(self, timeout: float = None) -> ContextManager[float]:
+        """Hold the lock of the eviction during the block, so that one process evicts at a time.
+
+        Its file is not named by a hash, it is never the lock of an Item."""
+
+        return self.__lock(os.path.join(self.__locks_dir, 'eviction'), True, timeout)
+
+    @contextmanager
+    def __lock(self, base: str, exclusive: bool, timeout: float) -> Iterator[float]:
+        """Hold the lock whose files start with base, see lock."""
+
+        if fcntl is None or base in self.__held:
+            self.__held[base] = self.__held.get(base, 0) + 1
+            try:
+                yield 0
+            finally:
+                self.__held[base] -= 1
+                if not self.__held[base]:
+                    del self.__held[base]
+            return
+        os.makedirs(self.__locks_dir, exist_ok=True)
+        start_time = time.time()
+        remaining = lambda: None if timeout is None else max(0, timeout - (time.time() - start_time))
+        ticket_path, ticket_fd, predecessor_path = self.__take_ticket(base)
+        try:
+            acquired = self.__wait_turn(predecessor_path, remaining())
+            if acquired:
+                fd = os.open(f'{base}.lock', os.O_RDWR | os.O_CREAT, 0o666)
+                acquired = self.__flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, remaining())
+        finally:
+            self.__release_ticket(ticket_path, ticket_fd)
+        if not acquired:
+            raise FunctionRecallAsked(self.lock)
+        self.__held[base] = 1
+        try:
+            yield time.time() - start_time
+        finally:
+            del self.__held[base]
+            os.close(fd)
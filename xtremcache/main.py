@@ -1,9 +1,11 @@
 import argparse
 import inspect
 import logging
+from functools import partial
 from typing import List
 
 from xtremcache.cachemanager import CacheManager
+from xtremcache.configuration import SETTINGS
 from xtremcache.exceptions import *
 from xtremcache.utils import *
 
@@ -18,7 +20,7 @@ class XtreamCacheArgumentParser:
         self._parser.add_argument(
             '--timeout', '-t',
             dest='timeout',
-            type=str,
+            type=float,
             action='store',
             required=False,
             help='Maximum time of execution in second before stop of the process.')
@@ -74,7 +76,7 @@ class XtreamCacheArgumentParser:
             nargs='*',
             action='store',
             required=False,
-            help='Explicitly exclude the specified list of file and dir (relative path from given target).')
+            help='Explicitly exclude the specified list of file and dir (relative path from given target, or gitignore pattern).')
         cache_parser.add_argument(
             '--compression-level', '-c',
             dest='compression_level',
@@ -83,6 +85,12 @@ class XtreamCacheArgumentParser:
             required=False,
             default=6,
             help='Level of compression 0 is the fastest and 9 is the most compressed (based on zip -#).')
+        cache_parser.add_argument(
+            '--base', '-b',
+            dest='base_id',
+            type=str,
+            required=False,
+            help='Id of a cached archive, only the differences with it are stored.')
 
         # Uncache parser
         uncache_parser = command_parser.add_parser(
@@ -99,6 +107,98 @@ class XtreamCacheArgumentParser:
             'path',
             type=str,
             help='Destination file or directory.')
+        uncache_parser.add_argument(
+            '--workers', '-w',
+            dest='workers',
+            type=int,
+            required=False,
+            help='Number of threads extracting the archive (default to the workers setting).')
+        uncache_parser.add_argument(
+            '--only', '-o',
+            dest='include',
+            type=str,
+            nargs='+',
+            required=False,
+            help='Only uncache the files and dirs matching these globs (relative paths, * also matches /).')
+        uncache_parser.add_argument(
+            '--incremental',
+            dest='incremental',
+            action='store_true',
+            required=False,
+            help='Only write the files differing from the ones already in the destination.')
+        uncache_parser.add_argument(
+            '--delete',
+            dest='delete',
+            action='store_true',
+            required=False,
+            help='Remove the files of the destination that are not in the archive, implies --incremental.')
+
+        # Ls parser
+        ls_parser = command_parser.add_parser(
+            'ls',
+            description='List the cached archives, or the content of one of them.',
+            help='List the cached archives, or the content of one of them.')
+        ls_parser.add_argument(
+            '--id', '-i',
+            dest='id',
+            type=str,
+            required=False,
+            help='Id of the archive to list the content of, if not specified, list all the archives.')
+
+        # Locks parser
+        locks_parser = command_parser.add_parser(
+            'locks',
+            description='List the processes reading or writing the cached archives.',
+            help='List the processes reading or writing the cached archives.')
+        locks_parser.add_argument(
+            '--id', '-i',
+            dest='id',
+            type=str,
+            required=False,
+            help='Id of the archive to list the locks of, if not specified, list the locks of all the archives.')
+        locks_parser.add_argument(
+            '--clear', '-c',
+            dest='clear',
+            action='store_true',
+            required=False,
+            help='Release the locks of dead processes and the expired ones, the archives left by a dead writer are removed.')
+
+        # Batch parser
+        batch_parser = command_parser.add_parser(
+            'batch',
+            description='Run the cache, uncache and remove operations of a JSON lines manifest, one JSON object by line '
+                        '(e.g. {"op": "uncache", "id": "UUID", "path": "/tmp/dest"}), and print the result of each one.',
+            help='Run the cache, uncache and remove operations of a JSON lines manifest.')
+        batch_parser.add_argument(
+            dest='manifest',
+            type=str,
+            nargs='?',
+            default='-',
+            help='Path to the manifest, stdin by default.')
+        batch_parser.add_argument(
+            '--workers', '-w',
+            dest='workers',
+            type=int,
+            required=False,
+            help='Number of operations run at once, the configured workers by default.')
+
+        # Reconcile parser
+        command_parser.add_parser(
+            'reconcile',
+            description='Compute the size of the cache content again and correct its running total.',
+            help='Compute the size of the cache content again and correct its running total.')
+
+        # Evict parser
+        command_parser.add_parser(
+            'evict',
+            description='Remove the idle archives, in the order of the eviction policy, until the cache is below its watermarks.',
+            help='Remove the idle archives until the cache is below its watermarks.')
+
+        # Reshard parser
+        command_parser.add_parser(
+            'reshard',
+            description='Move the cached archives to the dirs of the shard_depth setting, while the cache stays in use.',
+            help='Move the cached archives to the dirs of the shard_depth setting.')
 
         # Remove parser
         remove_parser = command_parser.add_parser(
@@ -191,6 +291,10 @@ class CommandRunner():
                 command_func = {
                     'cache_dir': self.__manager.set_cache_dir,
                     'max_size': self.__manager.set_max_size,
+                    **{
+                        var: partial(self.__manager.set_setting, var)
+                        for var in SETTINGS
+                    }
                 }[args.var]
             except KeyError as e:
                 raise XtremCacheInputError(f'Impossible to set the varibale: {e}')
@@ -224,7 +328,9 @@ def run_xtremcache(argv: List[str]) -> int:
         CommandRunner(CacheManager(
             cache_dir=args.cache_dir if 'cache_dir' in args else None,
             max_size=args.max_size if 'max_size' in args else None,
-            log_level=args.log_level
+            log_level=args.log_level,
+            # The command line exits without waiting for a background eviction.
+            detach_eviction=True
         )).run(args)
     except Exception as e:
         logging.error(f'{e.__class__.__name__}: {e}')
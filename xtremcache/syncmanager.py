@@ -0,0 +1,131 @@
+import os
+import stat
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Set
+
+from xtremcache.archivermanager import ArchiveMember
+from xtremcache.utils import *
+
+
+class SyncManager():
+    """Compare a destination dir with the members of a cached Item, as rsync does.
+
+    Files are compared by size, mode and mtime first, then by content hash (or
+    zip CRC) when only the mtime differs. The destination is stat on a pool of
+    worker threads."""
+
+    BUFFER_SIZE = 1024 * 1024
+
+    # Tolerance on mtimes, they are stored as floats.
+    MTIME_EPSILON = 1e-6
+
+    def __init__(self, workers: int = 1) -> None:
+        self.__workers = workers
+
+    def __same_content(self, member: ArchiveMember, full_path: str) -> bool:
+        """Return True if the file at full_path has the content of the member."""
+
+        if member.hash is not None:
+            return member.hash == hash_file(full_path, self.BUFFER_SIZE)
+        if member.crc is not None:
+            crc = 0
+            with open(full_path, 'rb') as f:
+                for data in iter(lambda: f.read(self.BUFFER_SIZE), b''):
+                    crc = zlib.crc32(data, crc)
+            return member.crc == crc
+        return False
+
+    def __compare(self, name: str, member: ArchiveMember, path: str) -> str:
+        """Return 'same', 'metadata' (only mode or mtime differ), 'changed' or 'replaced' (another kind)."""
+
+        target = safe_join(path, name)
+        try:
+            st = os.lstat(target)
+        except FileNotFoundError:
+            return 'changed'
+        kind = 'link' if stat.S_ISLNK(st.st_mode) else 'dir' if stat.S_ISDIR(st.st_mode) else 'file'
+        if kind != member.kind:
+            return 'replaced'
+        if member.kind == 'dir':
+            return 'same'
+        if member.kind == 'link':
+            return 'same' if os.readlink(target) == member.link else 'changed'
+        if not stat.S_ISREG(st.st_mode) or st.st_size != member.size:
+            return 'changed'
+        same_mode = not member.mode or stat.S_IMODE(st.st_mode) == member.mode
+        if same_mode and abs(st.st_mtime - member.mtime) < self.MTIME_EPSILON:
+            return 'same'
+        return 'metadata' if self.__same_content(member, target) else 'changed'
+
+    def stale(
+            self,
+            members: Dict[str, ArchiveMember],
+            path: str,
+            included: Callable[[str], bool]) -> Set[str]:
+        """Return the names of the included members to restore at the given path.
+
+        The files only differing by their mode or mtime are fixed in place,
+        the entries of another kind than the member are removed."""
+
+        names = [name for name in members if included(name)]
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            states = list(executor.map(lambda name: self.__compare(name, members[name], path), names))
+        changed, replaced = set(), []
+        for name, state in zip(names, states):
+            if state in ('changed', 'replaced'):
+                changed.add(name)
+            if state == 'replaced':
+                replaced.append(name)
+            elif state == 'metadata':
+                self.fix_metadata(members, path, [name])
+        self.remove(path, sorted(replaced, reverse=True))
+        return changed
+
+    def fix_metadata(self, members: Dict[str, ArchiveMember], path: str, names: List[str]) -> None:
+        """Set the mode and the exact mtime of the given restored files.
+
+        The archives may round the mtimes (zip keeps 2 seconds), the next
+        comparisons can then stop at the quick check. The files with other
+        hardlinks, as the ones shared with a tree store, are left as they are:
+        their metadata are the ones of the other paths too."""
+
+        for name in names:
+            member = members[name]
+            if member.kind != 'file':
+                continue
+            target = safe_join(path, name)
+            if os.lstat(target).st_nlink > 1:
+                continue
+            if member.mode:
+                os.chmod(target, member.mode)
+            mtime_ns = round(member.mtime * 1e9)
+            os.utime(target, ns=(mtime_ns, mtime_ns))
+
+    def extra(
+            self,
+            members: Dict[str, ArchiveMember],
+            path: str,
+            included: Callable[[str], bool]) -> List[str]:
+        """Return the names of the included entries at the given path that are not members."""
+
+        if not os.path.isdir(path):
+            return []
+        extra = []
+        for full_path, name in walk_tree(path, ignore_file=None):
+            # Dirs are walked before their content, which is removed with them.
+            if extra and name.startswith(extra[-1] + '/'):
+                continue
+            if name not in members and included(name):
+                extra.append(name)
+        return extra
+
+    def remove(self, path: str, names: List[str]) -> None:
+        """Remove the given entries from path."""
+
+        for name in names:
+            target = safe_join(path, name)
+            if os.path.isdir(target) and not os.path.islink(target):
+                filesystem_remove(target)
+            elif os.path.lexists(target):
+                os.remove(target)
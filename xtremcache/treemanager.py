@@ -0,0 +1,189 @@
+import errno
+import os
+import shutil
+import stat
+import tempfile
+from typing import Callable, List, Set
+
+from xtremcache.bddmanager import BddManager
+from xtremcache.utils import *
+
+
+class FileCloner():
+    """Fill files from a source tree with the cheapest method supported by the filesystem.
+
+    In order: hardlink (only if asked), reflink (FICLONE), copy_file_range and
+    finally a regular copy. A method failing because the filesystem does not
+    support it is not tried again for the next files."""
+
+    # ioctl number of FICLONE (linux/fs.h).
+    FICLONE = 0x40049409
+
+    __UNSUPPORTED = (errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EMLINK)
+
+    def __init__(self) -> None:
+        self.__hardlink = True
+        self.__reflink = is_unix()
+        self.__copy_file_range = hasattr(os, 'copy_file_range')
+
+    def __clone_range(self, src: str, dst: str) -> None:
+        """Copy src into dst with a reflink or copy_file_range, raise OSError if not supported."""
+
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            if self.__reflink:
+                try:
+                    import fcntl
+                    fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+                    return
+                except (ImportError, OSError) as e:
+                    if isinstance(e, OSError) and e.errno not in self.__UNSUPPORTED:
+                        raise e
+                    self.__reflink = False
+            if self.__copy_file_range:
+                try:
+                    size = os.fstat(fsrc.fileno()).st_size
+                    offset = 0
+                    while offset < size:
+                        n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), size - offset, offset, offset)
+                        if not n:
+                            break
+                        offset += n
+                    return
+                except OSError as e:
+                    if e.errno not in self.__UNSUPPORTED:
+                        raise e
+                    self.__copy_file_range = False
+                    fdst.truncate(0)
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+    def clone(self, src: str, dst: str, hardlink: bool = False) -> bool:
+        """Fill dst with the content of src.
+
+        Return True if dst is a hardlink of src (so its metadata are shared)."""
+
+        if hardlink and self.__hardlink:
+            try:
+                os.link(src, dst)
+                return True
+            except OSError as e:
+                if e.errno not in self.__UNSUPPORTED:
+                    raise e
+                self.__hardlink = False
+        self.__clone_range(src, dst)
+        return False
+
+
+class TreeManager():
+    """Store of the extracted trees of the cached ids.
+
+    An extracted tree is created at the first uncache of an id, the next ones
+    fill the destination from it without any decompression."""
+
+    __WRITE = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+    def __init__(self, cache_dir: str, bdd_manager: BddManager, hardlink: bool = False) -> None:
+        self.__tree_dir = os.path.join(cache_dir, 'trees')
+        self.__bdd_manager = bdd_manager
+        self.__hardlink = hardlink
+
+    def tree_path(self, id: str) -> str:
+        """Convert an id into its extracted tree path."""
+
+        return os.path.join(self.__tree_dir, str_to_md5(id))
+
+    def exists(self, id: str) -> bool:
+        """Return True if the extracted tree of id is available."""
+
+        return os.path.isdir(self.tree_path(id))
+
+    def materialize(self, id: str, extract: Callable[[str], None]) -> None:
+        """Create the extracted tree of id by calling extract on a temporary dir.
+
+        In hardlink mode the write permissions of the files are removed, as
+        they are shared with the destinations."""
+
+        os.makedirs(self.__tree_dir, exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=self.__tree_dir, suffix='.tmp')
+        try:
+            extract(tmp_path)
+            size = 0
+            for full_path, _ in walk_tree(tmp_path, ignore_file=None):
+                st = os.lstat(full_path)
+                if stat.S_ISREG(st.st_mode):
+                    size += st.st_size
+                    if self.__hardlink:
+                        os.chmod(full_path, stat.S_IMODE(st.st_mode) & ~self.__WRITE)
+            try:
+                os.rename(tmp_path, self.tree_path(id))
+            except OSError:
+                # Already created by a concurrent uncache.
+                filesystem_remove(tmp_path)
+            else:
+                self.__bdd_manager.add_tree(id, size)
+        except Exception as e:
+            filesystem_remove(tmp_path)
+            raise XtremCacheArchiveExtractionError(self.tree_path(id), e)
+
+    def uncache(self, id: str, path: str, include: List[str] = None, members: Set[str] = None) -> None:
+        """Fill the given path from the extracted tree of id.
+
+        With include and members, only the entries selected by these globs
+        and names are filled. Only the errors reading the tree raise
+        XtremCacheArchiveExtractionError, the OSError raised writing the
+        destination are raised unchanged."""
+
+        tree_path = self.tree_path(id)
+        cloner = FileCloner()
+        included = include_filter(include, members)
+        try:
+            os.makedirs(path, exist_ok=True)
+            dirs = []
+            for full_path, name in walk_tree(tree_path, ignore_file=None):
+                if not included(name):
+                    continue
+                target = safe_join(path, name)
+                st = os.lstat(full_path)
+                if stat.S_ISDIR(st.st_mode):
+                    os.makedirs(target, exist_ok=True)
+                    dirs.append((target, st))
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                if os.path.lexists(target):
+                    os.remove(target)
+                if stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(full_path), target)
+                # Only the read only files of the tree can be shared with the destination.
+                elif not cloner.clone(full_path, target, self.__hardlink and not st.st_mode & self.__WRITE):
+                    os.chmod(target, stat.S_IMODE(st.st_mode))
+                    os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+            for target, st in reversed(dirs):
+                os.chmod(target, stat.S_IMODE(st.st_mode))
+                os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+        except OSError as e:
+            if not self.__reading(e, tree_path):
+                # The destination can't be written, the tree is not at fault.
+                raise e
+            raise XtremCacheArchiveExtractionError(path, e)
+        except Exception as e:
+            raise XtremCacheArchiveExtractionError(path, e)
+
+    @staticmethod
+    def __reading(e: OSError, tree_path: str) -> bool:
+        """Return True if e was raised reading the tree at tree_path, not writing the destination.
+
+        A link or a clone names the file of the tree first, it is only at fault if it is missing."""
+
+        source = e.filename
+        if not isinstance(source, str) or not (source == tree_path or source.startswith(tree_path + os.sep)):
+            return False
+        return e.filename2 is None or not os.path.lexists(source)
+
+    def remove(self, id: str) -> None:
+        """Delete the extracted tree of id if any."""
+
+        try:
+            if self.exists(id):
+                filesystem_remove(self.tree_path(id))
+            self.__bdd_manager.delete_tree(id)
+        except Exception as e:
+            raise XtremCacheArchiveRemovingError(id, e)
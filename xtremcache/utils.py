@@ -1,11 +1,17 @@
+import fnmatch
 import hashlib
+import importlib
 import os
+import re
+import stat
 import subprocess
 import sys
 import time
-from typing import Any, Callable
+from types import ModuleType
+from typing import Any, Callable, Dict, Iterator, List, Set, Tuple
 
 from xtremcache.exceptions import *
+from xtremcache.ignorematcher import IGNORE_FILE, IgnoreMatcher
 
 
 def xtremcache_location() -> str:
@@ -21,11 +27,151 @@ def str_to_md5(val: str) -> str:
 
     return hashlib.md5(val.encode()).hexdigest()
 
+def import_optional(module: str, extra: str) -> ModuleType:
+    """Import an optional dependency, installed with the given setup.py extra."""
+
+    try:
+        return importlib.import_module(module)
+    except ImportError:
+        raise XtremCacheMissingDependencyError(module, extra)
+
+def content_hasher() -> 'hashlib._Hash':
+    """Return a new hash object used to identify file contents."""
+
+    return hashlib.blake2b(digest_size=16)
+
+def hash_file(path: str, buffer_size: int = 1024 * 1024) -> str:
+    """Return the content hash of the given file."""
+
+    hasher = content_hasher()
+    buffer = memoryview(bytearray(buffer_size))
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(buffer[:n])
+    return hasher.hexdigest()
+
+def manifest_entry(full_path: str, name: str, st: os.stat_result) -> Dict:
+    """Return the manifest entry of the given file, dir or symlink (None for other kinds).
+
+    The content hash of the files is left to the caller."""
+
+    entry = {
+        'path': name,
+        'mode': stat.S_IMODE(st.st_mode),
+        'mtime': st.st_mtime,
+        'size': 0,
+        'hash': None,
+        'link': None,
+    }
+    if stat.S_ISLNK(st.st_mode):
+        entry['kind'] = 'link'
+        entry['link'] = os.readlink(full_path)
+    elif stat.S_ISDIR(st.st_mode):
+        entry['kind'] = 'dir'
+    elif stat.S_ISREG(st.st_mode):
+        entry['kind'] = 'file'
+        entry['size'] = st.st_size
+    else:
+        return None
+    return entry
+
+def tree_root(src_path: str) -> str:
+    """Return the dir the names of the entries of the file or dir are relative to."""
+
+    return src_path if os.path.isdir(src_path) else os.path.dirname(os.path.abspath(src_path))
+
+def tree_size(src_path: str, excluded: List[str] = [], member_overhead: int = 0) -> int:
+    """Return the size in bytes of the regular files of the file or dir, as walked by walk_tree.
+
+    member_overhead bytes plus twice its name are added for every entry, the
+    headers taken by each member of an archive."""
+
+    size = 0
+    for full_path, name in walk_tree(src_path, excluded):
+        size += member_overhead and member_overhead + 2 * len(name.encode())
+        st = os.lstat(full_path)
+        if stat.S_ISREG(st.st_mode):
+            size += st.st_size
+    return size
+
+def walk_tree(src_path: str, excluded: List[str] = [], ignore_file: str = IGNORE_FILE) -> Iterator[Tuple[str, str]]:
+    """Yield the (path, relative name) of every entry of the file or dir, symlinks are not followed.
+
+    The excluded entries and the ones matching the ignore file at the root
+    of the dir are skipped (see IgnoreMatcher), the content of an excluded
+    dir is never read. Dirs are yielded before their content, in name order."""
+
+    matcher = IgnoreMatcher.from_tree(src_path, excluded, ignore_file)
+    if not os.path.isdir(src_path) or os.path.islink(src_path):
+        name = os.path.basename(os.path.abspath(src_path))
+        if not matcher.excluded(name):
+            yield os.path.join(tree_root(src_path), name), name
+        return
+
+    def _walk(dir_path: str, prefix: str) -> Iterator[Tuple[str, str]]:
+        with os.scandir(dir_path) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        for entry in entries:
+            name = prefix + entry.name
+            # The type comes from the dir listing, the entry is not stat.
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if matcher.excluded(name, is_dir):
+                continue
+            yield entry.path, name
+            if is_dir:
+                yield from _walk(entry.path, name + '/')
+
+    yield from _walk(src_path, '')
+
+def include_filter(include: List[str] = None, members: Set[str] = None) -> Callable[[str], bool]:
+    """Return a predicate telling if a member name is selected by the include globs.
+
+    A member is selected if its name or the one of a parent dir matches one of
+    the globs (fnmatch syntax, * also matches /). Without include, all the
+    members are selected. With members, only these exact names are selected."""
+
+    if members is not None:
+        included = include_filter(include)
+        return lambda name: name.rstrip('/') in members and included(name)
+    if not include:
+        return lambda name: True
+    regex = re.compile('|'.join(f'(?:{fnmatch.translate(glob.strip("/"))})' for glob in include))
+
+    def _included(name: str) -> bool:
+        parts = name.rstrip('/').split('/')
+        return any(regex.match('/'.join(parts[:i])) for i in range(1, len(parts) + 1))
+
+    return _included
+
+def safe_join(path: str, name: str) -> str:
+    """Join the relative name to path, refusing the names escaping path."""
+
+    target = os.path.normpath(os.path.join(path, name))
+    if os.path.isabs(name) or os.path.relpath(target, path).startswith(os.pardir):
+        raise ValueError(f'"{name}" is outside of "{path}".')
+    return target
+
 def is_unix() -> bool:
     """Return True if the building is an Unix at compilation time."""
 
     return not ('win' in sys.platform)
 
+def pid_alive(pid: int) -> bool:
+    """Return True if the process pid runs on this host, always True out of Unix."""
+
+    if not is_unix():
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
 def timeout_exec(timeout_sec: int, fn: Callable, *args, **kwargs) -> Any:
     """Try to execute fn and relaunch it if the FunctionRetry signal is raised and some time are left."""
 